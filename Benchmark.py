@@ -0,0 +1,824 @@
+"""
+Synthetic station fleet and benchmark suite for Climanet.
+
+Virtual stations print readings exactly like Receiver.ino does, the lines go
+through Data_parsing.parse_serial_line, and the resulting /submit payloads
+drive the server, either in-process through Flask's test client or over
+HTTP. Throughput and p50/p99 latency per endpoint and data size are written
+as JSON, so storage or parsing changes can be compared run to run.
+
+Usage:
+    python Benchmark.py run --stations 50 --rows 1000,100000 --out results.json
+    python Benchmark.py run --url http://localhost:5000 --requests 500
+    python Benchmark.py stress --processes 8 --devices 4 --readings 2000
+    python Benchmark.py rollups --readings 3000
+    python Benchmark.py wire --stations 50 --rounds 200
+    python Benchmark.py parser --repeat 50 --capture receiver.log
+"""
+import argparse
+import calendar
+import csv
+import gzip
+import io
+import json
+import math
+import multiprocessing
+import os
+import platform
+import random
+import shutil
+import sys
+import tempfile
+import threading
+import time
+
+import Wire_format
+from Data_parsing import parse_serial_line, tokenize_serial_line
+
+CORPUS_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "serial_corpus.jsonl")
+READING_INTERVAL = 5   # seconds between readings of one station, as on the Receiver
+START_TIME = calendar.timegm((2025, 6, 1, 0, 0, 0))
+
+
+class VirtualStation:
+    """One simulated station: fixed position, diurnal temperature/UV, sticky rain."""
+
+    def __init__(self, device_id: int, rng: random.Random, start_ts: float = START_TIME):
+        self.device_id = device_id
+        self.rng = rng
+        self.ts = start_ts
+        self.lon = rng.uniform(20.5, 26.5)   # somewhere over Greece
+        self.lat = rng.uniform(35.0, 41.5)
+        self.alt = rng.uniform(0, 900)
+        self.temp_offset = rng.uniform(-3, 3)
+        self.raining = False
+
+    def reading(self) -> dict:
+        """Advances the clock by READING_INTERVAL and returns the reading as a /submit dict."""
+        self.ts += READING_INTERVAL
+        hour = (self.ts % 86400) / 3600
+        temp = 22 + self.temp_offset + 7 * math.sin(2 * math.pi * (hour - 9) / 24)
+        temp += self.rng.gauss(0, 0.3) - self.alt / 150
+        hum = min(100.0, max(15.0, 65 - 2.2 * (temp - 22) + self.rng.gauss(0, 2)))
+        uv = max(0.0, 9 * math.sin(math.pi * (hour - 6) / 12)) if 6 < hour < 18 else 0.0
+        if self.rng.random() < 0.002:
+            self.raining = not self.raining
+        if self.raining:
+            uv /= 3
+            hum = min(100.0, hum + 20)
+        return {
+            "time": time.strftime("%d-%m-%Y %H:%M:%S", time.gmtime(self.ts)),
+            "long": round(self.lon, 6),
+            "lat": round(self.lat, 6),
+            "alt": round(self.alt, 2),
+            "temp": round(temp, 2),
+            "hum": round(hum, 2),
+            "uv": round(uv, 2),
+            "rain": int(self.raining),
+        }
+
+    def serial_line(self) -> str:
+        """Returns the next reading as Receiver.ino's printAllValues() would print it."""
+        return format_serial_line(self.device_id, self.reading())
+
+
+def format_serial_line(device_id: int, r: dict) -> str:
+    return (f"Dev={device_id},Time={r['time']},Lon={r['long']:.6f},Lat={r['lat']:.6f},"
+            f"Alt={r['alt']:.2f},Temp={r['temp']:.2f},Hum={r['hum']:.2f},"
+            f"UV={r['uv']:.2f},Rain={r['rain']},end")
+
+
+def make_fleet(count: int, seed: int = 1):
+    rng = random.Random(seed)
+    return [VirtualStation(device_id, rng) for device_id in range(count)]
+
+
+def fleet_payload(stations) -> dict:
+    """One /submit payload with a reading from every station, parsed from its serial line."""
+    payload = {}
+    for station in stations:
+        parsed = parse_serial_line(station.serial_line())
+        payload[str(parsed.pop("device"))] = parsed
+    return payload
+
+
+def preload(data_dir: str, stations, rows: int):
+    """Writes `rows` readings spread over the stations straight into server-format CSVs."""
+    per_station = max(1, rows // len(stations))
+    for station in stations:
+        path = os.path.join(data_dir, f"{station.device_id}_data.csv")
+        with open(path, "w", newline="") as f:
+            f.write("time,longitude,latitude,altitude,temp,hum,uv,rain\r\n")
+            chunk = []
+            for _ in range(per_station):
+                r = station.reading()
+                chunk.append(f"{r['time']},{r['long']},{r['lat']},{r['alt']},"
+                             f"{r['temp']},{r['hum']},{r['uv']},{r['rain']}\r\n")
+                if len(chunk) >= 10000:
+                    f.writelines(chunk)
+                    chunk = []
+            f.writelines(chunk)
+
+
+# === Targets ===
+
+class LocalTarget:
+    """Drives Server.app in-process through one Flask test client per thread."""
+
+    def __init__(self):
+        import Server
+        self.server = Server
+        self.local = threading.local()
+
+    def use_data_dir(self, data_dir: str):
+        """Points the server at `data_dir` and rebuilds its indexes, as a restart would."""
+        server = self.server
+        server.csv_log.close()
+        server.persist_open_rollups()
+        server.DATA_DIR = data_dir
+        server.csv_log = server.WriteBehindLog(on_write=server.after_csv_write)
+        with server.dedup_lock:
+            server.recent_keys.clear()
+        server.load_indexes()
+
+    def request(self, method: str, path: str, **kwargs):
+        client = getattr(self.local, "client", None)
+        if client is None:
+            client = self.local.client = self.server.app.test_client()
+        response = client.open(path, method=method, **kwargs)
+        size = len(response.get_data())
+        response.close()
+        return response.status_code, size
+
+
+class HttpTarget:
+    """Drives a running server over HTTP with one keep-alive session per thread."""
+
+    def __init__(self, url: str):
+        import requests
+        self.requests = requests
+        self.url = url.rstrip("/")
+        self.local = threading.local()
+
+    def request(self, method: str, path: str, **kwargs):
+        session = getattr(self.local, "session", None)
+        if session is None:
+            session = self.local.session = self.requests.Session()
+        if "query_string" in kwargs:
+            kwargs["params"] = kwargs.pop("query_string")
+        response = session.request(method, self.url + path, timeout=60, **kwargs)
+        return response.status_code, len(response.content)
+
+
+# === Measurement ===
+
+def percentile(sorted_samples, p: float) -> float:
+    if not sorted_samples:
+        return float("nan")
+    k = (len(sorted_samples) - 1) * p / 100
+    lo, hi = math.floor(k), math.ceil(k)
+    return sorted_samples[lo] + (sorted_samples[hi] - sorted_samples[lo]) * (k - lo)
+
+
+def measure(make_request, count: int, concurrency: int = 1, rate: float = 0.0) -> dict:
+    """
+    Calls make_request() `count` times from `concurrency` threads, paced to
+    `rate` requests per second overall (0 = as fast as possible).
+    make_request returns (ok, response_bytes).
+    """
+    latencies, errors, sizes = [], [0], [0]
+    lock = threading.Lock()
+    interval = concurrency / rate if rate else 0.0
+
+    def worker(n):
+        next_at = time.perf_counter()
+        for _ in range(n):
+            if interval:
+                delay = next_at - time.perf_counter()
+                if delay > 0:
+                    time.sleep(delay)
+                next_at += interval
+            started = time.perf_counter()
+            try:
+                ok, size = make_request()
+            except Exception:
+                ok, size = False, 0
+            elapsed = time.perf_counter() - started
+            with lock:
+                latencies.append(elapsed)
+                errors[0] += not ok
+                sizes[0] += size
+
+    shares = [count // concurrency + (i < count % concurrency) for i in range(concurrency)]
+    threads = [threading.Thread(target=worker, args=(n,)) for n in shares if n]
+    started = time.perf_counter()
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    wall = time.perf_counter() - started
+
+    latencies.sort()
+    return {
+        "requests": len(latencies),
+        "errors": errors[0],
+        "seconds": round(wall, 4),
+        "throughput_rps": round(len(latencies) / wall, 2) if wall else None,
+        "p50_ms": round(percentile(latencies, 50) * 1000, 3),
+        "p99_ms": round(percentile(latencies, 99) * 1000, 3),
+        "mean_response_bytes": round(sizes[0] / len(latencies)) if latencies else 0,
+    }
+
+
+def benchmark_endpoints(target, stations, args) -> list:
+    """Measures every endpoint once against the data the target currently holds."""
+    def ok(status):
+        return 200 <= status < 300
+
+    # Payloads are generated up front so only the requests themselves are timed
+    submit_bodies = iter([fleet_payload(stations) for _ in range(args.requests)])
+    bulk_count = max(1, args.requests // 10)
+    bulk_bodies = []
+    for _ in range(bulk_count):
+        lines = []
+        for _ in range(args.bulk_size):
+            for device, reading in fleet_payload(stations).items():
+                lines.append(json.dumps(dict(reading, device=int(device))))
+        bulk_bodies.append("\n".join(lines))
+    bulk_bodies = iter(bulk_bodies)
+    lock = threading.Lock()
+
+    def submit():
+        with lock:
+            payload = next(submit_bodies)
+        status, size = target.request("POST", "/submit", json=payload)
+        return ok(status), size
+
+    def submit_bulk():
+        with lock:
+            body = next(bulk_bodies)
+        status, size = target.request(
+            "POST", "/submit_bulk", data=body,
+            headers={"Content-Type": "application/x-ndjson"}
+        )
+        return ok(status), size
+
+    # A one-hour window in the middle of the preloaded data
+    middle = START_TIME + args.rows_now // max(1, len(stations)) * READING_INTERVAL // 2
+    window = {"device": "0", "from": str(middle), "to": str(middle + 3600)}
+
+    def get(path, query=None):
+        def call():
+            status, size = target.request("GET", path, query_string=query or {})
+            return ok(status), size
+        return call
+
+    plan = [
+        ("/submit", submit, args.requests, args.rate),
+        ("/submit_bulk", submit_bulk, bulk_count, 0.0),
+        ("/latest", get("/latest"), args.requests, 0.0),
+        ("/history", get("/history", window), args.requests, 0.0),
+        ("/rollup", get("/rollup", {"device": "0", "resolution": "hour"}), args.requests, 0.0),
+        ("/get_logs", get("/get_logs", {"devices": "0", "level": "1"}), args.log_requests, 0.0),
+    ]
+    results = []
+    for endpoint, call, count, rate in plan:
+        result = measure(call, count, args.concurrency, rate)
+        result["endpoint"] = endpoint
+        results.append(result)
+        print(f"  {endpoint:<13} {result['throughput_rps']:>10} req/s  "
+              f"p50 {result['p50_ms']:>9} ms  p99 {result['p99_ms']:>9} ms  "
+              f"errors {result['errors']}", file=sys.stderr)
+    return results
+
+
+def run(args):
+    stations = make_fleet(args.stations, args.seed)
+    meta = {
+        "started": time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime()),
+        "target": args.url or "testclient",
+        "stations": args.stations,
+        "concurrency": args.concurrency,
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+    }
+    results = []
+
+    if args.url:
+        target = HttpTarget(args.url)
+        args.rows_now = 0
+        print(f"Benchmarking {args.url}", file=sys.stderr)
+        for result in benchmark_endpoints(target, stations, args):
+            result["rows"] = None
+            results.append(result)
+    else:
+        target = LocalTarget()
+        for rows in args.rows:
+            data_dir = tempfile.mkdtemp(prefix="climanet-bench-")
+            try:
+                fleet = make_fleet(args.stations, args.seed)
+                started = time.perf_counter()
+                preload(data_dir, fleet, rows)
+                load_started = time.perf_counter()
+                target.use_data_dir(data_dir)
+                load_seconds = time.perf_counter() - load_started
+                print(f"{rows} rows: preload {load_started - started:.1f}s, "
+                      f"index load {load_seconds:.1f}s", file=sys.stderr)
+
+                # Keep submitting after the preloaded history, in time order
+                for station, preloaded in zip(stations, fleet):
+                    station.ts = preloaded.ts
+                args.rows_now = rows
+                for result in benchmark_endpoints(target, stations, args):
+                    result["rows"] = rows
+                    result["index_load_seconds"] = round(load_seconds, 3)
+                    results.append(result)
+            finally:
+                target.server.csv_log.close()
+                target.server.persist_open_rollups()
+                shutil.rmtree(data_dir, ignore_errors=True)
+
+    report = json.dumps({"meta": meta, "results": results}, indent=2)
+    if args.out:
+        with open(args.out, "w") as f:
+            f.write(report + "\n")
+    else:
+        print(report)
+
+
+# === Multi-process stress test ===
+
+def stress_worker(data_dir: str, worker: int, devices: int, readings: int, seed: int, go):
+    """One server process submitting `readings` rows to each shared device, with small buffers."""
+    rng = random.Random(seed * 1000 + worker)
+    import Server
+    Server.MULTI_PROCESS = True
+    Server.WRITE_BUFFER_ROWS = rng.randint(1, 16)
+    Server.INDEX_STRIDE = rng.randint(1, 8)   # many index entries to check
+    Server.MAX_OPEN_FILES = rng.randint(1, devices)
+    Server.DATA_DIR = data_dir
+    Server.csv_log = Server.WriteBehindLog(on_write=Server.after_csv_write)
+    Server.load_indexes()
+
+    client = Server.app.test_client()
+    go.wait()   # every process starts writing at once
+    for i in range(readings):
+        payload = {}
+        for device_id in rng.sample(range(devices), rng.randint(1, devices)):
+            # altitude.temp mark each row with its writer and sequence number
+            payload[str(device_id)] = {
+                "time": time.strftime("%Y-%m-%d %H:%M:%S", time.gmtime(START_TIME + i)),
+                "long": 22.9, "lat": 40.6, "alt": worker, "temp": i,
+                "hum": 50, "uv": 0, "rain": 0,
+            }
+        response = client.post("/submit", json=payload)
+        if response.status_code != 200:
+            raise RuntimeError(f"/submit returned {response.status_code}")
+        if rng.random() < 0.01:
+            Server.csv_log.flush()
+    Server.csv_log.close()
+
+
+def check_stress_output(data_dir: str, devices: int) -> dict:
+    """Verifies every shared CSV and .idx file after a stress run; returns counts and problems."""
+    problems = []
+    rows = 0
+    for device_id in range(devices):
+        path = os.path.join(data_dir, f"{device_id}_data.csv")
+        if not os.path.isfile(path):
+            continue
+        with open(path, "rb") as f:
+            data = f.read()
+
+        line_starts = {}   # {offset: time value}
+        last_seq = {}      # {worker: last temp value}
+        seen = set()
+        offset = 0
+        for n, line in enumerate(data.split(b"\r\n")[:-1]):
+            fields = next(csv.reader([line.decode()]))
+            line_at, offset = offset, offset + len(line) + 2
+            if n == 0:
+                if fields[0] != "time":
+                    problems.append(f"device {device_id}: missing header")
+                continue
+            if len(fields) != 8 or fields[0] == "time":
+                problems.append(f"device {device_id}: bad line at {line_at}: {line[:60]!r}")
+                continue
+            worker, seq = fields[3], int(float(fields[4]))
+            if (worker, seq) in seen:
+                problems.append(f"device {device_id}: duplicate row {worker}/{seq}")
+            if seq <= last_seq.get(worker, -1):
+                problems.append(f"device {device_id}: worker {worker} out of order at {seq}")
+            seen.add((worker, seq))
+            last_seq[worker] = seq
+            line_starts[line_at] = fields[0]
+            rows += 1
+        if offset != len(data):
+            problems.append(f"device {device_id}: torn last line")
+
+        idx = os.path.join(data_dir, f"{device_id}_data.idx")
+        with open(idx) as f:
+            for entry in f:
+                ts, at = entry.strip().split(",")
+                expected = line_starts.get(int(at))
+                if expected is None or calendar.timegm(time.strptime(expected, "%Y-%m-%d %H:%M:%S")) != float(ts):
+                    problems.append(f"device {device_id}: index entry {entry.strip()} is off")
+    return {"rows": rows, "problems": problems}
+
+
+def stress(args):
+    data_dir = tempfile.mkdtemp(prefix="climanet-stress-")
+    try:
+        ctx = multiprocessing.get_context("spawn")
+        go = ctx.Barrier(args.processes + 1)
+        workers = [ctx.Process(target=stress_worker,
+                               args=(data_dir, n, args.devices, args.readings, args.seed, go))
+                   for n in range(args.processes)]
+        for worker in workers:
+            worker.start()
+        go.wait()
+        started = time.perf_counter()
+        for worker in workers:
+            worker.join()
+        seconds = time.perf_counter() - started
+
+        result = check_stress_output(data_dir, args.devices)
+        failed = [w.exitcode for w in workers if w.exitcode != 0]
+        if failed:
+            result["problems"].append(f"{len(failed)} worker(s) failed")
+        report = {
+            "processes": args.processes,
+            "devices": args.devices,
+            "readings_per_process": args.readings,
+            "rows": result["rows"],
+            "seconds": round(seconds, 2),
+            "rows_per_second": round(result["rows"] / seconds, 1),
+            "problems": result["problems"][:50],
+            "ok": not result["problems"],
+        }
+        print(json.dumps(report, indent=2))
+        if result["problems"]:
+            sys.exit(1)
+    finally:
+        shutil.rmtree(data_dir, ignore_errors=True)
+
+
+# === Rollups of out-of-order readings ===
+
+def rollup_scenarios(readings: int, rng: random.Random):
+    """
+    Yields (name, [[epoch time, ...] per /submit_bulk request]) orders to
+    feed one device: 300 live minutes then the 200 before them, a live
+    stream with late batches, and a fully shuffled history.
+    """
+    yield "backfill", [[START_TIME + 200 * 60 + m * 60] for m in range(300)] + [
+        [START_TIME + m * 60 for m in range(i, i + 10)] for i in range(0, 200, 10)]
+
+    times = [START_TIME + i * 37 for i in range(readings)]
+    batches, i = [], 0
+    while i < len(times):
+        size = rng.randint(1, 12)
+        batches.append(times[i:i + size])
+        i += size
+    for n in range(len(batches) // 20):   # some batches arrive late, some very late
+        j = rng.randrange(1, len(batches))
+        batches.insert(min(len(batches), j + rng.choice((1, 2, 50, 500))), batches.pop(j))
+    yield "late", batches
+
+    shuffled = times[:]
+    rng.shuffle(shuffled)
+    yield "shuffled", [shuffled[i:i + 25] for i in range(0, len(shuffled), 25)]
+
+
+def expected_rollups(times, value_of) -> dict:
+    """Brute-force {resolution: {bucket start: (min, max, count)}} of the temp field."""
+    import Server
+    expected = {}
+    for resolution, seconds in Server.ROLLUP_RESOLUTIONS.items():
+        buckets = expected[resolution] = {}
+        for ts in times:
+            start = ts // seconds * seconds
+            lo, hi, n = buckets.get(start, (math.inf, -math.inf, 0))
+            value = value_of(ts)
+            buckets[start] = (min(lo, value), max(hi, value), n + 1)
+    return expected
+
+
+def compare_rollups(client, device: str, expected: dict, rng: random.Random) -> list:
+    """Compares /rollup with `expected` over the whole range and random windows (which bisect)."""
+    problems = []
+    for resolution, buckets in expected.items():
+        starts = sorted(buckets)
+        windows = [(starts[0], starts[-1])] + [
+            tuple(sorted((rng.choice(starts), rng.choice(starts)))) for _ in range(5)]
+        for lo, hi in windows:
+            query = {"device": device, "resolution": resolution, "from": str(lo), "to": str(hi)}
+            body = client.get("/rollup", query_string=query).get_json()
+            got = {b["epoch"]: (b["temp"]["min"], b["temp"]["max"], b["temp"]["count"])
+                   for b in body["buckets"] if b["temp"]}
+            want = {start: stats for start, stats in buckets.items() if lo <= start <= hi}
+            if got != want:
+                missing = len(set(want) - set(got))
+                wrong = sum(1 for start in want if start in got and got[start] != want[start])
+                problems.append(f"{resolution} {lo}-{hi}: {len(got)} buckets, expected {len(want)} "
+                                f"({missing} missing, {wrong} wrong)")
+    return problems
+
+
+def rollups(args):
+    """Feeds readings to Server.app out of time order and checks /rollup against brute force."""
+    import Server
+    rng = random.Random(args.seed)
+    data_dir = tempfile.mkdtemp(prefix="climanet-rollups-")
+    results = []
+    try:
+        Server.DATA_DIR = data_dir
+        Server.ROLLUP_WRITE_RECORDS = args.write_records   # small, so most records go through the files
+        Server.load_indexes()
+        client = Server.app.test_client()
+        for n, (name, batches) in enumerate(rollup_scenarios(args.readings, rng)):
+            device = str(n)
+
+            def value_of(ts):
+                return float(ts % 1000)
+
+            started = time.perf_counter()
+            for batch in batches:
+                readings = [{"time": time.strftime("%Y-%m-%d %H:%M:%S", time.gmtime(ts)),
+                             "long": 22.9, "lat": 40.6, "alt": 10, "temp": value_of(ts),
+                             "hum": 50, "uv": 0, "rain": 0} for ts in batch]
+                response = client.post("/submit_bulk", json={device: readings})
+                if response.status_code != 200:
+                    raise RuntimeError(f"/submit_bulk returned {response.status_code}")
+            seconds = time.perf_counter() - started
+
+            expected = expected_rollups([ts for batch in batches for ts in batch], value_of)
+            problems = compare_rollups(client, device, expected, rng)
+            Server.persist_open_rollups()   # everything in the files now
+            problems += [f"persisted {p}" for p in compare_rollups(client, device, expected, rng)]
+            results.append({"scenario": name, "readings": sum(map(len, batches)),
+                            "seconds": round(seconds, 2), "problems": problems})
+    finally:
+        Server.persist_open_rollups()
+        Server.csv_log.close()
+        shutil.rmtree(data_dir, ignore_errors=True)
+
+    ok = not any(result["problems"] for result in results)
+    print(json.dumps({"results": results, "ok": ok}, indent=2))
+    if not ok:
+        sys.exit(1)
+
+
+# === Wire format comparison ===
+
+def decode_seconds(decode, body: bytes, repeat: int) -> float:
+    """Best of `repeat` timings of decode(body), which must consume the whole body."""
+    best = float("inf")
+    for _ in range(repeat):
+        started = time.perf_counter()
+        decode(body)
+        best = min(best, time.perf_counter() - started)
+    return best
+
+
+def wire(args):
+    stations = make_fleet(args.stations, args.seed)
+    payloads = [fleet_payload(stations) for _ in range(args.rounds)]
+    pairs = [(int(device), reading) for payload in payloads for device, reading in payload.items()]
+    count = len(pairs)
+
+    # One /submit per round, and the same readings as a single bulk upload
+    bodies = {
+        "json /submit": [json.dumps(payload).encode() for payload in payloads],
+        "binary /submit": [Wire_format.encode_readings((int(d), r) for d, r in payload.items())
+                           for payload in payloads],
+        "ndjson /submit_bulk": [b"\n".join(json.dumps(dict(r, device=d)).encode() for d, r in pairs)],
+        "binary /submit_bulk": [Wire_format.encode_readings(pairs)],
+    }
+
+    def decode_json(body):
+        json.loads(body)
+
+    def decode_ndjson(body):
+        for line in body.splitlines():
+            json.loads(line)
+
+    def decode_binary(body):
+        for _ in Wire_format.iter_decode(io.BytesIO(body)):
+            pass
+
+    decoders = {
+        "json /submit": decode_json,
+        "binary /submit": decode_binary,
+        "ndjson /submit_bulk": decode_ndjson,
+        "binary /submit_bulk": decode_binary,
+    }
+
+    results = []
+    for name, parts in bodies.items():
+        size = sum(len(body) for body in parts)
+        gzipped = sum(len(gzip.compress(body)) for body in parts)
+        seconds = sum(decode_seconds(decoders[name], body, args.repeat) for body in parts)
+        results.append({
+            "format": name,
+            "readings": count,
+            "bytes_per_reading": round(size / count, 1),
+            "gzip_bytes_per_reading": round(gzipped / count, 1),
+            "decode_us_per_reading": round(seconds / count * 1e6, 3),
+        })
+        print(f"  {name:<20} {size / count:>7.1f} B/reading  gzip {gzipped / count:>6.1f}  "
+              f"decode {seconds / count * 1e6:>7.3f} us/reading", file=sys.stderr)
+
+    # End to end through Server.app: the same /submit requests in each encoding
+    target = LocalTarget()
+    for name, content_type in (("json /submit", "application/json"),
+                               ("binary /submit", Wire_format.CONTENT_TYPE)):
+        data_dir = tempfile.mkdtemp(prefix="climanet-wire-")
+        try:
+            target.use_data_dir(data_dir)
+            parts = iter(bodies[name])
+
+            def submit():
+                status, size = target.request("POST", "/submit", data=next(parts),
+                                              headers={"Content-Type": content_type})
+                return 200 <= status < 300, size
+
+            timing = measure(submit, args.rounds)
+            result = next(r for r in results if r["format"] == name)
+            result["submit_rps"] = timing["throughput_rps"]
+            result["submit_p50_ms"] = timing["p50_ms"]
+            result["submit_errors"] = timing["errors"]
+        finally:
+            target.server.csv_log.close()
+            target.server.persist_open_rollups()
+            shutil.rmtree(data_dir, ignore_errors=True)
+
+    print(json.dumps({"stations": args.stations, "rounds": args.rounds, "results": results}, indent=2))
+
+
+# === Serial parser ===
+
+def corpus_entries(count: int, seed: int = 1):
+    """
+    Receiver.ino lines from a virtual fleet, plus damaged copies as a flaky
+    RF link or serial port delivers them. Each entry carries the expected
+    result: the reading, an error reason, or None for "anything but a crash".
+    """
+    rng = random.Random(seed)
+    stations = make_fleet(8, seed)
+    yield {"line": "RF22 Receiver initialized", "expect": "not_a_reading"}
+    yield {"line": "RF22 init failed", "expect": "not_a_reading"}
+    yield {"line": "", "expect": "not_a_reading"}
+
+    for _ in range(count):
+        station = rng.choice(stations)
+        r = station.reading()
+        kind = rng.choices(["clean", "no_fix", "reordered", "noise", "truncated", "dropped",
+                            "bad_value", "duplicate", "joined", "flipped"],
+                           weights=[40, 5, 8, 7, 8, 6, 6, 4, 8, 8])[0]
+        if kind == "no_fix":
+            r.update(time="Unknown", long=0.0, lat=0.0, alt=0.0)
+        line = format_serial_line(station.device_id, r)
+        tokens = line.split(",")
+        expected = dict(r, device=station.device_id)
+
+        if kind == "reordered":
+            body = tokens[:-1]
+            rng.shuffle(body)
+            line = ",".join(body + ["end"])
+        elif kind == "noise":
+            line = "".join(rng.choice("\x00\x7f#~?;:") for _ in range(rng.randint(1, 6))) + line
+        elif kind == "truncated":
+            line = line[:rng.randint(1, len(line) - 4)]
+            expected = "truncated" if "," in line else "not_a_reading"
+        elif kind == "dropped":
+            del tokens[rng.randrange(len(tokens) - 1)]
+            line, expected = ",".join(tokens), "missing_field"
+        elif kind == "bad_value":
+            i = rng.randrange(2, len(tokens) - 1)
+            tokens[i] = tokens[i].partition("=")[0] + "=" + rng.choice(["nan", "inf", "ovf", "", "-"])
+            line, expected = ",".join(tokens), "bad_value"
+        elif kind == "duplicate":
+            i = rng.randrange(len(tokens) - 1)
+            tokens.insert(i, tokens[i])
+            line, expected = ",".join(tokens), "duplicate_field"
+        elif kind == "joined":   # a lost newline glues two lines together
+            other = rng.choice(stations)
+            line = line[:rng.randint(1, len(line) - 4)] + other.serial_line()
+            expected = None
+        elif kind == "flipped":
+            chars = list(line)
+            for _ in range(rng.randint(1, 3)):
+                chars[rng.randrange(len(chars))] = chr(rng.randint(32, 126))
+            line, expected = "".join(chars), None
+        yield {"line": line, "expect": expected}
+
+
+def check_parser(entries) -> list:
+    """Returns a description of every corpus entry tokenize_serial_line gets wrong."""
+    problems = []
+    for n, entry in enumerate(entries, 1):
+        try:
+            reading, error = tokenize_serial_line(entry["line"])
+        except Exception as e:
+            problems.append(f"entry {n}: raised {e!r}")
+            continue
+        expect = entry["expect"]
+        if isinstance(expect, dict) and reading != expect:
+            problems.append(f"entry {n}: expected a reading, got {reading or error}")
+        elif isinstance(expect, str) and (error is None or error[0] != expect):
+            problems.append(f"entry {n}: expected {expect}, got {reading or error}")
+    return problems
+
+
+def serial_parser(args):
+    if args.generate or not os.path.exists(args.corpus):
+        with open(args.corpus, "w") as f:
+            for entry in corpus_entries(args.generate or 2000, args.seed):
+                f.write(json.dumps(entry) + "\n")
+    with open(args.corpus) as f:
+        entries = [json.loads(line) for line in f]
+
+    problems = check_parser(entries)
+    reasons = {}
+    for entry in entries:
+        error = tokenize_serial_line(entry["line"])[1]
+        reasons[error[0] if error else "ok"] = reasons.get(error[0] if error else "ok", 0) + 1
+
+    def lines_per_second(lines, repeat):
+        started = time.perf_counter()
+        for _ in range(repeat):
+            for line in lines:
+                tokenize_serial_line(line)
+        return round(len(lines) * repeat / (time.perf_counter() - started))
+
+    report = {
+        "corpus": args.corpus,
+        "lines": len(entries),
+        "results": reasons,
+        "problems": problems[:50],
+        "ok": not problems,
+        "corpus_lines_per_second": lines_per_second([e["line"] for e in entries], args.repeat),
+    }
+    if args.capture:
+        with open(args.capture, encoding="utf-8", errors="ignore") as f:
+            lines = f.read().splitlines()
+        report["capture_lines"] = len(lines)
+        report["capture_lines_per_second"] = lines_per_second(lines, 1)
+    print(json.dumps(report, indent=2))
+    if problems:
+        sys.exit(1)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Climanet fleet simulator and benchmarks")
+    sub = parser.add_subparsers(dest="command", required=True)
+
+    p = sub.add_parser("run", help="benchmark the server endpoints")
+    p.add_argument("--url", help="benchmark a running server instead of Server.app in-process")
+    p.add_argument("--stations", type=int, default=20, help="virtual stations in the fleet")
+    p.add_argument("--rows", type=lambda v: [int(x) for x in v.split(",")], default=[1000, 100000],
+                   help="comma separated data sizes to preload (in-process only)")
+    p.add_argument("--requests", type=int, default=200, help="requests per endpoint")
+    p.add_argument("--log-requests", type=int, default=5, help="requests for /get_logs")
+    p.add_argument("--bulk-size", type=int, default=12, help="readings per station per bulk upload")
+    p.add_argument("--concurrency", type=int, default=4, help="client threads")
+    p.add_argument("--rate", type=float, default=0.0, help="target /submit requests per second (0 = max)")
+    p.add_argument("--seed", type=int, default=1)
+    p.add_argument("--out", help="write the JSON report here instead of stdout")
+    p.set_defaults(func=run)
+
+    p = sub.add_parser("stress", help="check row integrity with several server processes appending")
+    p.add_argument("--processes", type=int, default=8, help="server processes sharing one DATA_DIR")
+    p.add_argument("--devices", type=int, default=4, help="devices every process writes to")
+    p.add_argument("--readings", type=int, default=2000, help="/submit requests per process")
+    p.add_argument("--seed", type=int, default=1)
+    p.set_defaults(func=stress)
+
+    p = sub.add_parser("rollups", help="check /rollup against brute force for out-of-order readings")
+    p.add_argument("--readings", type=int, default=3000, help="readings per scenario")
+    p.add_argument("--write-records", type=int, default=8, help="Server.ROLLUP_WRITE_RECORDS to run with")
+    p.add_argument("--seed", type=int, default=1)
+    p.set_defaults(func=rollups)
+
+    p = sub.add_parser("wire", help="compare the JSON and binary upload formats")
+    p.add_argument("--stations", type=int, default=20, help="virtual stations in the fleet")
+    p.add_argument("--rounds", type=int, default=200, help="/submit requests, one reading per station each")
+    p.add_argument("--repeat", type=int, default=5, help="decode timings to take the best of")
+    p.add_argument("--seed", type=int, default=1)
+    p.set_defaults(func=wire)
+
+    p = sub.add_parser("parser", help="check and time the serial line parser on a corpus")
+    p.add_argument("--corpus", default=CORPUS_PATH, help="JSON lines of {line, expect}")
+    p.add_argument("--generate", type=int, default=0, help="rewrite the corpus with this many lines first")
+    p.add_argument("--repeat", type=int, default=20, help="passes over the corpus to time")
+    p.add_argument("--capture", help="also time a raw serial capture file")
+    p.add_argument("--seed", type=int, default=1)
+    p.set_defaults(func=serial_parser)
+
+    args = parser.parse_args(argv)
+    args.func(args)
+
+
+if __name__ == "__main__":
+    main()
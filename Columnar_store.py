@@ -0,0 +1,407 @@
+"""
+Columnar binary storage for Climanet readings, kept alongside the per-device CSVs.
+
+Each device gets a directory with one fixed-width file per column:
+
+    <root>/<device_id>/time.bin   int64   epoch seconds (UTC)
+                       long.bin   float64
+                       lat.bin    float64
+                       alt.bin    float32
+                       temp.bin   float32
+                       hum.bin    float32
+                       uv.bin     float32
+                       rain.bin   uint8
+                       flags.bin  uint8   how the CSV wrote each row (see row_flags)
+
+Readers memory-map the files with NumPy, so a time range is a pair of
+`searchsorted` calls and every column comes back as a zero-copy slice.
+Rows are kept in time order: each batch is sorted (stably, so equal times
+keep their CSV order) before it is appended, a batch that starts before
+the rows already stored drops the device's `complete` marker, and `convert`
+sorts a device's whole history once it is loaded. Rows whose time cannot be
+parsed (e.g. "Unknown" before the GPS has a fix) are not stored here.
+Appends hold a flock on <root>/<device_id>/.lock, so several server
+processes can share the store.
+
+A device's columns only hold its whole history once `convert` has run
+for it, which leaves a `complete` marker in its directory; until then the
+server keeps answering from the CSVs. Run `convert` with the server stopped.
+
+Usage:
+    python Columnar_store.py convert <data_dir>                 # build from existing CSVs and segments
+    python Columnar_store.py export <data_dir> <device_id> <out.csv>
+"""
+import csv
+import gzip
+import json
+import os
+import shutil
+import sys
+import threading
+import time
+
+import numpy as np
+
+from Timestamps import RECEIVER_TIME_FORMAT
+
+try:
+    import fcntl
+except ImportError:   # Windows: single server process only
+    fcntl = None
+
+# Column name -> on-disk dtype, in CSV row order
+COLUMNS = {
+    "time": np.dtype("<i8"),
+    "long": np.dtype("<f8"),   # float32 cannot hold six decimals of a coordinate
+    "lat":  np.dtype("<f8"),
+    "alt":  np.dtype("<f4"),
+    "temp": np.dtype("<f4"),
+    "hum":  np.dtype("<f4"),
+    "uv":   np.dtype("<f4"),
+    "rain": np.dtype("u1"),
+}
+
+# CSV header for each column, and the decimals Receiver.ino prints them with
+CSV_NAMES = {
+    "time": "time", "long": "longitude", "lat": "latitude", "alt": "altitude",
+    "temp": "temp", "hum": "hum", "uv": "uv", "rain": "rain",
+}
+DECIMALS = {"long": 6, "lat": 6, "alt": 2, "temp": 2, "hum": 2, "uv": 2}
+
+# flags.bin bits: which numeric columns the CSV wrote without a decimal point,
+# and which form the time was in, so rows render exactly as the CSV has them
+INTEGER_FLAGS = {name: 1 << n for n, name in enumerate(DECIMALS)}
+RECEIVER_TIME_FLAG = 1 << 6
+EPOCH_TIME_FLAG = 1 << 7
+FLAGS_DTYPE = np.dtype("u1")
+
+BUFFER_ROWS    = 256   # rows buffered per device before they are written
+BUFFER_SECONDS = 1.0   # ... or once the oldest buffered row is this old
+
+
+class ColumnarStore:
+    """Append-only, per-device columnar store under `root`."""
+
+    def __init__(self, root: str, parse_time):
+        self.root = root
+        self.parse_time = parse_time    # time string -> epoch seconds or None
+        self.lock = threading.RLock()
+        self.buffers = {}               # {device_id: [row, ...]}
+        self.buffered_since = {}        # {device_id: monotonic time of oldest buffered row}
+        self.checked = set()            # devices whose column lengths were reconciled
+        self.flusher = None
+
+    def device_dir(self, device_id) -> str:
+        return os.path.join(self.root, str(device_id))
+
+    def devices(self):
+        """Returns the IDs of every device that has columnar data."""
+        if not os.path.isdir(self.root):
+            return []
+        return sorted(name for name in os.listdir(self.root)
+                      if os.path.isfile(os.path.join(self.root, name, "time.bin")))
+
+    def is_complete(self, device_id) -> bool:
+        """True once `convert` has loaded the device's whole history."""
+        return os.path.isfile(os.path.join(self.device_dir(device_id), "complete"))
+
+    def mark_complete(self, device_id):
+        with open(os.path.join(self.device_dir(device_id), "complete"), "w"):
+            pass
+
+    def mark_incomplete(self, device_id):
+        """Drops the `complete` marker, e.g. once rows were merged into the CSV history out of order."""
+        try:
+            os.remove(os.path.join(self.device_dir(device_id), "complete"))
+        except FileNotFoundError:
+            pass
+
+    def discard(self, device_id):
+        """Drops whatever a device has stored, ahead of a full conversion."""
+        with self.lock:
+            self.buffers.pop(str(device_id), None)
+            self.buffered_since.pop(str(device_id), None)
+            self.checked.discard(str(device_id))
+            shutil.rmtree(self.device_dir(device_id), ignore_errors=True)
+
+    # --- Writing ---
+
+    def append(self, device_id, rows):
+        """Buffers CSV-ordered rows [time, long, lat, alt, temp, hum, uv, rain]."""
+        key = str(device_id)
+        with self.lock:
+            buf = self.buffers.setdefault(key, [])
+            if not buf:
+                self.buffered_since[key] = time.monotonic()
+            buf.extend(rows)
+            if len(buf) >= BUFFER_ROWS:
+                self._flush(key)
+
+        if self.flusher is None:
+            self._start_flusher()
+
+    def flush(self, device_id=None):
+        with self.lock:
+            keys = list(self.buffers) if device_id is None else [str(device_id)]
+            for key in keys:
+                self._flush(key)
+
+    def _flush(self, key):
+        rows = self.buffers.pop(key, None)
+        self.buffered_since.pop(key, None)
+        if rows:
+            self.write_rows(key, rows)
+
+    def write_rows(self, device_id, rows) -> int:
+        """Converts rows to column arrays and appends them in time order; returns how many were stored."""
+        key = str(device_id)
+        times = [self.parse_time(row[0]) for row in rows]
+        keep = [i for i, ts in enumerate(times) if ts is not None]
+        if not keep:
+            return 0
+
+        columns = {"time": np.array([int(times[i]) for i in keep], dtype=COLUMNS["time"])}
+        for pos, name in enumerate(list(COLUMNS)[1:], start=1):
+            values = np.array([to_float(rows[i][pos]) for i in keep])
+            if name == "rain":
+                values = np.nan_to_num(values)
+            columns[name] = values.astype(COLUMNS[name])
+        columns["flags"] = np.array([row_flags(rows[i]) for i in keep], dtype=FLAGS_DTYPE)
+        order = np.argsort(columns["time"], kind="stable")
+        columns = {name: array[order] for name, array in columns.items()}
+
+        with self.lock:
+            os.makedirs(self.device_dir(key), exist_ok=True)
+            with open(os.path.join(self.device_dir(key), ".lock"), "a") as lock_file:
+                if fcntl is not None:
+                    fcntl.flock(lock_file.fileno(), fcntl.LOCK_EX)   # released on close
+                self._reconcile(key)
+                if self._last_time(key) > columns["time"][0]:
+                    self.mark_incomplete(key)   # readers bisect the time column
+                for name, array in columns.items():
+                    with open(os.path.join(self.device_dir(key), f"{name}.bin"), "ab") as f:
+                        f.write(array.tobytes())
+        return len(keep)
+
+    def _reconcile(self, key):
+        """Truncates every column to the shortest one, undoing a partially written batch."""
+        if key in self.checked:
+            return
+        count = self._row_count(key)
+        for name, dtype in stored_columns():
+            path = os.path.join(self.device_dir(key), f"{name}.bin")
+            if os.path.isfile(path) and os.path.getsize(path) != count * dtype.itemsize:
+                os.truncate(path, count * dtype.itemsize)
+        self.checked.add(key)
+
+    def _last_time(self, key) -> int:
+        """The time of a device's last stored row (the minimum int64 if it has none)."""
+        count = self._row_count(key)
+        if count == 0:
+            return np.iinfo(COLUMNS["time"]).min
+        with open(os.path.join(self.device_dir(key), "time.bin"), "rb") as f:
+            f.seek((count - 1) * COLUMNS["time"].itemsize)
+            return int(np.frombuffer(f.read(COLUMNS["time"].itemsize), dtype=COLUMNS["time"])[0])
+
+    def sort_by_time(self, device_id):
+        """Rewrites a device's columns in time order (stably) if they are not; used by `convert`."""
+        key = str(device_id)
+        with self.lock:
+            cols = self.columns(key)
+            times = cols["time"]
+            if np.all(times[:-1] <= times[1:]):
+                return
+            order = np.argsort(times, kind="stable")
+            for name, array in cols.items():
+                path = os.path.join(self.device_dir(key), f"{name}.bin")
+                with open(path + ".tmp", "wb") as f:
+                    f.write(np.ascontiguousarray(array[order]).tobytes())
+                os.replace(path + ".tmp", path)
+
+    def _row_count(self, key) -> int:
+        counts = []
+        for name, dtype in stored_columns():
+            path = os.path.join(self.device_dir(key), f"{name}.bin")
+            counts.append(os.path.getsize(path) // dtype.itemsize if os.path.isfile(path) else 0)
+        return min(counts)
+
+    def _start_flusher(self):
+        with self.lock:
+            if self.flusher is not None:
+                return
+            self.flusher = threading.Thread(target=self._flush_loop, daemon=True)
+            self.flusher.start()
+
+    def _flush_loop(self):
+        while True:
+            time.sleep(BUFFER_SECONDS / 2)
+            try:
+                with self.lock:
+                    now = time.monotonic()
+                    for key, since in list(self.buffered_since.items()):
+                        if now - since >= BUFFER_SECONDS:
+                            self._flush(key)
+            except Exception as e:
+                print(f"Columnar flush failed: {e}")
+
+    # --- Reading ---
+
+    def columns(self, device_id):
+        """Returns {column: read-only memmap} over every stored row of a device."""
+        key = str(device_id)
+        self.flush(key)
+        count = self._row_count(key)
+        result = {}
+        for name, dtype in stored_columns():
+            if count == 0:
+                result[name] = np.empty(0, dtype=dtype)
+            else:
+                path = os.path.join(self.device_dir(key), f"{name}.bin")
+                result[name] = np.memmap(path, dtype=dtype, mode="r", shape=(count,))
+        return result
+
+    def read(self, device_id, start=None, end=None):
+        """
+        Returns {column: array} for the rows with start <= time <= end
+        (epoch seconds, None = unbounded). The arrays are slices of the
+        memory-mapped files; nothing is copied or parsed.
+        """
+        cols = self.columns(device_id)
+        times = cols["time"]
+        lo = 0 if start is None else int(np.searchsorted(times, start, side="left"))
+        hi = len(times) if end is None else int(np.searchsorted(times, end, side="right"))
+        return {name: array[lo:hi] for name, array in cols.items()}
+
+    def iter_csv_rows(self, device_id, start=None, end=None, chunk_rows=65536):
+        """Yields rows as CSV-header -> string dicts, exactly as the CSV readers in Server.py do."""
+        cols = self.read(device_id, start, end)
+        for lo in range(0, len(cols["time"]), chunk_rows):
+            chunk = {name: array[lo:lo + chunk_rows] for name, array in cols.items()}
+            rendered = {name: format_column(name, chunk[name], chunk["flags"]) for name in COLUMNS}
+            for i in range(len(chunk["time"])):
+                yield {CSV_NAMES[name]: rendered[name][i] for name in COLUMNS}
+
+
+def to_float(value) -> float:
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        return np.nan
+
+
+def stored_columns():
+    """(name, dtype) of every file a device has: the CSV columns plus flags."""
+    return list(COLUMNS.items()) + [("flags", FLAGS_DTYPE)]
+
+
+def row_flags(row) -> int:
+    """The flags.bin byte for a CSV-ordered row, from the text the CSV holds for it."""
+    flags = 0
+    text = str(row[0]).strip()
+    if text[2:3] == "-":
+        flags |= RECEIVER_TIME_FLAG
+    elif text[4:5] != "-":
+        flags |= EPOCH_TIME_FLAG
+    for pos, name in enumerate(DECIMALS, start=1):
+        value = "" if row[pos] is None else str(row[pos])
+        if value and "." not in value and "e" not in value and "n" not in value:
+            flags |= INTEGER_FLAGS[name]
+    return flags
+
+
+def format_column(name, array, flags):
+    """Renders one column as the strings the CSV has for it."""
+    if name == "time":
+        return [str(int(v)) if f & EPOCH_TIME_FLAG else
+                time.strftime(RECEIVER_TIME_FORMAT if f & RECEIVER_TIME_FLAG else "%Y-%m-%d %H:%M:%S",
+                              time.gmtime(int(v)))
+                for v, f in zip(array, flags)]
+    if name == "rain":
+        return [str(int(v)) for v in array]
+    bit = INTEGER_FLAGS[name]
+    return ["" if np.isnan(v) else str(int(round(float(v)))) if f & bit
+            else repr(round(float(v), DECIMALS[name])) for v, f in zip(array, flags)]
+
+
+def history_files(data_dir: str, device_id):
+    """Opens a device's closed segments (in manifest order), then its live CSV, as text."""
+    directory = os.path.join(data_dir, "segments", str(device_id))
+    try:
+        with open(os.path.join(directory, "manifest.json")) as f:
+            entries = json.load(f)["segments"]
+    except FileNotFoundError:
+        entries = []
+    for entry in entries:
+        path = os.path.join(directory, entry["file"])
+        if path.endswith(".gz"):
+            yield gzip.open(path, "rt", newline="")
+        else:
+            yield open(path, newline="")
+    csv_path = os.path.join(data_dir, f"{device_id}_data.csv")
+    if os.path.isfile(csv_path):
+        yield open(csv_path, newline="")
+
+
+def convert_csv(files, store: ColumnarStore, device_id, batch_rows: int = 65536) -> int:
+    """Appends every row of the given CSV files to the store; returns the rows stored."""
+    total = 0
+    batch = []
+    for f in files:
+        with f:
+            reader = csv.reader(f)
+            next(reader, None)   # header
+            for row in reader:
+                if len(row) != len(COLUMNS):
+                    continue
+                batch.append(row)
+                if len(batch) >= batch_rows:
+                    total += store.write_rows(device_id, batch)
+                    batch = []
+    if batch:
+        total += store.write_rows(device_id, batch)
+    return total
+
+
+def export_csv(store: ColumnarStore, device_id, out_path: str, start=None, end=None) -> int:
+    """Writes a device's columnar data back out in the <device_id>_data.csv layout."""
+    count = 0
+    with open(out_path, "w", newline="") as f:
+        writer = csv.writer(f)
+        writer.writerow(list(CSV_NAMES.values()))
+        for row in store.iter_csv_rows(device_id, start, end):
+            writer.writerow(row.values())
+            count += 1
+    return count
+
+
+if __name__ == "__main__":
+    from Timestamps import parse_time
+
+    if len(sys.argv) >= 3 and sys.argv[1] == "convert":
+        data_dir = sys.argv[2]
+        store = ColumnarStore(os.path.join(data_dir, "columnar"), parse_time)
+        device_ids = {name.replace("_data.csv", "") for name in os.listdir(data_dir)
+                      if name.endswith("_data.csv")}
+        segments = os.path.join(data_dir, "segments")
+        if os.path.isdir(segments):
+            device_ids.update(os.listdir(segments))
+        for device_id in sorted(device_ids):
+            if store.is_complete(device_id):
+                print(f"Device {device_id}: already converted, skipped")
+                continue
+            started = time.perf_counter()
+            store.discard(device_id)   # rows the server appended before the conversion
+            rows = convert_csv(history_files(data_dir, device_id), store, device_id)
+            os.makedirs(store.device_dir(device_id), exist_ok=True)
+            store.sort_by_time(device_id)
+            store.mark_complete(device_id)
+            print(f"Device {device_id}: {rows} rows in {time.perf_counter() - started:.1f}s")
+
+    elif len(sys.argv) == 5 and sys.argv[1] == "export":
+        data_dir, device_id, out_path = sys.argv[2:]
+        store = ColumnarStore(os.path.join(data_dir, "columnar"), parse_time)
+        print(f"Exported {export_csv(store, device_id, out_path)} rows to {out_path}")
+
+    else:
+        print(__doc__)
+        sys.exit(1)
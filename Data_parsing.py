@@ -1,89 +1,539 @@
-import serial
+"""
+Reads Climanet receivers on the serial ports of a Raspberry Pi and uploads
+their readings to the server, through a local spool that survives outages.
+
+Usage:
+    python Data_parsing.py                                   # live, from SERIAL_PORTS
+    python Data_parsing.py replay <capture file or dir>      # backfill captures to the server
+    python Data_parsing.py replay <capture file or dir> <csv_dir>   # ... or into server CSVs
+
+The server merges uploaded readings older than what it already has for a
+device into that device's history in time order, so captures can be
+replayed in any order; replaying into a stopped server's CSVs does the same
+merge offline.
+"""
 import csv
+import gzip
+import json
+import os
+import queue
+import random
 import requests
+import sqlite3
+import sys
+import threading
 import time
+import uuid
+
+from Timestamps import parse_time
+from Wire_format import CONTENT_TYPE, encode_readings
 
 # === Configuration ===
 UPLOAD_INTERVAL       = 5                   # seconds between uploads
-EXPECTED_DEVICE_COUNT = 1                   # number of devices expected per batch
-SERIAL_PORT           = 'COM8'
+SERIAL_PORTS          = ['COM8']            # one per receiver attached to this Pi
 BAUD_RATE             = 9600
-SERVER_URL            = "https://kargalex.eu.pythonanywhere.com/submit"
+RECONNECT_SECONDS     = 5                   # wait before reopening a port that failed
+SERVER_URL            = "https://kargalex.eu.pythonanywhere.com/submit_bulk"
+WIRE_FORMAT           = True                # send the compact binary layout while the server accepts it
+SPOOL_PATH            = "spool.db"          # readings wait here until the server has them
+SPOOL_BATCH           = 1000                # readings per upload; a full batch is sent right away
+REQUEST_TIMEOUT       = 30                  # seconds
+BACKOFF_MIN_SECONDS   = 1                   # first retry delay after a failed upload, doubled up to
+BACKOFF_MAX_SECONDS   = 300                 # ... this
+REPLAY_SPOOL_PATH     = "replay_spool.db"   # captures being backfilled, kept apart from live readings
+REPLAY_BATCH          = 20000               # readings per upload when backfilling
 
-# === Serial Init ===
-arduino_serial = serial.Serial(SERIAL_PORT, BAUD_RATE)
+# Column order of the server's <device_id>_data.csv files
+CSV_HEADERS = ["time", "longitude", "latitude", "altitude", "temp", "hum", "uv", "rain"]
 
 # === Field Identifiers in Serial Data ===
+# Key printed by Receiver.ino's printAllValues() -> (reading key, converter)
 fields = {
-    "device":      "Dev=",
-    "time":        ",Time=",
-    "longitude":   ",Lon=",
-    "latitude":    ",Lat=",
-    "altitude":    ",Alt=",
-    "temperature": ",Temp=",
-    "humidity":    ",Hum=",
-    "UV":          ",UV=",
-    "rain":        ",Rain=",
-    "end":         ",end"
+    "Dev":  ("device", int),
+    "Time": ("time",   str.strip),
+    "Lon":  ("long",   float),
+    "Lat":  ("lat",    float),
+    "Alt":  ("alt",    float),
+    "Temp": ("temp",   float),
+    "Hum":  ("hum",    float),
+    "UV":   ("uv",     float),
+    "Rain": ("rain",   int),
 }
+END_MARKER = "end"
+FLOAT_FIELDS = [name for name, convert in fields.values() if convert is float]
+
+def tokenize_serial_line(line):
+    """
+    Parses one serial line in a single pass over its comma separated
+    key=value tokens, which may come in any order. Returns (reading, None),
+    or (None, (reason, detail)) where reason is one of not_a_reading,
+    truncated, malformed_token, unknown_field, duplicate_field, bad_value
+    and missing_field.
+    """
+    start = line.find("Dev=")
+    if start > 0 and "," not in line[:start]:
+        line = line[start:]   # RF noise before the first field
+    tokens = line.strip().split(",")
+    if len(tokens) < 2:
+        return None, ("not_a_reading", line[:40])
+    if tokens[-1].strip() != END_MARKER:
+        return None, ("truncated", tokens[-1][:40])
+
+    reading = {}
+    lookup = fields.get
+    for token in tokens[:-1]:
+        key, sep, value = token.partition("=")
+        if not sep:
+            return None, ("malformed_token", token[:40])
+        field = lookup(key)
+        if field is None:
+            return None, ("unknown_field", key[:40])
+        name, convert = field
+        if name in reading:
+            return None, ("duplicate_field", key)
+        try:
+            reading[name] = convert(value)
+        except ValueError:
+            return None, ("bad_value", f"{key}={value[:40]}")
+
+    if len(reading) < len(fields):
+        missing = [key for key, (name, _) in fields.items() if name not in reading]
+        return None, ("missing_field", ",".join(missing))
+    for name in FLOAT_FIELDS:
+        value = reading[name]
+        if value - value:   # nan or inf, which Arduino prints for a failed sensor
+            return None, ("bad_value", f"{name}={value}")
+    return reading, None
 
 def parse_serial_line(line):
-    """Extracts all fields from one well-formed serial line or returns None."""
-    try:
-        d, t  = line.find(fields["device"]),     line.find(fields["time"])
-        lo, la = line.find(fields["longitude"]), line.find(fields["latitude"])
-        al, tp = line.find(fields["altitude"]),  line.find(fields["temperature"])
-        hu, uv = line.find(fields["humidity"]),  line.find(fields["UV"])
-        ra, en = line.find(fields["rain"]),      line.find(fields["end"])
-
-        if d == -1 or en == -1:
-            return None
-
-        return {
-            "device": int( line[d + len(fields["device"]): t].strip() ),
-            "time":   line[t + len(fields["time"]):      lo].strip(),
-            "long":   float( line[lo + len(fields["longitude"]): la] ),
-            "lat":    float( line[la + len(fields["latitude"]):  al] ),
-            "alt":    float( line[al + len(fields["altitude"]):  tp] ),
-            "temp":   float( line[tp + len(fields["temperature"]): hu] ),
-            "hum":    float( line[hu + len(fields["humidity"]):   uv] ),
-            "uv":     float( line[uv + len(fields["UV"]):         ra] ),
-            "rain":   int(   line[ra + len(fields["rain"]):       en] )
-        }
-    except Exception:
-        print("Failed to parse:", line)
-        return None
+    """Returns the reading in one well-formed serial line, or None."""
+    return tokenize_serial_line(line)[0]
 
-# === Main Loop ===
-while True:
-    device_data = {}
-
-    # 1) Read exactly EXPECTED_DEVICE_COUNT valid lines
-    for _ in range(EXPECTED_DEVICE_COUNT):
-        while not arduino_serial.inWaiting():
-            pass
-
-        raw = arduino_serial.readline().decode(errors='ignore').strip()
-        parsed = parse_serial_line(raw)
-        if not parsed:
-            print("Skipped malformed:", raw)
-            continue
+# === Spool ===
+class Spool:
+    """
+    Durable FIFO of parsed readings in SQLite. Every reading is stored here
+    before it is uploaded and removed only once the server has accepted it,
+    so readings survive server outages, network loss and restarts.
+    """
+
+    def __init__(self, path):
+        self.db = sqlite3.connect(path, check_same_thread=False)
+        self.lock = threading.Lock()
+        self.added = threading.Condition(self.lock)
+        with self.lock, self.db:
+            self.db.execute("PRAGMA journal_mode=WAL")
+            self.db.execute("CREATE TABLE IF NOT EXISTS readings "
+                            "(id INTEGER PRIMARY KEY AUTOINCREMENT, device INTEGER, reading TEXT)")
+            self.db.execute("CREATE TABLE IF NOT EXISTS rejected "
+                            "(id INTEGER PRIMARY KEY, device INTEGER, reading TEXT, reason TEXT)")
+            self.db.execute("CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT)")
+            self.db.execute("INSERT OR IGNORE INTO meta VALUES ('spool_id', ?)", (uuid.uuid4().hex,))
+            self.spool_id = self.db.execute("SELECT value FROM meta WHERE key = 'spool_id'").fetchone()[0]
+            self.waiting = self.db.execute("SELECT COUNT(*) FROM readings").fetchone()[0]
+
+    def add(self, parsed):
+        reading = {k: v for k, v in parsed.items() if k != "device"}
+        with self.lock:
+            with self.db:
+                self.db.execute("INSERT INTO readings (device, reading) VALUES (?, ?)",
+                                (parsed["device"], json.dumps(reading)))
+            self.waiting += 1
+            self.added.notify()
+
+    def add_many(self, parsed_readings, mark=None):
+        """
+        Adds readings in one transaction, recording `mark` in the same
+        transaction if given; returns how many were added.
+        """
+        rows = ((parsed["device"], json.dumps({k: v for k, v in parsed.items() if k != "device"}))
+                for parsed in parsed_readings)
+        with self.lock:
+            with self.db:
+                added = self.db.executemany("INSERT INTO readings (device, reading) VALUES (?, ?)",
+                                            rows).rowcount
+                if mark is not None:
+                    self.db.execute("INSERT OR REPLACE INTO meta VALUES (?, '')", (mark,))
+            self.waiting += added
+            self.added.notify()
+        return added
+
+    def is_marked(self, mark):
+        with self.lock:
+            return self.db.execute("SELECT 1 FROM meta WHERE key = ?", (mark,)).fetchone() is not None
 
-        dev_id = parsed["device"]
-        payload = {k: v for k, v in parsed.items() if k != "device"}
-        device_data[str(dev_id)] = payload
+    def wait(self, interval):
+        """Blocks until a full batch is waiting, or anything is and `interval` seconds have passed."""
+        deadline = time.monotonic() + interval
+        with self.lock:
+            while True:
+                remaining = deadline - time.monotonic()
+                if self.waiting >= SPOOL_BATCH or (self.waiting and remaining <= 0):
+                    return
+                self.added.wait(remaining if remaining > 0 else interval)
+
+    def peek(self, limit):
+        """Returns the oldest `limit` readings as (id, device_id, reading dict)."""
+        with self.lock:
+            rows = self.db.execute("SELECT id, device, reading FROM readings ORDER BY id LIMIT ?",
+                                   (limit,)).fetchall()
+        return [(row_id, device, json.loads(reading)) for row_id, device, reading in rows]
+
+    def remove(self, last_id):
+        """Drops every reading up to and including `last_id`, once the server has them."""
+        with self.lock:
+            with self.db:
+                removed = self.db.execute("DELETE FROM readings WHERE id <= ?", (last_id,)).rowcount
+            self.waiting -= removed
+
+    def reject(self, row_id, reason):
+        """Moves a reading the server refuses to the rejected table, for inspection."""
+        with self.lock:
+            with self.db:
+                self.db.execute("INSERT INTO rejected SELECT id, device, reading, ? FROM readings "
+                                "WHERE id = ?", (reason, row_id))
+                removed = self.db.execute("DELETE FROM readings WHERE id = ?", (row_id,)).rowcount
+            self.waiting -= removed
+
+# === Upload ===
+use_wire_format = WIRE_FORMAT
+
+def upload(session, rows, key):
+    """
+    Posts spooled rows to /submit_bulk as one gzip body, binary if possible,
+    otherwise NDJSON. `key` makes a resent batch idempotent on the server.
+    """
+    global use_wire_format
+    headers = {"Content-Encoding": "gzip", "Idempotency-Key": key}
+    if use_wire_format:
+        try:
+            body = encode_readings((device, reading) for _, device, reading in rows)
+        except ValueError as e:
+            print("Sending as JSON:", e)
+        else:
+            resp = session.post(SERVER_URL, data=gzip.compress(body), timeout=REQUEST_TIMEOUT,
+                                headers=dict(headers, **{"Content-Type": CONTENT_TYPE}))
+            if resp.status_code not in (400, 415):
+                return resp
+            # Servers without the binary format reject it as malformed
+            json_resp = upload_ndjson(session, rows, headers)
+            if json_resp.status_code < 300:
+                print("Server does not accept the binary format, switching to JSON.")
+                use_wire_format = False
+            return json_resp
+    return upload_ndjson(session, rows, headers)
+
+def upload_ndjson(session, rows, headers):
+    body = "\n".join(json.dumps(dict(reading, device=device)) for _, device, reading in rows)
+    return session.post(SERVER_URL, data=gzip.compress(body.encode()), timeout=REQUEST_TIMEOUT,
+                        headers=dict(headers, **{"Content-Type": "application/x-ndjson"}))
+
+def send_spool(spool, batch=SPOOL_BATCH, until_empty=False):
+    """
+    Drains the spool in batches of up to `batch` readings over one
+    keep-alive session. Failed uploads (no answer, 429, 5xx) are retried
+    with exponential backoff; only a batch the server rejects as invalid
+    (400/413) is halved until the bad reading is isolated and moved aside.
+    Returns once the spool is empty if `until_empty`, otherwise keeps
+    waiting for new readings.
+    """
+    session = requests.Session()
+    limit, delay, rows = batch, 0, None
+    while True:
+        if delay:
+            time.sleep(delay * random.uniform(0.5, 1.0))
+        elif not until_empty:
+            spool.wait(UPLOAD_INTERVAL)
+        # A failed batch is resent unchanged, so its Idempotency-Key still matches
+        rows = rows or spool.peek(limit)
+        if not rows:
+            if until_empty:
+                return
+            continue
 
-    # 4) Upload batch if we got anything
-    if device_data:
-        print("Uploading:", device_data)
         try:
-            resp = requests.post(SERVER_URL, json=device_data)
-            if resp.status_code == 200:
-                print("Upload successful.")
+            resp = upload(session, rows, f"{spool.spool_id}-{rows[0][0]}-{rows[-1][0]}")
+        except requests.RequestException as e:
+            delay = min(BACKOFF_MAX_SECONDS, max(BACKOFF_MIN_SECONDS, delay * 2))
+            print(f"Upload exception, retrying in about {delay}s:", e)
+            continue
+
+        if resp.status_code < 300:
+            spool.remove(rows[-1][0])
+            limit, delay = batch, 0
+            print(f"Uploaded {len(rows)} readings, {spool.waiting} waiting.")
+            rows = None
+        elif resp.status_code in (400, 413):
+            delay = 0
+            if len(rows) > 1:
+                limit = max(1, len(rows) // 2)
             else:
-                print(f"Upload failed {resp.status_code}:", resp.text)
-        except Exception as e:
-            print("Upload exception:", e)
+                spool.reject(rows[0][0], resp.text)
+                print(f"Reading {rows[0][0]} rejected {resp.status_code}:", resp.text)
+            rows = None
+        else:
+            delay = min(BACKOFF_MAX_SECONDS, max(BACKOFF_MIN_SECONDS, delay * 2,
+                                                 int(resp.headers.get("Retry-After", 0) or 0)))
+            print(f"Upload failed {resp.status_code}, retrying in about {delay}s:", resp.text)
+
+# === Serial Readers ===
+def read_port(port, lines):
+    """Queues every line one receiver prints, blocking between lines, and reopens the port if it drops."""
+    import serial  # only needed when reading from a live receiver
+
+    while True:
+        try:
+            with serial.Serial(port, BAUD_RATE) as conn:
+                print(f"Listening on {port}")
+                while True:
+                    lines.put(conn.readline())
+        except serial.SerialException as e:
+            print(f"Serial port {port} failed: {e}")
+            time.sleep(RECONNECT_SECONDS)
+
+def parse_lines(lines, spool):
+    """Parses queued lines from every port into the spool."""
+    while True:
+        raw = lines.get().decode(errors='ignore').strip()
+        if not raw:
+            continue
+        parsed, error = tokenize_serial_line(raw)
+        if error:
+            print(f"Skipped malformed ({error[0]}: {error[1]}):", raw)
+            continue
+        spool.add(parsed)
+
+# === Replay ===
+def capture_files(path):
+    """Returns `path`, or every file in the directory `path` in name order."""
+    if os.path.isdir(path):
+        return [os.path.join(path, name) for name in sorted(os.listdir(path))
+                if os.path.isfile(os.path.join(path, name))]
+    return [path]
+
+def parse_capture(filename, stats):
+    """Yields the readings in one raw serial capture (gzip if it ends in .gz), counting into `stats`."""
+    opener = gzip.open if filename.endswith(".gz") else open
+    with opener(filename, "rt", encoding="utf-8", errors="ignore") as f:
+        for line in f:
+            line = line.strip()
+            if not line:
+                continue
+            stats["lines"] += 1
+            reading, error = tokenize_serial_line(line)
+            if error:
+                stats["rejected"][error[0]] = stats["rejected"].get(error[0], 0) + 1
+                continue
+            stats["readings"] += 1
+            yield reading
+
+def read_csv_rows(path):
+    """Returns the data rows of a server CSV or segment (gzip if it ends in .gz)."""
+    opener = gzip.open if path.endswith(".gz") else open
+    with opener(path, "rt", newline="") as f:
+        reader = csv.reader(f)
+        next(reader, None)   # header
+        return list(reader)
+
+def newest_time(csv_dir, device_id):
+    """The newest time the server has for a device: its live CSV's last rows, or its closed segments."""
+    newest = None
+    try:
+        with open(os.path.join(csv_dir, f"{device_id}_data.csv"), "rb") as f:
+            f.seek(max(os.fstat(f.fileno()).st_size - 65536, 0))
+            for line in f.read().decode(errors="ignore").splitlines()[1:]:
+                ts = parse_time(line.split(",", 1)[0])
+                newest = ts if ts is not None else newest
+    except FileNotFoundError:
+        pass
+    for entry in read_segment_manifest(csv_dir, device_id):
+        if entry["end"] is not None and (newest is None or entry["end"] > newest):
+            newest = entry["end"]
+    return newest
+
+def read_segment_manifest(csv_dir, device_id):
+    try:
+        with open(os.path.join(csv_dir, "segments", str(device_id), "manifest.json")) as f:
+            return json.load(f)["segments"]
+    except FileNotFoundError:
+        return []
+
+def sorted_rows(rows):
+    """Sorts rows by time; a row without a parsable time stays after the row before it."""
+    keyed, last = [], float("-inf")
+    for row in rows:
+        ts = parse_time(row[0])
+        last = ts if ts is not None else last
+        keyed.append((last, len(keyed), row))
+    keyed.sort(key=lambda item: item[:2])
+    return [row for _, _, row in keyed]
+
+def write_csv_file(path, rows):
+    with open(path + ".tmp", "w", newline="") as f:
+        writer = csv.writer(f)
+        writer.writerow(CSV_HEADERS)
+        writer.writerows(rows)
+    os.replace(path + ".tmp", path)
+
+def backfill(csv_dir, device_id, rows):
+    """
+    Merges rows older than a device's newest data into its history in time
+    order. Rows that fall within the live CSV's range are merged into it;
+    the rest are merged with the closed segments they overlap into a new
+    closed segment, which the server seals into per-day files. Only the
+    files that overlap are read back.
+    """
+    live_path = os.path.join(csv_dir, f"{device_id}_data.csv")
+    live = read_csv_rows(live_path) if os.path.isfile(live_path) else []
+    live_start = next((ts for ts in (parse_time(row[0]) for row in live) if ts is not None), None)
+    into_live, into_segments = [], []
+    for row in rows:   # every row here has a parsable time
+        (into_live if live_start is not None and parse_time(row[0]) >= live_start else into_segments).append(row)
+
+    if into_live:
+        write_csv_file(live_path, sorted_rows(live + into_live))
+        if os.path.isfile(os.path.join(csv_dir, f"{device_id}_data.idx")):
+            os.remove(os.path.join(csv_dir, f"{device_id}_data.idx"))
+
+    if into_segments:
+        times = [ts for ts in (parse_time(row[0]) for row in into_segments) if ts is not None]
+        lo, hi = min(times), max(times)
+        directory = os.path.join(csv_dir, "segments", str(device_id))
+        os.makedirs(directory, exist_ok=True)
+        entries = read_segment_manifest(csv_dir, device_id)
+        merged = [e for e in entries if e["start"] is not None and e["end"] is not None
+                  and e["start"] <= hi and e["end"] >= lo]
+        merged_rows = into_segments
+        for entry in merged:
+            merged_rows = merged_rows + read_csv_rows(os.path.join(directory, entry["file"]))
+        merged_rows = sorted_rows(merged_rows)
+        name = f"closed-{time.time_ns()}.csv"
+        write_csv_file(os.path.join(directory, name), merged_rows)
+        times = [ts for ts in (parse_time(row[0]) for row in merged_rows) if ts is not None]
+        entries = [e for e in entries if e not in merged]
+        entries.append({"file": name, "start": min(times), "end": max(times), "rows": len(merged_rows),
+                        "bytes": os.path.getsize(os.path.join(directory, name)), "sealed": False})
+        entries.sort(key=lambda e: (e["start"] is None, e["start"] or 0, e["file"]))   # as Server.write_manifest
+        path = os.path.join(directory, "manifest.json")
+        retired = []   # replaced files the server still keeps for its readers
+        if os.path.isfile(path):
+            with open(path) as f:
+                retired = json.load(f).get("retired", [])
+        with open(path + ".tmp", "w") as f:
+            json.dump({"segments": entries, "retired": retired}, f, indent=1)
+        os.replace(path + ".tmp", path)
+        for entry in merged:
+            os.remove(os.path.join(directory, entry["file"]))
+
+    # Rollups only ever replay rows after their last bucket: rebuild them from the whole history
+    for name in os.listdir(csv_dir):
+        if name.startswith(f"{device_id}_rollup_") and name.endswith(".bin"):
+            os.remove(os.path.join(csv_dir, name))
+
+def write_csvs(readings, csv_dir):
+    """
+    Appends readings to <csv_dir>/<device_id>_data.csv in the server's layout.
+    Readings older than what a device already has are merged into its
+    history in time order instead (see backfill). Meant for a data directory
+    the server is not running on: the server rebuilds its indexes and
+    rollups for the changed files when it next starts.
+    """
+    os.makedirs(csv_dir, exist_ok=True)
+    files, writers, newest, older = {}, {}, {}, {}
+    try:
+        for reading in readings:
+            device_id = reading["device"]
+            row = [reading["time"], reading["long"], reading["lat"], reading["alt"],
+                   reading["temp"], reading["hum"], reading["uv"], reading["rain"]]
+            if device_id not in newest:
+                newest[device_id] = newest_time(csv_dir, device_id)
+            ts = parse_time(reading["time"])
+            if ts is not None and newest[device_id] is not None and ts < newest[device_id]:
+                older.setdefault(device_id, []).append(row)
+                continue
+            if ts is not None:
+                newest[device_id] = ts
+            writer = writers.get(device_id)
+            if writer is None:
+                f = files[device_id] = open(os.path.join(csv_dir, f"{device_id}_data.csv"), "a", newline="")
+                writer = writers[device_id] = csv.writer(f)
+                if f.tell() == 0:
+                    writer.writerow(CSV_HEADERS)
+            writer.writerow(row)
+    finally:
+        for f in files.values():
+            f.close()
+
+    for device_id, rows in older.items():
+        print(f"Device {device_id}: merging {len(rows)} readings older than its newest data")
+        backfill(csv_dir, device_id, rows)
+    for device_id in newest:
+        # The columnar store no longer holds the whole history; Columnar_store.py convert rebuilds it
+        marker = os.path.join(csv_dir, "columnar", str(device_id), "complete")
+        if os.path.isfile(marker):
+            os.remove(marker)
+
+def replay(path, csv_dir=None):
+    """
+    Backfills raw serial captures as fast as they parse: into server CSVs, or
+    through REPLAY_SPOOL_PATH to the server in REPLAY_BATCH uploads. Each
+    capture is spooled in one transaction and remembered, so an interrupted
+    replay can simply be run again.
+    """
+    stats = {"lines": 0, "readings": 0, "rejected": {}}
+    files = capture_files(path)
+    started = time.perf_counter()
+
+    if csv_dir:
+        for filename in files:
+            write_csvs(parse_capture(filename, stats), csv_dir)
+    else:
+        spool = Spool(REPLAY_SPOOL_PATH)
+        if spool.waiting:
+            print(f"{spool.waiting} readings from an interrupted replay will be uploaded too.")
+        for filename in files:
+            mark = f"replayed:{os.path.abspath(filename)}:{os.path.getsize(filename)}"
+            if spool.is_marked(mark):
+                print(f"{filename}: already spooled, skipped")
+                continue
+            spool.add_many(parse_capture(filename, stats), mark=mark)
+
+    seconds = time.perf_counter() - started
+    rejected = stats["lines"] - stats["readings"]
+    print(f"Parsed {stats['lines']} lines from {len(files)} file(s) in {seconds:.1f}s "
+          f"({stats['lines'] / seconds if seconds else 0:.0f} lines/s), "
+          f"{rejected} malformed ({rejected / stats['lines'] if stats['lines'] else 0:.2%})")
+    for reason, count in sorted(stats["rejected"].items(), key=lambda item: -item[1]):
+        print(f"  {reason}: {count}")
+
+    if not csv_dir:
+        waiting = spool.waiting
+        started = time.perf_counter()
+        send_spool(spool, batch=REPLAY_BATCH, until_empty=True)
+        seconds = time.perf_counter() - started
+        print(f"Uploaded {waiting} readings in {seconds:.1f}s "
+              f"({waiting / seconds if seconds else 0:.0f} readings/s)")
+
+# === Main Loop ===
+def main():
+    spool = Spool(SPOOL_PATH)
+    if spool.waiting:
+        print(f"{spool.waiting} spooled readings from an earlier run will be uploaded first.")
+
+    # Serial reads and parsing run on their own threads, so a slow upload never stalls a port
+    lines = queue.Queue()
+    for port in SERIAL_PORTS:
+        threading.Thread(target=read_port, args=(port, lines), name=f"serial-{port}", daemon=True).start()
+    threading.Thread(target=parse_lines, args=(lines, spool), name="parser", daemon=True).start()
+
+    send_spool(spool)
+
 
-    # 5) Wait before next batch
-    time.sleep(UPLOAD_INTERVAL)
+if __name__ == "__main__":
+    if len(sys.argv) in (3, 4) and sys.argv[1] == "replay":
+        replay(*sys.argv[2:])
+    elif len(sys.argv) == 1:
+        main()
+    else:
+        print(__doc__)
+        sys.exit(1)
@@ -1,11 +1,15 @@
 import customtkinter
 import tkinter
+import json
+import queue
+import threading
+from concurrent.futures import ThreadPoolExecutor
 from PIL import Image
 from tkintermapview import TkinterMapView
 import matplotlib.pyplot as plt
 from matplotlib.backends.backend_tkagg import FigureCanvasTkAgg
 import requests
-from geopy.geocoders import Nominatim
+from Geocode_cache import GeocodeCache, NearestPlaceBackend, NominatimBackend
 import mplcursors
 import matplotlib.ticker as ticker
 from datetime import datetime, time
@@ -13,9 +17,40 @@ from matplotlib.dates import DateFormatter, HourLocator, num2date
 
 # API URL
 API_URL = "https://kargalex.eu.pythonanywhere.com/latest"
-
-# Initialize geolocator for reverse geocoding
-geolocator = Nominatim(user_agent="weather_app")
+STREAM_URL = "https://kargalex.eu.pythonanywhere.com/stream"  # live readings (Server-Sent Events)
+STREAM_RETRY_SECONDS = 5
+REQUEST_TIMEOUT = (5, 10)  # connect, read (seconds)
+GEOCODE_TIMEOUT = 10
+GEOCODE_CACHE_PATH = "geocode_cache.db"
+GEOCODE_PRECISION = 3  # decimals the coordinates are rounded to for the cache, about 100 m
+GEOCODE_TTL_DAYS = 30
+GEOCODE_CACHE_SIZE = 10000
+GEOCODE_PLACES = None  # CSV of name,lat,lon to name stations offline instead of asking Nominatim
+UI_POLL_MS = 16  # how often finished background work is applied, about once a frame
+
+# Network calls run on this pool; their results come back to the Tk thread
+# through ui_results. Each kind of request only applies its newest result.
+io_pool = ThreadPoolExecutor(max_workers=4, thread_name_prefix="gui-io")
+ui_results = queue.Queue()
+request_generations = {}  # {kind: number of the newest request}
+pending_requests = set()  # kinds whose newest request has not come back yet
+
+# Readings pushed by the server, queued by the stream thread for the UI thread
+stream_events = queue.Queue()
+stream_connected = threading.Event()
+
+# ETag of the last /latest response, so unchanged polls come back as 304
+latest_etag = None
+
+# Reverse geocoding, cached on disk since stations hardly ever move
+geocoder = GeocodeCache(
+    GEOCODE_CACHE_PATH,
+    NearestPlaceBackend.from_csv(GEOCODE_PLACES) if GEOCODE_PLACES
+    else NominatimBackend(user_agent="weather_app", timeout=GEOCODE_TIMEOUT),
+    precision=GEOCODE_PRECISION,
+    ttl_seconds=GEOCODE_TTL_DAYS * 86400,
+    max_entries=GEOCODE_CACHE_SIZE
+)
 
 # Store current markers by API key with their data
 current_markers = {}  # {key: {'marker': marker, 'coords': (lat, lon), 'name': city_name, 'temperature_data': [], 'uv_data': [], 'humidity_data': [], 'time_data': []}}
@@ -66,12 +101,61 @@ def get_weather_icon(uv, rain):
             return clear_night_icon
     return cloudy_icon  # Fallback
 
+def run_in_background(kind, work, on_done, on_error):
+    """
+    Runs work() on the I/O pool, then on_done(result) or on_error(exception)
+    on the Tk thread. A newer request of the same kind makes this one stale,
+    and its result is dropped.
+    """
+    generation = request_generations[kind] = request_generations.get(kind, 0) + 1
+    pending_requests.add(kind)
+
+    def task():
+        try:
+            ui_results.put((kind, generation, on_done, work()))
+        except Exception as e:
+            ui_results.put((kind, generation, on_error, e))
+
+    io_pool.submit(task)
+
+def drain_ui_results():
+    """Applies finished background work on the Tk thread, skipping stale results."""
+    while True:
+        try:
+            kind, generation, callback, result = ui_results.get_nowait()
+        except queue.Empty:
+            break
+        if generation != request_generations.get(kind):
+            continue
+        pending_requests.discard(kind)
+        try:
+            callback(result)
+        except Exception as e:
+            print(f"Error applying {kind} result: {e}")
+    app.after(UI_POLL_MS, drain_ui_results)
+
+def fetch_latest(headers=None):
+    """Worker side: GET /latest, returning (status code, JSON body or None, ETag)."""
+    response = requests.get(API_URL, headers=headers or {}, timeout=REQUEST_TIMEOUT)
+    data = response.json() if response.status_code == 200 else None
+    return response.status_code, data, response.headers.get("ETag")
+
 def on_marker_click(marker):
+    run_in_background("selection", fetch_latest,
+                      lambda result: show_marker_data(marker, result), selection_failed)
+
+def selection_failed(e):
     global current_location
+    print(f"Error fetching API data: {e}")
+    current_location = "No Location Selected"
+    location_label.configure(text=f"Location: {current_location}")
+    label_board.configure(text="Error fetching data")
+
+def show_marker_data(marker, result):
+    global current_location
+    status, data_dict, _ = result
     try:
-        response = requests.get(API_URL)
-        if response.status_code == 200:
-            data_dict = response.json()
+        if status == 200:
             for key, data in data_dict.items():
                 if key in current_markers and current_markers[key]['name'] == marker.text:
                     current_location = marker.text
@@ -107,15 +191,12 @@ def on_marker_click(marker):
                 ax.autoscale_view()
             canvas.draw_idle()
         else:
-            print(f"Failed to fetch data: {response.status_code}")
+            print(f"Failed to fetch data: {status}")
             current_location = "No Location Selected"
             location_label.configure(text=f"Location: {current_location}")
             label_board.configure(text="Error fetching data")
     except Exception as e:
-        print(f"Error fetching API data: {e}")
-        current_location = "No Location Selected"
-        location_label.configure(text=f"Location: {current_location}")
-        label_board.configure(text="Error fetching data")
+        selection_failed(e)
 
 def open_full_map():
     map_window = customtkinter.CTkToplevel(app)
@@ -164,18 +245,40 @@ def reset_graph():
     canvas.draw_idle()
 
 def refresh_markers():
-    global current_markers, current_location
+    run_in_background("stations", fetch_stations, show_stations, stations_failed)
+
+def stations_failed(e):
+    global current_location
+    print(f"Error fetching API data: {e}")
+    current_location = "No Location Selected"
+    location_label.configure(text=f"Location: {current_location}")
+
+def locate_station(key, lat, lon):
+    """Worker side: the city name for a station's coordinates."""
     try:
-        response = requests.get(API_URL)
-        if response.status_code == 200:
-            data_dict = response.json()
-        else:
-            print(f"Failed to fetch data: {response.status_code}")
-            current_location = "No Location Selected"
-            location_label.configure(text=f"Location: {current_location}")
-            return
+        return geocoder.lookup(lat, lon) or f"Unknown City {key}"
     except Exception as e:
-        print(f"Error fetching API data: {e}")
+        print(f"Error reverse geocoding for key {key}: {e}")
+        return f"Unknown City {key}"
+
+def fetch_stations():
+    """Worker side: /latest plus a city name per station, as (status code, data, {key: city})."""
+    status, data_dict, _ = fetch_latest()
+    if status != 200:
+        return status, None, {}
+    names = {}
+    for key, data in data_dict.items():
+        try:
+            names[key] = locate_station(key, float(data['latitude']), float(data['longitude']))
+        except (TypeError, KeyError, ValueError):
+            continue  # reported when the markers are built
+    return status, data_dict, names
+
+def show_stations(result):
+    global current_markers, current_location
+    status, data_dict, names = result
+    if status != 200:
+        print(f"Failed to fetch data: {status}")
         current_location = "No Location Selected"
         location_label.configure(text=f"Location: {current_location}")
         return
@@ -205,19 +308,7 @@ def refresh_markers():
             new_humidity = float(data['hum'])
             rain = data['rain']
 
-            # Reverse geocode to get city name
-            try:
-                location = geolocator.reverse((lat, lon), language='en')
-                city_name = (
-                    location.raw['address'].get('city') or
-                    location.raw['address'].get('town') or
-                    location.raw['address'].get('village') or
-                    location.raw['address'].get('locality') or
-                    f"Unknown City {key}"
-                ) if location and location.raw.get('address') else f"Unknown City {key}"
-            except Exception as e:
-                print(f"Error reverse geocoding for key {key}: {e}")
-                city_name = f"Unknown City {key}"
+            city_name = names.get(key, f"Unknown City {key}")
 
             # Check if this is Thessaloniki (based on coordinates proximity)
             if abs(lat - 40.6401) < 0.1 and abs(lon - 22.9444) < 0.1:
@@ -312,21 +403,65 @@ def refresh_markers():
     map_widget.set_position(39.0, 22.0)  # Center of Greece
     map_widget.set_zoom(6)  # Zoom to show all of Greece
 
+def stream_listener():
+    """Background thread: follows the server's /stream and queues each pushed reading."""
+    while True:
+        try:
+            with requests.get(STREAM_URL, stream=True, timeout=(5, 60)) as response:
+                response.raise_for_status()
+                stream_connected.set()
+                data_lines = []
+                for line in response.iter_lines(decode_unicode=True):
+                    if line.startswith("data:"):
+                        data_lines.append(line[5:].strip())
+                    elif not line and data_lines:
+                        stream_events.put(json.loads("\n".join(data_lines)))
+                        data_lines = []
+        except Exception as e:
+            print(f"Live stream disconnected: {e}")
+        stream_connected.clear()
+        threading.Event().wait(STREAM_RETRY_SECONDS)
+
+def drain_stream_events():
+    """Applies readings pushed through /stream on the Tk thread."""
+    data_dict = {}
+    while True:
+        try:
+            data_dict.update(stream_events.get_nowait())
+        except queue.Empty:
+            break
+    if data_dict:
+        apply_latest_data(data_dict)
+    app.after(250, drain_stream_events)
+
 def update_data():
-    global current_markers, current_location
-    try:
-        response = requests.get(API_URL)
-        if response.status_code == 200:
-            data_dict = response.json()
-        else:
-            print(f"Failed to fetch data: {response.status_code}")
-            label_board.configure(text="Error fetching data")
-            return
-    except Exception as e:
-        print(f"Error fetching API data: {e}")
+    """Polls /latest, but only while the live stream is not connected and no poll is in flight."""
+    if not stream_connected.is_set() and "poll" not in pending_requests:
+        headers = {"If-None-Match": latest_etag} if latest_etag else {}
+        run_in_background("poll", lambda: fetch_latest(headers), apply_poll, poll_failed)
+
+    # Schedule next update
+    app.after(5000, update_data)
+
+def apply_poll(result):
+    global latest_etag
+    status, data_dict, etag = result
+    if status == 200:
+        latest_etag = etag
+        apply_latest_data(data_dict)
+    elif status == 304:
+        pass  # Nothing new since the last poll
+    else:
+        print(f"Failed to fetch data: {status}")
         label_board.configure(text="Error fetching data")
-        return
 
+def poll_failed(e):
+    print(f"Error fetching API data: {e}")
+    label_board.configure(text="Error fetching data")
+
+def apply_latest_data(data_dict):
+    """Adds new readings ({key: /latest row}) to the graphs and the current-location panel."""
+    global current_markers, current_location
     # Update data for all locations
     for key, data in data_dict.items():
         if key not in current_markers:
@@ -377,9 +512,6 @@ def update_data():
             print(f"Error converting data to float for key {key}: {e}")
             continue
 
-    # Schedule next update
-    app.after(5000, update_data)
-
 app = customtkinter.CTk()
 app.title("ClimaNET")
 app.geometry("1920x1080")
@@ -554,7 +686,10 @@ map_widget.grid(row=0, column=0, sticky="nsew")
 map_widget.set_position(39.0, 22.0)  # Initial center on Greece
 map_widget.set_zoom(6)  # Zoom to show all of Greece
 
-# Start periodic data updates
+# Start live updates, with /latest polling as the fallback
+threading.Thread(target=stream_listener, daemon=True).start()
+drain_stream_events()
+drain_ui_results()
 update_data()
 
 app.mainloop()
\ No newline at end of file
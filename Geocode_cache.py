@@ -0,0 +1,155 @@
+"""
+Persistent reverse-geocode cache for station names.
+
+Stations hardly ever move, so the place name for a pair of coordinates is
+looked up once and kept in SQLite, keyed by the coordinates rounded to
+`precision` decimals (3 is about 100 m). Entries older than the TTL are
+looked up again. Beyond `max_entries`, the entries fetched longest ago are
+evicted first; hits do not count, so this is not an LRU.
+
+The lookup itself is a backend: any callable (lat, lon) -> name or None.
+NominatimBackend asks OpenStreetMap through geopy; NearestPlaceBackend
+answers from a local list of places, for tests and offline deployments.
+
+Usage:
+    python Geocode_cache.py <cache.db> <lat> <lon> [<places.csv>]
+"""
+import csv
+import math
+import sqlite3
+import sys
+import threading
+import time
+
+EARTH_RADIUS_KM = 6371.0
+
+
+class NominatimBackend:
+    """Reverse geocoding through Nominatim, at most one request per `min_interval` seconds."""
+
+    def __init__(self, user_agent="weather_app", timeout=10, min_interval=1.0):
+        from geopy.geocoders import Nominatim   # only needed when geocoding online
+        self.geolocator = Nominatim(user_agent=user_agent, timeout=timeout)
+        self.min_interval = min_interval
+        self.last_request = 0.0
+        self.lock = threading.Lock()
+
+    def __call__(self, lat, lon):
+        with self.lock:   # Nominatim's usage policy allows one request per second
+            delay = self.last_request + self.min_interval - time.monotonic()
+            if delay > 0:
+                time.sleep(delay)
+            try:
+                location = self.geolocator.reverse((lat, lon), language='en')
+            finally:
+                self.last_request = time.monotonic()
+        address = location.raw.get('address') if location else None
+        if not address:
+            return None
+        return (address.get('city') or address.get('town') or
+                address.get('village') or address.get('locality'))
+
+
+class NearestPlaceBackend:
+    """Names coordinates after the nearest of a fixed list of places, within `max_km`."""
+
+    def __init__(self, places, max_km=25.0):
+        self.places = [(name, float(lat), float(lon)) for name, lat, lon in places]
+        self.max_km = max_km
+
+    @classmethod
+    def from_csv(cls, path, max_km=25.0):
+        """Reads places from a CSV file with name, lat and lon columns."""
+        with open(path, newline="", encoding="utf-8") as f:
+            return cls([(row["name"], row["lat"], row["lon"]) for row in csv.DictReader(f)], max_km)
+
+    def __call__(self, lat, lon):
+        best, best_km = None, self.max_km
+        for name, place_lat, place_lon in self.places:
+            km = distance_km(lat, lon, place_lat, place_lon)
+            if km <= best_km:
+                best, best_km = name, km
+        return best
+
+
+def distance_km(lat1: float, lon1: float, lat2: float, lon2: float) -> float:
+    """Great-circle (haversine) distance; Server.py's /nearest uses it too."""
+    p1, p2 = math.radians(lat1), math.radians(lat2)
+    a = (math.sin((p2 - p1) / 2) ** 2
+         + math.cos(p1) * math.cos(p2) * math.sin(math.radians(lon2 - lon1) / 2) ** 2)
+    return 2 * EARTH_RADIUS_KM * math.asin(min(1.0, math.sqrt(a)))
+
+
+class GeocodeCache:
+    """
+    Disk-backed cache in front of a reverse-geocoding backend, evicting by
+    oldest `fetched` time. Safe to share between threads.
+    """
+
+    def __init__(self, path, backend, precision=3, ttl_seconds=30 * 86400, max_entries=10000):
+        self.backend = backend
+        self.precision = precision
+        self.ttl_seconds = ttl_seconds
+        self.max_entries = max_entries
+        self.hits = self.misses = 0
+        self.lock = threading.Lock()
+        self.db = sqlite3.connect(path, check_same_thread=False)
+        with self.db:
+            self.db.execute("CREATE TABLE IF NOT EXISTS places "
+                            "(key TEXT PRIMARY KEY, name TEXT, fetched REAL)")
+            self.db.execute("CREATE INDEX IF NOT EXISTS places_fetched ON places (fetched)")
+
+    def key(self, lat, lon) -> str:
+        return f"{float(lat):.{self.precision}f},{float(lon):.{self.precision}f}"
+
+    def lookup(self, lat, lon):
+        """
+        Returns the place name for the coordinates, or None if the backend
+        knows none. A failing backend raises, unless an expired entry can be
+        returned instead.
+        """
+        key = self.key(lat, lon)
+        with self.lock:
+            row = self.db.execute("SELECT name, fetched FROM places WHERE key = ?", (key,)).fetchone()
+        if row is not None and time.time() - row[1] < self.ttl_seconds:
+            self.hits += 1
+            return row[0] or None
+
+        self.misses += 1
+        try:
+            name = self.backend(lat, lon)
+        except Exception:
+            if row is not None:
+                return row[0] or None   # stale beats nothing while the backend is down
+            raise
+        self.store(key, name)
+        return name
+
+    def store(self, key, name):
+        """
+        Records a lookup ("" for no name, so empty places are not asked
+        again) and evicts the entries fetched longest ago beyond max_entries.
+        """
+        with self.lock:
+            with self.db:
+                self.db.execute("INSERT OR REPLACE INTO places VALUES (?, ?, ?)",
+                                (key, name or "", time.time()))
+                excess = self.db.execute("SELECT COUNT(*) FROM places").fetchone()[0] - self.max_entries
+                if excess > 0:
+                    self.db.execute("DELETE FROM places WHERE key IN "
+                                    "(SELECT key FROM places ORDER BY fetched LIMIT ?)", (excess,))
+
+    def close(self):
+        with self.lock:
+            self.db.close()
+
+
+if __name__ == "__main__":
+    if len(sys.argv) not in (4, 5):
+        print(__doc__)
+        sys.exit(1)
+    backend = NearestPlaceBackend.from_csv(sys.argv[4]) if len(sys.argv) == 5 else NominatimBackend()
+    cache = GeocodeCache(sys.argv[1], backend)
+    started = time.perf_counter()
+    print(cache.lookup(float(sys.argv[2]), float(sys.argv[3])),
+          f"({'hit' if cache.hits else 'miss'}, {(time.perf_counter() - started) * 1000:.1f} ms)")
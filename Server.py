@@ -1,48 +1,2350 @@
-from flask import Flask, request, jsonify, send_file
+from flask import Flask, Response, g, request, jsonify
+import atexit
+import bisect
 import csv
+import gzip
+import json
+import math
+import multiprocessing
 import os
+import queue
+import struct
+import threading
+import time
 import zipfile
-from io import BytesIO
+import zlib
+from collections import OrderedDict, deque
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from contextlib import contextmanager
+from io import RawIOBase, StringIO
+
+import Wire_format
+from Geocode_cache import EARTH_RADIUS_KM, distance_km
+from Timestamps import parse_time, utc_day
+
+try:
+    import fcntl
+except ImportError:   # Windows: no advisory locks, run a single server process
+    fcntl = None
 
 app = Flask(__name__)
 DATA_DIR = "/home/Kargalex"
 
-def save_device(device_id: int, data: dict):
+# Map internal keys to proper header names
+CSV_HEADERS = ["time", "longitude", "latitude", "altitude",
+               "temp", "hum", "uv", "rain"]
+
+# Last row written per device, keyed by device ID string (as /latest returns it).
+# Kept up to date by save_device and rebuilt from the CSV tails at startup,
+# so /latest never has to re-read a device's history.
+latest_rows = {}
+latest_times = {}   # {device_id_str: parsed time of its /latest row}, so saves need not re-parse it
+latest_lock = threading.Lock()
+
+# Write sequence for /latest ETags and ?since= deltas. It starts from the clock
+# (in microseconds) so values keep increasing across restarts; every device
+# loaded at startup gets the starting value.
+latest_seq = time.time_ns() // 1000
+latest_seqs = {}   # {device_id_str: sequence number of its last write}
+latest_file_sizes = {}   # {device_id_str: CSV size when its /latest row was last taken}
+latest_refreshed = 0.0
+
+
+def next_latest_seq() -> int:
+    """Advances the write sequence (under latest_lock); never behind the clock, so
+    values from different server processes stay roughly comparable."""
+    global latest_seq
+    latest_seq = max(latest_seq + 1, time.time_ns() // 1000)
+    return latest_seq
+
+# Sparse time -> byte offset index per device, persisted as <device_id>_data.idx
+# ("epoch,offset" lines). One entry every INDEX_STRIDE rows lets /history seek
+# close to the start of a window instead of scanning the file from the top.
+# Rows are assumed to be appended in time order.
+INDEX_STRIDE = 256
+offset_index = {}   # {device_id_str: {"times", "offsets", "rows_since", "idx_size"}}
+index_lock = threading.Lock()
+
+HISTORY_ROW_LIMIT = 100000   # max rows returned by one /history call
+
+# === Write-behind CSV appends ===
+WRITE_BUFFER_ROWS    = 64       # flush a device's buffer once it holds this many rows
+WRITE_BUFFER_SECONDS = 1.0      # ... or once its oldest buffered row is this old
+MAX_OPEN_FILES       = 128      # per-device append handles kept open (LRU)
+FSYNC_POLICY         = "none"   # "none": leave it to the OS, "flush": fsync after every flush
+
+# Set when several server processes (e.g. gunicorn workers) share DATA_DIR.
+# Appends are always serialised per device with flock; this additionally makes
+# /latest pick up rows written by the other processes.
+MULTI_PROCESS          = False
+LATEST_REFRESH_SECONDS = 1.0    # how often /latest re-checks the files in that mode
+
+# === Segments ===
+# Rows go to <device_id>_data.csv until a row for a later UTC day arrives; the
+# file is then closed into DATA_DIR/segments/<device_id>/, where a background
+# thread splits it per day and gzips it. segments/<device_id>/manifest.json
+# lists every closed segment with its time range, so readers only open the
+# segments a request needs.
+SEGMENT_ROLLOVER       = True
+SEGMENT_COMPRESS       = True    # gzip sealed segments (otherwise they stay plain CSV)
+SEGMENT_CHECK_SECONDS  = 3600    # how often retention runs without a rollover
+SEGMENT_RETIRE_SECONDS = 300     # replaced segments stay on disk this long for readers still on them
+RETENTION_DAYS         = None    # drop closed segments whose last row is older (None = keep)
+DEVICE_RETENTION_DAYS  = {}      # per-device overrides, e.g. {"3": 30}
+
+# === Warm start ===
+# At startup every device's last row, sparse index and rollups are loaded.
+# Devices unchanged since the last clean shutdown are taken from
+# DATA_DIR/warm_start.json (file sizes plus checksums of the index files);
+# the others are scanned, on a process pool when there is enough to read.
+# Until that is done /ready answers 503, and so does everything outside
+# WARMUP_OPEN_ROUTES.
+WARMUP_IN_BACKGROUND  = True
+WARMUP_PROCESSES      = 0                  # 0 = one per CPU
+WARMUP_POOL_MIN_BYTES = 64 * 1024 * 1024   # CSV bytes to scan before a pool is worth starting
+WARMUP_OPEN_ROUTES    = ("/", "/ready", "/metrics")
+
+# === Asynchronous /submit ===
+# When enabled, validated batches are queued for a background writer thread and
+# /submit answers 202 right away; a full queue is answered with 429 + Retry-After.
+ASYNC_SUBMIT        = False
+SUBMIT_QUEUE_SIZE   = 1000   # batches waiting to be written
+WRITER_DRAIN_MAX    = 256    # batches the writer takes off the queue in one go
+RETRY_AFTER_SECONDS = 1
+
+MAX_BULK_READINGS = 100000   # readings accepted by one /submit_bulk request
+
+# === Duplicate submissions ===
+# A retried batch is acknowledged without being written again. It is
+# recognised by its Idempotency-Key header or, without one, reading by
+# reading from (device, time). Keys are remembered in an LRU of this size.
+IDEMPOTENCY_HEADER = "Idempotency-Key"
+DEDUP_CACHE_SIZE   = 100000   # 0 turns the check off
+
+REQUIRED_FIELDS = {
+    "time", "long", "lat", "alt", "temp", "hum", "uv", "rain"
+}
+
+# === /get_logs export ===
+EXPORT_LEVEL      = 6           # default deflate level (0 = store, 9 = smallest)
+EXPORT_CHUNK_SIZE = 64 * 1024   # bytes read / emitted per step while streaming
+
+# === Rollups ===
+# min/max/mean/count per device and bucket, kept up to date as rows are saved
+# and persisted as fixed-width records in <device_id>_rollup_<resolution>.bin
+ROLLUP_RESOLUTIONS = {"minute": 60, "hour": 3600, "day": 86400}
+ROLLUP_FIELDS      = ("temp", "hum", "uv", "rain")
+ROLLUP_BUCKET_LIMIT = 100000   # max buckets returned by one /rollup call
+ROLLUP_SCAN_SLACK   = 64       # records readers look around a bisection point (see read_rollups)
+ROLLUP_WRITE_RECORDS = 256     # closed buckets kept in memory before they are written out together
+
+# === Live stream (/stream) ===
+STREAM_HEARTBEAT_SECONDS = 15    # comment line sent to idle clients to keep the connection up
+STREAM_CLIENT_QUEUE      = 100   # events buffered per client; a client that falls further behind is dropped
+
+# === Station positions (/stations, /nearest) ===
+GRID_CELL_DEGREES = 0.5   # side of one cell of the spatial grid
+NEAREST_MAX_K     = 100   # most stations one /nearest call returns
+
+# === Running statistics and anomaly flags (/stats) ===
+# Kept in memory per device and field, updated in O(1) as readings are saved
+STATS_FIELDS      = ("temp", "hum", "uv")
+STATS_WINDOW      = 720     # readings in the sliding window (1 h at one reading per 5 s)
+EWMA_ALPHA        = 0.05
+ANOMALY_SIGMA     = 4.0     # flag readings further than this from the window mean, in std devs
+ANOMALY_MIN_COUNT = 60      # readings in the window before the sigma test applies
+ANOMALY_MIN_STD   = 0.5     # std dev floor, since the DHT11 only reports whole units
+STUCK_RUNS        = {"temp": 720, "hum": 720}   # identical readings in a row that mean a stuck sensor
+ANOMALY_LOG_SIZE  = 100     # recent flags kept per device
+
+# === Metrics (/metrics) ===
+LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05,
+                   0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+METRIC_ROUTES = ("/submit", "/submit_bulk", "/latest", "/history", "/rollup", "/get_logs",
+                 "/stations", "/nearest", "/stats")
+
+# === Columnar storage (optional, needs NumPy) ===
+# Also write every reading to fixed-width column files under DATA_DIR/columnar
+# (see Columnar_store.py); /history then answers from memory-mapped arrays.
+COLUMNAR_STORE = False
+
+
+def read_last_row(filepath: str, chunk_size: int = 4096):
+    """
+    Returns the last data row of a device CSV as a header->value dict
+    (like csv.DictReader would), or None if the file has no data rows.
+    Only the header line and the file tail are read, working backwards
+    from the end in `chunk_size` steps until a full line is found.
+    """
+    with open(filepath, "rb") as f:
+        header = f.readline()
+        body_start = f.tell()
+        f.seek(0, os.SEEK_END)
+        pos = f.tell()
+
+        tail = b""
+        while pos > body_start:
+            step = min(chunk_size, pos - body_start)
+            pos -= step
+            f.seek(pos)
+            tail = f.read(step) + tail
+            if b"\n" in tail.rstrip(b"\r\n"):
+                break
+
+    last_line = tail.rstrip(b"\r\n").rsplit(b"\n", 1)[-1]
+    if not last_line.strip():
+        return None
+
+    keys = next(csv.reader([header.decode(errors="replace")]))
+    values = next(csv.reader([last_line.decode(errors="replace")]))
+    return dict(zip(keys, values))
+
+
+def iter_csv_rows(filepath: str, offset=None):
+    """
+    Yields (byte_offset, row_dict) for every complete data row of a device CSV,
+    starting at `offset` (default: just past the header). A trailing partial
+    line, e.g. one still being written, is not yielded.
+    """
+    with open(filepath, "rb") as f:
+        keys = next(csv.reader([f.readline().decode(errors="replace")]), [])
+        if offset is not None:
+            f.seek(offset)
+        pos = f.tell()
+
+        for raw in iter(f.readline, b""):
+            start = pos
+            pos += len(raw)
+            if not raw.endswith(b"\n"):
+                break
+            if not raw.strip():
+                continue
+            values = next(csv.reader([raw.decode(errors="replace")]))
+            yield start, dict(zip(keys, values))
+
+
+def index_path(device_id) -> str:
+    return os.path.join(DATA_DIR, f"{device_id}_data.idx")
+
+
+def _new_index_state() -> dict:
+    # idx_size/idx_ino: bytes (and inode) of the .idx file already reflected in times/offsets
+    return {"times": [], "offsets": [], "rows_since": 0, "idx_size": 0, "idx_ino": None}
+
+
+def _index_row(state: dict, ts, offset: int) -> bool:
+    """Advances a device's index state by one row; returns True if the row got an entry."""
+    if ts is not None and (not state["offsets"] or state["rows_since"] >= INDEX_STRIDE):
+        state["times"].append(ts)
+        state["offsets"].append(offset)
+        state["rows_since"] = 1
+        return True
+    state["rows_since"] += 1
+    return False
+
+
+def load_offset_index(device_id: str) -> dict:
+    """
+    Loads <device_id>_data.idx and indexes any rows appended after its last
+    entry. The whole CSV is only scanned if the index is missing or does not
+    match the file, in which case the .idx is rewritten.
+    """
+    filepath = os.path.join(DATA_DIR, f"{device_id}_data.csv")
+    idx_path = index_path(device_id)
+    state = _new_index_state()
+
+    if os.path.isfile(idx_path):
+        try:
+            with open(idx_path) as f:
+                for line in f:
+                    ts, offset = line.strip().split(",")
+                    state["times"].append(float(ts))
+                    state["offsets"].append(int(offset))
+        except ValueError:
+            state = _new_index_state()
+
+    # Every entry must point at the start of a line inside the file
+    valid = state["offsets"] == sorted(state["offsets"])
+    if valid and state["offsets"]:
+        last = state["offsets"][-1]
+        with open(filepath, "rb") as f:
+            f.seek(last - 1)
+            valid = last < os.path.getsize(filepath) and f.read(1) == b"\n"
+
+    if not valid or not state["offsets"]:
+        state = _new_index_state()
+        start = None
+    else:
+        start = state["offsets"][-1]
+
+    written = len(state["offsets"])
+    for offset, row in iter_csv_rows(filepath, start):
+        _index_row(state, parse_time(row.get("time")), offset)
+
+    if not valid or written == 0:
+        with open(idx_path, "w") as f:
+            for ts, offset in zip(state["times"], state["offsets"]):
+                f.write(f"{ts!r},{offset}\n")
+    elif len(state["offsets"]) > written:
+        with open(idx_path, "a") as f:
+            for ts, offset in zip(state["times"][written:], state["offsets"][written:]):
+                f.write(f"{ts!r},{offset}\n")
+    st = os.stat(idx_path)
+    state["idx_size"], state["idx_ino"] = st.st_size, st.st_ino
+    return state
+
+
+def _catch_up_index(device_id: str, state: dict):
+    """Reads .idx entries other server processes appended since we last looked (under index_lock)."""
+    try:
+        st = os.stat(index_path(device_id))
+    except FileNotFoundError:
+        if state["idx_ino"] is not None:
+            state.update(_new_index_state())   # removed on rollover: those offsets are gone
+        return
+    size = st.st_size
+    if st.st_ino != state["idx_ino"] or size < state["idx_size"]:
+        state.update(_new_index_state())   # replaced elsewhere (e.g. on rollover): read it again
+        state["idx_ino"] = st.st_ino
+    if size == state["idx_size"]:
+        return
+
+    with open(index_path(device_id), "rb") as f:
+        f.seek(state["idx_size"])
+        data = f.read(size - state["idx_size"])
+    complete = data[:data.rfind(b"\n") + 1]
+    for line in complete.splitlines():
+        ts, offset = line.split(b",")
+        state["times"].append(float(ts))
+        state["offsets"].append(int(offset))
+        state["rows_since"] = 1
+    state["idx_size"] += len(complete)
+
+
+def record_index_rows(device_id, rows, created: bool = False, cut=None):
+    """
+    Adds rows just written, given as (epoch time, offset) pairs, to the
+    device's sparse index. Called with the CSV's file lock held, so .idx
+    appends from several server processes stay in file order. `created`
+    means the CSV was new, so any leftover .idx is discarded; `cut` means
+    everything from that offset on was rewritten, so entries there are.
+    """
+    key = str(device_id)
+    entries = []
+    with index_lock:
+        state = offset_index.get(key)
+        if state is None or created:
+            state = offset_index[key] = _new_index_state()
+            if created:
+                try:
+                    os.remove(index_path(key))   # a new inode tells other processes to start over
+                except FileNotFoundError:
+                    pass
+        _catch_up_index(key, state)
+        if cut is not None and state["offsets"] and state["offsets"][-1] >= cut:
+            n = bisect.bisect_left(state["offsets"], cut)
+            del state["times"][n:], state["offsets"][n:]
+            data = "".join(f"{ts!r},{offset}\n" for ts, offset in zip(state["times"], state["offsets"]))
+            with open(index_path(key) + ".tmp", "w") as f:
+                f.write(data)
+            os.replace(index_path(key) + ".tmp", index_path(key))   # a new inode: other processes reread it
+            st = os.stat(index_path(key))
+            state["idx_size"], state["idx_ino"] = st.st_size, st.st_ino
+            state["rows_since"] = INDEX_STRIDE   # the first rewritten row gets an entry
+
+        for ts, offset in rows:
+            if _index_row(state, ts, offset):
+                entries.append(f"{ts!r},{offset}\n")
+        if entries:
+            data = "".join(entries).encode()
+            with open(index_path(key), "ab") as f:
+                f.write(data)
+                state["idx_ino"] = os.fstat(f.fileno()).st_ino
+            state["idx_size"] += len(data)
+
+
+def iter_history(device_id: str, start=None, end=None):
+    """
+    Yields the rows of one device with start <= time <= end (epoch seconds,
+    None = unbounded): first from the closed segments the manifest lists for
+    that range, then from <device_id>_data.csv, where it seeks to the last
+    index entry at or before `start` and stops at the first row past `end`.
+    """
+    filepath = os.path.join(DATA_DIR, f"{device_id}_data.csv")
+    csv_log.flush(device_id)
+    if os.path.isdir(segment_dir(device_id)):
+        yield from iter_segment_rows(device_id, start, end)
+        if not os.path.isfile(filepath):
+            return
+    offset = None
+    if start is not None:
+        with index_lock:
+            state = offset_index.get(device_id)
+            if state:
+                _catch_up_index(device_id, state)
+                i = bisect.bisect_right(state["times"], start) - 1
+                if i >= 0:
+                    offset = state["offsets"][i]
+
+    for _, row in iter_csv_rows(filepath, offset):
+        ts = parse_time(row.get("time"))
+        if ts is None or (start is not None and ts < start):
+            continue
+        if end is not None and ts > end:
+            break
+        yield row
+
+
+def read_history(device_id: str, start=None, end=None, limit=None):
+    """
+    Returns (rows, truncated) for iter_history, capped at `limit` rows.
+    Served from the columnar store instead once it holds the device's whole
+    history (see Columnar_store.py convert).
+    """
+    if columnar is not None and columnar.is_complete(device_id):
+        source = columnar.iter_csv_rows(device_id, start, end)
+    else:
+        source = iter_history(device_id, start, end)
+
+    rows = []
+    for row in source:
+        if limit is not None and len(rows) >= limit:
+            return rows, True
+        rows.append(row)
+    return rows, False
+
+
+class ZipStream(RawIOBase):
+    """Write-only, unseekable sink that collects zipfile output for a response generator."""
+
+    def __init__(self):
+        self.chunks = []
+
+    def writable(self):
+        return True
+
+    def write(self, b):
+        self.chunks.append(bytes(b))
+        return len(b)
+
+    def drain(self) -> bytes:
+        data = b"".join(self.chunks)
+        self.chunks = []
+        return data
+
+
+def stream_logs_zip(device_ids, start=None, end=None, level=EXPORT_LEVEL):
+    """
+    Yields a zip archive of the given devices' CSVs chunk by chunk, so memory
+    use stays flat and the first bytes go out before the archive is complete.
+    With a time range, only the matching rows (plus the header) are included.
+    """
+    sink = ZipStream()
+    compression = zipfile.ZIP_DEFLATED if level else zipfile.ZIP_STORED
+    with zipfile.ZipFile(sink, "w", compression, compresslevel=level or None) as zipf:
+        for device_id in device_ids:
+            filename = f"{device_id}_data.csv"
+            filepath = os.path.join(DATA_DIR, filename)
+            if not os.path.isfile(filepath):
+                continue
+
+            csv_log.flush(device_id)
+            segments = read_manifest(device_id)
+            size = os.path.getsize(filepath) + sum(segment["bytes"] for segment in segments)
+            with zipf.open(filename, "w", force_zip64=size >= zipfile.ZIP64_LIMIT) as entry:
+                if start is None and end is None:
+                    # Closed segments first, then the open file, under a single header
+                    for n, f in enumerate(iter_device_files(device_id)):
+                        header = f.readline()
+                        if n == 0:
+                            entry.write(header.encode())
+                        for chunk in iter(lambda: f.read(EXPORT_CHUNK_SIZE), ""):
+                            entry.write(chunk.encode())
+                            yield sink.drain()
+                else:
+                    pending = [encode_csv_row(CSV_HEADERS)]
+                    size = 0
+                    for row in iter_history(device_id, start, end):
+                        line = encode_csv_row([row.get(h) for h in CSV_HEADERS])
+                        pending.append(line)
+                        size += len(line)
+                        if size >= EXPORT_CHUNK_SIZE:
+                            entry.write(b"".join(pending))
+                            pending, size = [], 0
+                            yield sink.drain()
+                    entry.write(b"".join(pending))
+            yield sink.drain()
+    yield sink.drain()
+
+
+def device_ids_on_disk():
+    """Returns the IDs of every device with a <device_id>_data.csv in DATA_DIR."""
+    return sorted(
+        (filename.replace("_data.csv", "")
+         for filename in os.listdir(DATA_DIR) if filename.endswith("_data.csv")),
+        key=lambda device_id: (len(device_id), device_id)
+    )
+
+
+def parse_time_range():
+    """
+    Reads the optional `from`/`to` query arguments as epoch seconds.
+    Returns (start, end, None), or (None, None, error_response).
+    """
+    bounds = {}
+    for name in ("from", "to"):
+        value = request.args.get(name)
+        bounds[name] = parse_time(value) if value else None
+        if value and bounds[name] is None:
+            return None, None, (
+                jsonify({
+                    "status": "error",
+                    "message": f"'{name}' is not a valid time: {value}"
+                }),
+                400
+            )
+    return bounds["from"], bounds["to"], None
+
+
+def parse_device_arg():
+    """Reads the `device` query argument. Returns (device_id, None) or (None, error_response)."""
+    device_str = request.args.get("device", "")
+    try:
+        return str(int(device_str)), None
+    except ValueError:
+        return None, (
+            jsonify({
+                "status": "error",
+                "message": f"Device '{device_str}' is not a valid integer"
+            }),
+            400
+        )
+
+
+def refresh_latest_from_disk():
+    """
+    With MULTI_PROCESS, takes the /latest row of every device whose CSV grew
+    through another server process since we last looked (one stat per
+    device, at most every LATEST_REFRESH_SECONDS).
+    """
+    global latest_refreshed
+    now = time.monotonic()
+    with latest_lock:
+        if now - latest_refreshed < LATEST_REFRESH_SECONDS:
+            return
+        latest_refreshed = now
+        known = dict(latest_file_sizes)
+
+    for device_id in device_ids_on_disk():
+        filepath = os.path.join(DATA_DIR, f"{device_id}_data.csv")
+        try:
+            size = os.path.getsize(filepath)
+            if size == known.get(device_id) or csv_log.has_buffered(device_id):
+                continue   # unchanged, or our own newer rows are still buffered
+            last_row_dict = read_last_row(filepath)
+        except OSError:
+            continue
+
+        ts = parse_time(last_row_dict.get("time")) if last_row_dict else None
+        with latest_lock:
+            latest_file_sizes[device_id] = size
+            advanced = last_row_dict and is_newer_time(ts, latest_times.get(device_id))
+            if advanced:
+                latest_rows[device_id] = last_row_dict
+                latest_times[device_id] = ts
+                latest_seqs[device_id] = next_latest_seq()
+        if advanced:
+            update_station(device_id, last_row_dict)
+
+
+def encode_csv_row(row) -> bytes:
+    """Encodes one row exactly as csv.writer would write it to the file."""
+    try:
+        line = ",".join(row)   # save_readings passes cells already as strings
+    except TypeError:
+        line = ",".join(["" if value is None else str(value) for value in row])
+    if len(row) > 1 and line.count(",") == len(row) - 1 and not ('"' in line or "\r" in line or "\n" in line):
+        return (line + "\r\n").encode()   # nothing to quote: skip the csv module
+    buf = StringIO()
+    csv.writer(buf).writerow(row)
+    return buf.getvalue().encode()
+
+
+def _line_time(line: bytes):
+    """Epoch time of one encoded CSV row, or None."""
+    return parse_time(next(csv.reader([line.decode(errors="replace")]), [None])[0])
+
+
+def time_ordered(rows: list) -> list:
+    """
+    Sorts (epoch time, encoded row) pairs by time, keeping the order of
+    equal times; a row without a parsable time stays after the row before it.
+    """
+    keyed, last = [], -math.inf
+    for ts, line in rows:
+        last = ts if ts is not None else last
+        keyed.append((last, len(keyed), ts, line))
+    keyed.sort()
+    return [(ts, line) for _, _, ts, line in keyed]
+
+
+@contextmanager
+def file_lock(f):
+    """Exclusive advisory lock on an open file, honoured by every server process."""
+    if fcntl is None:
+        yield
+        return
+    fcntl.flock(f.fileno(), fcntl.LOCK_EX)
+    try:
+        yield
+    finally:
+        fcntl.flock(f.fileno(), fcntl.LOCK_UN)
+
+
+class WriteBehindLog:
+    """
+    Buffers encoded CSV rows per device and appends them through a bounded
+    LRU pool of open file handles, instead of opening and closing the file
+    for every reading. A device's buffer is written out once it holds
+    WRITE_BUFFER_ROWS rows or its oldest row is WRITE_BUFFER_SECONDS old,
+    so a crash loses at most that much. Everything is flushed on shutdown.
+
+    Each flush holds the file's flock while it checks the real file size,
+    writes the header if the file is empty and appends the rows, so server
+    processes sharing DATA_DIR never interleave partial lines or write a
+    second header. Row offsets are only known at that point and are passed
+    to `on_write(device_id, [(epoch time, offset)], end_size, created)`.
+
+    With SEGMENT_ROLLOVER, a row for a later UTC day than the file's newest
+    row first closes the file into a segment (see close_segment), and the
+    row starts a fresh <device_id>_data.csv.
+
+    Readers expect each device's history in time order, so a row older than
+    one already appended for its device is not appended: it is merged into
+    the history where it belongs (see merge_late).
+    """
+
+    def __init__(self, on_write=None):
+        self.lock = threading.RLock()
+        self.handles = OrderedDict()   # {device_id: append handle}, least recently used first
+        self.buffers = {}              # {device_id: [(epoch time or None, encoded row)]}
+        self.buffered_since = {}       # {device_id: monotonic time of oldest buffered row}
+        self.file_days = {}            # {device_id: (inode, UTC day of the newest row in it)}
+        self.newest_times = {}         # {CSV path: newest time appended for its device}
+        self.written_times = {}        # {CSV path: newest time written to it, buffers aside}
+        self.on_write = on_write
+        self.flusher = None
+
+    def append_rows(self, device_id, rows, times=None) -> list:
+        """
+        Buffers CSV-ordered rows of one device; `times` are their parsed times,
+        if known. A row older than the device's newest still goes into the
+        buffer, in time order, if nothing newer was written out yet; older
+        rows are merged into the history instead, and their positions in
+        `rows` are returned.
+        """
+        key = str(device_id)
+        if times is None:
+            times = [parse_time(row[0]) for row in rows]
+        entries = [(ts, encode_csv_row(row)) for ts, row in zip(times, rows)]
+        with self.lock:
+            path = os.path.join(DATA_DIR, f"{key}_data.csv")
+            if path not in self.newest_times:
+                self.newest_times[path] = self.written_times[path] = self._stored_newest(key)
+            previous = newest = self.newest_times[path]
+            written = self.written_times[path]
+            appended, inserted, late = [], [], []
+            for i, (ts, _) in enumerate(entries):
+                if ts is None or newest is None or ts >= newest:
+                    appended.append(entries[i])
+                    newest = ts if ts is not None else newest
+                elif written is None or ts >= written:
+                    inserted.append(i)
+                else:
+                    late.append(i)
+            if late:
+                self.merge_late(key, [entries[i] for i in late])
+            self.newest_times[path] = newest
+            ours = appended + [entries[i] for i in inserted]
+            if not ours:
+                return late
+
+            buf = self.buffers.setdefault(key, [])
+            if not buf:
+                self.buffered_since[key] = time.monotonic()
+            buf.extend(appended)
+            for i in inserted:
+                ts = entries[i][0]
+                at = len(buf)
+                while at and (buf[at - 1][0] is None or buf[at - 1][0] > ts):
+                    at -= 1
+                buf.insert(at, entries[i])
+
+            if len(buf) >= WRITE_BUFFER_ROWS:
+                try:
+                    self._flush(key)
+                except Exception as e:
+                    # Still all buffered means nothing of ours reached the file: take the
+                    # rows back so the caller fails cleanly. Otherwise they count as
+                    # stored and the flusher retries what is left.
+                    buf = self.buffers.get(key, [])
+                    ids = {id(entry) for entry in ours}
+                    if not late and sum(id(entry) in ids for entry in buf) == len(ours):
+                        buf[:] = [entry for entry in buf if id(entry) not in ids]
+                        if not buf:
+                            self.buffers.pop(key, None)
+                            self.buffered_since.pop(key, None)
+                        self.newest_times[path] = previous
+                        raise
+                    print(f"Write to {key}_data.csv failed, will retry: {e}")
+
+        if self.flusher is None:
+            self._start_flusher()
+        return late
+
+    def has_buffered(self, device_id) -> bool:
+        with self.lock:
+            return bool(self.buffers.get(str(device_id)))
+
+    def flush(self, device_id=None):
+        """Writes out the buffer of one device, or of every device."""
+        with self.lock:
+            keys = list(self.buffers) if device_id is None else [str(device_id)]
+            for key in keys:
+                self._flush(key)
+
+    def close(self):
+        """Flushes every buffer and closes all pooled handles."""
+        with self.lock:
+            self.flush()
+            while self.handles:
+                _, f = self.handles.popitem(last=False)
+                f.close()
+
+    def _handle(self, key):
+        f = self.handles.get(key)
+        if f is not None:
+            self.handles.move_to_end(key)
+            return f
+
+        f = open(os.path.join(DATA_DIR, f"{key}_data.csv"), "a+b", buffering=0)
+        self.handles[key] = f
+        while len(self.handles) > MAX_OPEN_FILES:
+            old_key, old_f = self.handles.popitem(last=False)
+            self._write(old_key, old_f)
+            old_f.close()
+        return f
+
+    def _flush(self, key):
+        if self.buffers.get(key):
+            self._write(key, self._handle(key))
+
+    def _write(self, key, f):
+        while self.buffers.get(key):
+            with file_lock(f):
+                current = self._is_current(key, f)
+                if current:
+                    count = self._rollover_point(key, f)
+                    if count:
+                        self._append(key, f, count)
+                    if self.buffers.get(key):
+                        close_segment(key)   # the rest starts a new day
+                        current = False
+            if not current:
+                f = self._reopen(key, f)   # renamed away here or by another process
+
+    def _stored_newest(self, key):
+        """The newest time a device has on disk: its CSV's last row, or else its newest segment's end."""
+        filepath = os.path.join(DATA_DIR, f"{key}_data.csv")
+        if os.path.isfile(filepath):
+            newest = parse_time((read_last_row(filepath) or {}).get("time"))
+            if newest is not None:
+                return newest
+        ends = [e["end"] for e in read_manifest(key) if e["end"] is not None]
+        return max(ends) if ends else None
+
+    def merge_late(self, key, entries):
+        """
+        Merges (epoch time, encoded row) pairs older than every row written to
+        the device's CSV into its history in time order (under self.lock);
+        buffered rows are newer, so they can stay where they are. Rows within
+        the open CSV's time range are merged into it, older ones go to the
+        closed segments (see merge_into_segments).
+        """
+        older = entries
+        if os.path.isfile(os.path.join(DATA_DIR, f"{key}_data.csv")):
+            f = self._handle(key)
+            while True:
+                with file_lock(f):
+                    current = self._is_current(key, f)
+                    if current:
+                        older = self._merge_into_file(key, f, entries)
+                if current:
+                    break
+                f = self._reopen(key, f)
+        if older:
+            merge_into_segments(key, older)
+
+    def _merge_into_file(self, key, f, entries) -> list:
+        """
+        Merges the entries not older than the open CSV's first row into it and
+        returns the rest. Only the rows after the newest one at or before the
+        oldest entry are rewritten, so a row that is just a little late costs
+        a read of the file's tail.
+        """
+        oldest = min(ts for ts, _ in entries)
+        size = os.fstat(f.fileno()).st_size
+        with open(f.name, "rb") as src:
+            body = len(src.readline())
+            chunk = 4096
+            while True:
+                # Complete lines from `begin` on, as [offset, line]; reread with more until a row
+                # at or before `oldest` turns up or the whole file is in
+                begin = max(size - chunk, body)
+                src.seek(begin)
+                data = src.read(size - begin)
+                if begin > body:
+                    skip = data.find(b"\n") + 1
+                    data, begin = data[skip:], begin + skip
+                lines, pos = [], begin
+                for line in data.splitlines(keepends=True):
+                    lines.append((pos, line))
+                    pos += len(line)
+                keep = None
+                for n in range(len(lines) - 1, -1, -1):
+                    ts = _line_time(lines[n][1])
+                    if ts is not None and ts <= oldest:
+                        keep = n
+                        break
+                if keep is not None or begin == body:
+                    break
+                chunk *= 4
+
+        tail = [(_line_time(line), line if line.endswith(b"\n") else line + b"\r\n")
+                for _, line in lines[0 if keep is None else keep + 1:]]
+        if keep is None:
+            # Nothing in the file is that old: rows older than its first one go elsewhere
+            start = next((ts for ts, _ in tail if ts is not None), None)
+            if start is None:
+                return entries
+            older = [entry for entry in entries if entry[0] < start]
+            entries = [entry for entry in entries if entry[0] >= start]
+            if not entries:
+                return older
+        else:
+            older = []
+
+        cut = lines[keep + 1][0] if keep is not None and keep + 1 < len(lines) else (
+            size if keep is not None else begin)
+        pos = cut
+        placed, chunks = [], []
+        for ts, line in time_ordered(tail + entries):
+            placed.append((ts, pos))
+            chunks.append(line)
+            pos += len(line)
+        data = memoryview(b"".join(chunks))
+        with open(f.name, "r+b", buffering=0) as dst:   # `f` appends wherever it writes
+            dst.seek(cut)
+            while data:   # never shorter than what it overwrites
+                data = data[dst.write(data):]
+            if FSYNC_POLICY == "flush":
+                os.fsync(dst.fileno())
+        if self.on_write is not None:
+            self.on_write(key, placed, pos, False, cut)
+        return older
+
+    def _is_current(self, key, f) -> bool:
+        """True if <device_id>_data.csv is still the file `f` has open."""
+        try:
+            return os.stat(os.path.join(DATA_DIR, f"{key}_data.csv")).st_ino == os.fstat(f.fileno()).st_ino
+        except FileNotFoundError:
+            return False
+
+    def _reopen(self, key, f):
+        f.close()
+        self.handles.pop(key, None)
+        return self._handle(key)
+
+    def _rollover_point(self, key, f) -> int:
+        """Returns how many buffered rows still belong in the open file (all without rollover)."""
+        buf = self.buffers[key]
+        if not SEGMENT_ROLLOVER:
+            return len(buf)
+
+        inode = os.fstat(f.fileno()).st_ino
+        cached = self.file_days.get(key)
+        if cached is not None and cached[0] == inode:
+            day = cached[1]
+        else:
+            last = read_last_row(f.name) if os.fstat(f.fileno()).st_size else None
+            day = utc_day(parse_time(last.get("time"))) if last else None
+
+        for i, (ts, _) in enumerate(buf):
+            row_day = utc_day(ts)
+            if row_day is None:
+                continue
+            if day is not None and row_day > day:
+                self.file_days[key] = (inode, day)
+                return i
+            day = row_day if day is None else max(day, row_day)
+        self.file_days[key] = (inode, day)
+        return len(buf)
+
+    def _append(self, key, f, count: int):
+        """Appends the first `count` buffered rows (file lock held)."""
+        buf = self.buffers[key]
+        size = os.fstat(f.fileno()).st_size
+        chunks = []
+        if size == 0:
+            chunks.append(encode_csv_row(CSV_HEADERS))  # Write header only once
+        elif os.pread(f.fileno(), 1, size - 1) != b"\n":
+            chunks.append(b"\r\n")   # a crashed writer left half a line: keep ours separate
+
+        pos = size + sum(len(chunk) for chunk in chunks)
+        placed = []
+        newest = self.written_times.get(f.name)
+        for ts, line in buf[:count]:
+            placed.append((ts, pos))
+            chunks.append(line)
+            pos += len(line)
+            if ts is not None and (newest is None or ts > newest):
+                newest = ts
+
+        data = memoryview(b"".join(chunks))
+        while data:
+            data = data[f.write(data):]
+        if FSYNC_POLICY == "flush":
+            os.fsync(f.fileno())
+        self.written_times[f.name] = newest
+        del buf[:count]
+        if not buf:
+            del self.buffers[key]
+            self.buffered_since.pop(key, None)
+
+        if self.on_write is not None:
+            self.on_write(key, placed, pos, size == 0)
+
+    def _start_flusher(self):
+        with self.lock:
+            if self.flusher is not None:
+                return
+            self.flusher = threading.Thread(target=self._flush_loop, daemon=True)
+            self.flusher.start()
+
+    def _flush_loop(self):
+        while True:
+            time.sleep(WRITE_BUFFER_SECONDS / 2)
+            try:
+                with self.lock:
+                    now = time.monotonic()
+                    for key, since in list(self.buffered_since.items()):
+                        if now - since >= WRITE_BUFFER_SECONDS:
+                            self._flush(key)
+            except Exception as e:
+                print(f"Write-behind flush failed: {e}")
+
+
+def after_csv_write(device_id: str, placed, end_size: int, created: bool, cut=None):
+    """WriteBehindLog callback: indexes the rows just written (still under the file lock)."""
+    record_index_rows(device_id, placed, created, cut)
+    with latest_lock:
+        latest_file_sizes[device_id] = end_size
+
+
+csv_log = WriteBehindLog(on_write=after_csv_write)
+atexit.register(lambda: save_warm_start())   # registered first, so it runs after the final flushes
+atexit.register(csv_log.close)
+
+
+def segment_dir(device_id) -> str:
+    return os.path.join(DATA_DIR, "segments", str(device_id))
+
+
+def _load_manifest(device_id) -> dict:
+    try:
+        with open(os.path.join(segment_dir(device_id), "manifest.json")) as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return {"segments": []}
+
+
+def _save_manifest(device_id, manifest: dict):
+    path = os.path.join(segment_dir(device_id), "manifest.json")
+    with open(path + ".tmp", "w") as f:
+        json.dump(manifest, f, indent=1)
+    os.replace(path + ".tmp", path)
+
+
+def read_manifest(device_id) -> list:
+    """Returns the closed segments of a device, oldest first, as manifest entries."""
+    return _load_manifest(device_id)["segments"]
+
+
+def write_manifest(device_id, entries: list, retired=()):
+    """
+    Replaces the device's segment list (under manifest_lock). Files that no
+    longer appear in it go in `retired`: a reader may still be working from
+    the old list, so they are only deleted SEGMENT_RETIRE_SECONDS later, by
+    drop_retired_segments.
+    """
+    entries.sort(key=lambda e: (e["start"] is None, e["start"] or 0, e["file"]))
+    now = time.time()
+    pending = _load_manifest(device_id).get("retired", []) + [{"file": name, "at": now} for name in retired]
+    _save_manifest(device_id, {"segments": entries, "retired": pending})
+
+
+def drop_retired_segments(device_id):
+    """Deletes the device's segment files retired more than SEGMENT_RETIRE_SECONDS ago."""
+    cutoff = time.time() - SEGMENT_RETIRE_SECONDS
+    with manifest_lock(device_id):
+        manifest = _load_manifest(device_id)
+        due = [r for r in manifest.get("retired", []) if r["at"] < cutoff]
+        if not due:
+            return
+        manifest["retired"] = [r for r in manifest["retired"] if r not in due]
+        _save_manifest(device_id, manifest)
+    for retired in due:
+        try:
+            os.remove(os.path.join(segment_dir(device_id), retired["file"]))
+        except FileNotFoundError:
+            pass
+
+
+@contextmanager
+def manifest_lock(device_id):
+    """Serialises manifest updates of one device across threads and server processes."""
+    os.makedirs(segment_dir(device_id), exist_ok=True)
+    with open(os.path.join(segment_dir(device_id), ".lock"), "a") as f, file_lock(f):
+        yield
+
+
+def _segment_time_range(filepath: str):
+    """
+    Rough (start, end) of a CSV about to be closed: its first parsable time
+    and its last row's. Only the head and tail are read, since this runs
+    under WriteBehindLog's lock; sealing records the exact min/max.
+    """
+    first = None
+    for _, row in iter_csv_rows(filepath):
+        first = parse_time(row.get("time"))
+        if first is not None:
+            break
+    last = parse_time((read_last_row(filepath) or {}).get("time"))
+    return first, last if last is not None else first
+
+
+def close_segment(device_id: str):
+    """
+    Moves <device_id>_data.csv into the device's segment directory and lists
+    it in the manifest (called by WriteBehindLog with the CSV's lock held).
+    It stays a plain CSV until the maintainer seals it.
+    """
+    filepath = os.path.join(DATA_DIR, f"{device_id}_data.csv")
+    first, last = _segment_time_range(filepath)
+    name = f"closed-{time.time_ns()}.csv"
+    with manifest_lock(device_id):
+        entries = read_manifest(device_id)
+        entries.append({"file": name, "start": first, "end": last, "rows": None,
+                        "bytes": os.path.getsize(filepath), "sealed": False})
+        os.rename(filepath, os.path.join(segment_dir(device_id), name))
+        write_manifest(device_id, entries)
+    try:
+        os.remove(index_path(device_id))
+    except FileNotFoundError:
+        pass
+    start_segment_maintainer()
+    segment_work.set()
+
+
+def merge_into_segments(device_id: str, entries: list):
+    """
+    Merges (epoch time, encoded row) pairs older than the device's open CSV
+    with the closed segments whose time range they overlap, into one new
+    closed segment that the maintainer seals like any other.
+    """
+    times = [ts for ts, _ in entries]
+    lo, hi = min(times), max(times)
+    name = f"closed-{time.time_ns()}.csv"
+    with manifest_lock(device_id):
+        manifest = read_manifest(device_id)
+        merged = [e for e in manifest if e["start"] is not None and e["end"] is not None
+                  and e["start"] <= hi and e["end"] >= lo]
+        rows = []
+        for entry in merged:
+            with open_segment(device_id, entry["file"]) as f:
+                f.readline()   # header
+                rows.extend((_line_time(line.encode()), line.encode()) for line in f)
+        rows = time_ordered(rows + entries)
+
+        data = b"".join([encode_csv_row(CSV_HEADERS)] + [line for _, line in rows])
+        with open(os.path.join(segment_dir(device_id), name), "wb") as f:
+            f.write(data)
+        times = [ts for ts, _ in rows if ts is not None]
+        manifest = [e for e in manifest if e not in merged]
+        manifest.append({"file": name, "start": min(times), "end": max(times), "rows": len(rows),
+                         "bytes": len(data), "sealed": False})
+        write_manifest(device_id, manifest, [entry["file"] for entry in merged])
+    start_segment_maintainer()
+    segment_work.set()
+
+
+def open_segment(device_id, name: str):
+    """Opens a segment for reading as text."""
+    path = os.path.join(segment_dir(device_id), name)
+    if name.endswith(".gz"):
+        return gzip.open(path, "rt", newline="")
+    return open(path, newline="")
+
+
+def iter_segment_files(device_id, start=None, end=None):
+    """
+    Yields the device's closed segments that overlap [start, end], oldest
+    first, each open for reading. A segment replaced after the manifest was
+    read stays on disk for SEGMENT_RETIRE_SECONDS (see write_manifest); one
+    already deleted is looked up in the new manifest, which lists the files
+    that replaced it. Unsealed segments only have a rough time range
+    (see _segment_time_range), so they are always read.
+    """
+    done = set()
+    entries = read_manifest(device_id)
+    while entries:
+        entry = entries.pop(0)
+        if entry["file"] in done:
+            continue
+        if entry["sealed"] and start is not None and entry["end"] is not None and entry["end"] < start:
+            continue
+        if entry["sealed"] and end is not None and entry["start"] is not None and entry["start"] > end:
+            continue
+        try:
+            f = open_segment(device_id, entry["file"])
+        except FileNotFoundError:
+            entries = [e for e in read_manifest(device_id) if e["file"] not in done]
+            if entry in entries:
+                raise   # still listed: the file really is missing
+            continue
+        done.add(entry["file"])
+        with f:
+            yield f
+
+
+def iter_device_files(device_id):
+    """Yields a device's closed segments, then its <device_id>_data.csv, each open for reading."""
+    yield from iter_segment_files(device_id)
+    with open(os.path.join(DATA_DIR, f"{device_id}_data.csv"), newline="") as f:
+        yield f
+
+
+def iter_segment_rows(device_id, start=None, end=None):
+    """Yields the rows of the device's closed segments with start <= time <= end."""
+    for f in iter_segment_files(device_id, start, end):
+        reader = csv.reader(f)
+        keys = next(reader, [])
+        for values in reader:
+            row = dict(zip(keys, values))
+            ts = parse_time(row.get("time"))
+            if ts is None or (start is not None and ts < start) or (end is not None and ts > end):
+                continue   # a segment is read to its end: only its min/max are known
+            yield row
+
+
+def _segment_name(directory: str, day, taken: set) -> str:
+    base = time.strftime("%Y-%m-%d", time.gmtime(day * 86400)) if day is not None else "unknown"
+    suffix = ".csv.gz" if SEGMENT_COMPRESS else ".csv"
+    name, n = base + suffix, 1
+    while name in taken or os.path.exists(os.path.join(directory, name)):
+        name, n = f"{base}.{n}{suffix}", n + 1
+    taken.add(name)
+    return name
+
+
+def seal_segment(device_id, entry: dict) -> list:
+    """
+    Splits a closed segment into one file per UTC day (rows without a
+    parsable time stay with their neighbours), gzipped with SEGMENT_COMPRESS.
+    Returns the manifest entries of the new files.
+    """
+    directory = segment_dir(device_id)
+    taken = set()
+    sealed = []
+    out = None   # [file, tmp path, min time, max time, rows, bytes, day]
+
+    def finish():
+        if out is not None:
+            out[0].close()
+            name = _segment_name(directory, utc_day(out[2]), taken)
+            os.replace(out[1], os.path.join(directory, name))
+            sealed.append({"file": name, "start": out[2], "end": out[3],
+                           "rows": out[4], "bytes": out[5], "sealed": True})
+
+    with open_segment(device_id, entry["file"]) as f:
+        header = f.readline()
+        for line in f:
+            ts = parse_time(next(csv.reader([line]), [None])[0])
+            day = utc_day(ts)
+            if out is None or (day is not None and out[6] is not None and day != out[6]):
+                finish()
+                tmp = os.path.join(directory, f".sealing-{len(sealed)}.tmp")
+                dst = (gzip.open if SEGMENT_COMPRESS else open)(tmp, "wt", newline="")
+                dst.write(header)
+                out = [dst, tmp, None, None, 0, len(header), day]
+            out[0].write(line)
+            if ts is not None:
+                out[2] = ts if out[2] is None else min(out[2], ts)
+                out[3] = ts if out[3] is None else max(out[3], ts)
+                out[6] = day
+            out[4] += 1
+            out[5] += len(line)
+    finish()
+    return sealed
+
+
+def maintain_segments(device_id):
+    """Seals the device's closed segments and drops the ones past retention."""
+    drop_retired_segments(device_id)
+    for entry in read_manifest(device_id):
+        if entry["sealed"]:
+            continue
+        with manifest_lock(device_id):
+            entries = read_manifest(device_id)
+            if entry not in entries:
+                continue   # another process got there first
+            sealed = seal_segment(device_id, entry)
+            entries.remove(entry)
+            write_manifest(device_id, entries + sealed, [entry["file"]])
+
+    days = DEVICE_RETENTION_DAYS.get(device_id, RETENTION_DAYS)
+    if days is None:
+        return
+    cutoff = time.time() - days * 86400
+    with manifest_lock(device_id):
+        entries = read_manifest(device_id)
+        expired = [e for e in entries if e["sealed"] and e["end"] is not None and e["end"] < cutoff]
+        if expired:
+            write_manifest(device_id, [e for e in entries if e not in expired], [e["file"] for e in expired])
+
+
+segment_work = threading.Event()
+segment_maintainer = None
+segment_maintainer_lock = threading.Lock()
+
+
+def segment_maintainer_loop():
+    while True:
+        segment_work.wait(SEGMENT_CHECK_SECONDS)
+        segment_work.clear()
+        root = os.path.join(DATA_DIR, "segments")
+        for device_id in sorted(os.listdir(root)) if os.path.isdir(root) else []:
+            try:
+                maintain_segments(device_id)
+            except Exception as e:
+                print(f"Segment maintenance failed for device {device_id}: {e}")
+
+
+def start_segment_maintainer():
+    global segment_maintainer
+    with segment_maintainer_lock:
+        if segment_maintainer is None or not segment_maintainer.is_alive():
+            segment_maintainer = threading.Thread(target=segment_maintainer_loop, daemon=True)
+            segment_maintainer.start()
+
+columnar = None
+if COLUMNAR_STORE:
+    from Columnar_store import ColumnarStore
+    columnar = ColumnarStore(os.path.join(DATA_DIR, "columnar"), parse_time)
+    atexit.register(columnar.flush)
+
+
+# One record per (partial) bucket: start, then min, max, sum, count per field.
+# A bucket can be split over several records (e.g. across a restart, or when
+# older rows arrive after it was written); readers merge records with the
+# same start. Records are kept sorted by start (see _write_rollup_records);
+# readers still tolerate files up to ROLLUP_SCAN_SLACK records out of order.
+ROLLUP_RECORD = struct.Struct("<q" + "dddI" * len(ROLLUP_FIELDS))
+
+open_rollups = {}   # {device_id: {resolution: [bucket_start, {field: [min, max, sum, count]}]}}
+# Live rows of each device's newest step, not yet in open_rollups:
+# {device_id: [step_start, [_reading_values]]}. They are folded into the
+# buckets a step at a time, which keeps the ingest path to one append.
+pending_rollups = {}
+ROLLUP_STEP = min(ROLLUP_RESOLUTIONS.values())   # every resolution is a multiple of it
+# Buckets closed but not yet written, oldest first: [(rollup_path, start,
+# stats)]. They are written out ROLLUP_WRITE_RECORDS at a time, outside
+# rollup_lock; read_rollups merges them like the open buckets.
+closed_rollups = []
+rollup_lock = threading.Lock()
+rollup_write_lock = threading.Lock()   # held while closed buckets move to the files
+
+
+def rollup_path(device_id, resolution: str) -> str:
+    return os.path.join(DATA_DIR, f"{device_id}_rollup_{resolution}.bin")
+
+
+def _empty_stats() -> dict:
+    return {field: [math.inf, -math.inf, 0.0, 0] for field in ROLLUP_FIELDS}
+
+
+def _reading_values(reading: dict) -> dict:
+    """Returns {field: float} for the numeric rollup fields of a reading or CSV row."""
+    values = {}
+    for field in ROLLUP_FIELDS:
+        try:
+            value = float(reading.get(field))
+        except (TypeError, ValueError):
+            continue
+        if math.isfinite(value):
+            values[field] = value
+    return values
+
+
+def _add_values(bucket_stats: dict, values: dict):
+    for field, value in values.items():
+        stats = bucket_stats[field]
+        if value < stats[0]:
+            stats[0] = value
+        if value > stats[1]:
+            stats[1] = value
+        stats[2] += value
+        stats[3] += 1
+
+
+def _merge_stats(target: dict, stats: dict):
+    for field in ROLLUP_FIELDS:
+        a, b = target[field], stats[field]
+        target[field] = [min(a[0], b[0]), max(a[1], b[1]), a[2] + b[2], a[3] + b[3]]
+
+
+def _pack_rollup(start: int, stats: dict) -> bytes:
+    flat = []
+    for field in ROLLUP_FIELDS:
+        flat.extend(stats[field])
+    return ROLLUP_RECORD.pack(start, *flat)
+
+
+def _unpack_rollup(record) -> dict:
+    return {field: list(record[1 + 4 * n: 5 + 4 * n]) for n, field in enumerate(ROLLUP_FIELDS)}
+
+
+def _write_rollup_records(path: str, records: list):
+    """
+    Adds (start, stats) records to a rollup file under its flock, keeping
+    the file sorted by start. Records no older than its last one are
+    appended; otherwise the file is rewritten from ROLLUP_SCAN_SLACK records
+    before the first one they go ahead of, merging records with equal starts.
+    """
+    records = sorted(records, key=lambda record: record[0])
+    with open(os.open(path, os.O_RDWR | os.O_CREAT, 0o666), "r+b") as f, file_lock(f):
+        count = os.fstat(f.fileno()).st_size // ROLLUP_RECORD.size   # a torn record gets overwritten
+        if count and _read_rollup_record(f, count - 1)[0] > records[0][0]:
+            lo, hi = 0, count
+            while lo < hi:
+                mid = (lo + hi) // 2
+                if _read_rollup_record(f, mid)[0] < records[0][0]:
+                    lo = mid + 1
+                else:
+                    hi = mid
+            count = max(lo - ROLLUP_SCAN_SLACK, 0)
+            f.seek(count * ROLLUP_RECORD.size)
+            merged = {}
+            for record in ROLLUP_RECORD.iter_unpack(f.read()):
+                _merge_stats(merged.setdefault(record[0], _empty_stats()), _unpack_rollup(record))
+            for start, stats in records:
+                _merge_stats(merged.setdefault(start, _empty_stats()), stats)
+            records = sorted(merged.items())
+        f.seek(count * ROLLUP_RECORD.size)
+        f.write(b"".join(_pack_rollup(start, stats) for start, stats in records))
+        f.truncate()
+
+
+def write_closed_rollups():
+    """Writes the buckets closed so far to their rollup files."""
+    with rollup_write_lock:
+        with rollup_lock:
+            if not closed_rollups:
+                return
+            records = closed_rollups[:]
+            del closed_rollups[:]
+        by_file = {}
+        for path, start, stats in records:
+            by_file.setdefault(path, []).append((start, stats))
+        for path, file_records in by_file.items():
+            _write_rollup_records(path, file_records)
+
+
+def _add_to_rollups(device_id: str, ts: float, values: dict, resume=None):
+    """
+    Folds one row into the open bucket of every resolution (under rollup_lock).
+    A bucket is written out when a row for a later bucket arrives. With
+    `resume` ({resolution: epoch}), resolutions already persisted up to that
+    point are skipped; it is used when replaying the CSV at startup.
+    """
+    device_rollups = open_rollups.setdefault(device_id, {})
+    for resolution, seconds in ROLLUP_RESOLUTIONS.items():
+        if resume is not None and resume[resolution] is not None and ts < resume[resolution]:
+            continue
+
+        _add_values(_open_bucket(device_id, device_rollups, resolution, ts), values)
+
+
+def _open_bucket(device_id: str, device_rollups: dict, resolution: str, ts: float) -> dict:
+    """Returns the stats of the open bucket holding `ts`, closing the one it replaces."""
+    seconds = ROLLUP_RESOLUTIONS[resolution]
+    bucket = device_rollups.get(resolution)
+    if bucket is None or not bucket[0] <= ts < bucket[0] + seconds:
+        if bucket is not None:
+            # Rows older than the open bucket still count, in a record of their own
+            closed_rollups.append((rollup_path(device_id, resolution), bucket[0], bucket[1]))
+        bucket = device_rollups[resolution] = [int(ts // seconds * seconds), _empty_stats()]
+    return bucket[1]
+
+
+def _pending_stats(rows: list) -> dict:
+    stats = {}
+    for field in ROLLUP_FIELDS:
+        values = [row[field] for row in rows if field in row]
+        stats[field] = ([min(values), max(values), sum(values), len(values)] if values
+                        else [math.inf, -math.inf, 0.0, 0])
+    return stats
+
+
+def _fold_pending(device_id: str):
+    """Folds a device's pending step into its open buckets (under rollup_lock)."""
+    pending = pending_rollups.pop(device_id, None)
+    if pending is None:
+        return
+    start, rows = pending
+    device_rollups = open_rollups.setdefault(device_id, {})
+    step_stats = _pending_stats(rows)
+    for resolution in ROLLUP_RESOLUTIONS:
+        bucket_stats = _open_bucket(device_id, device_rollups, resolution, start)
+        for field, (lo, hi, total, n) in step_stats.items():
+            stats = bucket_stats[field]
+            stats[0], stats[1] = min(stats[0], lo), max(stats[1], hi)
+            stats[2] += total
+            stats[3] += n
+
+
+def _close_late_rows(device_id: str, rows: list):
+    """
+    Turns (epoch time, _reading_values) rows older than a device's pending
+    step into closed records of their own, leaving its open buckets alone
+    (under rollup_lock).
+    """
+    for resolution, seconds in ROLLUP_RESOLUTIONS.items():
+        buckets = {}
+        for ts, values in rows:
+            _add_values(buckets.setdefault(int(ts // seconds * seconds), _empty_stats()), values)
+        path = rollup_path(device_id, resolution)
+        closed_rollups.extend((path, start, stats) for start, stats in sorted(buckets.items()))
+
+
+def update_rollups(stored: list):
+    """Adds freshly saved readings to the rollups; `stored` is as in save_batch."""
+    with rollup_lock:
+        for device_id, _, times, _, values in stored:
+            key = str(device_id)
+            if MULTI_PROCESS:
+                # Another process may write this device next: keep nothing open
+                for ts, reading_values in zip(times, values):
+                    if ts is not None:
+                        _add_to_rollups(key, ts, reading_values)
+                for resolution, (start, stats) in open_rollups.pop(key, {}).items():
+                    closed_rollups.append((rollup_path(key, resolution), start, stats))
+                continue
+
+            pending = pending_rollups.get(key)
+            late = []
+            for ts, reading_values in zip(times, values):
+                if ts is None:
+                    continue
+                if pending is not None and ts < pending[0]:
+                    late.append((ts, reading_values))
+                    continue
+                if pending is None or ts >= pending[0] + ROLLUP_STEP:
+                    _fold_pending(key)
+                    pending = pending_rollups[key] = [int(ts // ROLLUP_STEP * ROLLUP_STEP), []]
+                pending[1].append(reading_values)
+            if late:
+                _close_late_rows(key, late)
+    if MULTI_PROCESS or len(closed_rollups) >= ROLLUP_WRITE_RECORDS:
+        write_closed_rollups()
+
+
+def persist_open_rollups():
+    """Writes out every open bucket (runs at exit, so no partial bucket is lost)."""
+    with rollup_lock:
+        for device_id in list(pending_rollups):
+            _fold_pending(device_id)
+        for device_id, device_rollups in open_rollups.items():
+            for resolution, (start, stats) in device_rollups.items():
+                closed_rollups.append((rollup_path(device_id, resolution), start, stats))
+        open_rollups.clear()
+    write_closed_rollups()
+
+
+atexit.register(persist_open_rollups)
+
+
+def _read_rollup_record(f, i: int):
+    f.seek(i * ROLLUP_RECORD.size)
+    return ROLLUP_RECORD.unpack(f.read(ROLLUP_RECORD.size))
+
+
+def read_rollup_file(path: str, start, end, merge):
+    """
+    Calls merge(start, stats) for every record of a rollup file with
+    start <= bucket start <= end. Records are sorted by start (give or take
+    ROLLUP_SCAN_SLACK records), so the first one is found by bisection.
+    """
+    if not os.path.isfile(path):
+        return
+    with open(path, "rb") as f:
+        count = os.path.getsize(path) // ROLLUP_RECORD.size
+        lo, hi = 0, count
+        if start is not None:
+            while lo < hi:
+                mid = (lo + hi) // 2
+                if _read_rollup_record(f, mid)[0] < start:
+                    lo = mid + 1
+                else:
+                    hi = mid
+        past_end = 0
+        for i in range(max(lo - ROLLUP_SCAN_SLACK, 0), count):
+            record = _read_rollup_record(f, i)
+            if end is not None and record[0] > end:
+                past_end += 1
+                if past_end >= ROLLUP_SCAN_SLACK:
+                    break
+                continue
+            past_end = 0
+            if start is not None and record[0] < start:
+                continue
+            merge(record[0], _unpack_rollup(record))
+
+
+def read_rollups(device_id: str, resolution: str, start=None, end=None, fields=ROLLUP_FIELDS):
+    """
+    Returns the merged buckets of one device and resolution with
+    start <= bucket start <= end, oldest first, as
+    [{"time": ..., field: {"min", "max", "mean", "count"}}, ...].
+    """
+    merged = {}
+    seconds = ROLLUP_RESOLUTIONS[resolution]
+
+    def merge(bucket_start, stats):
+        _merge_stats(merged.setdefault(bucket_start, _empty_stats()), stats)
+
+    path = rollup_path(device_id, resolution)
+    with rollup_write_lock:   # a bucket is either in the file or still in memory
+        read_rollup_file(path, start, end, merge)
+        live = []
+        with rollup_lock:
+            for closed_path, bucket_start, stats in closed_rollups:
+                if closed_path == path:
+                    live.append((bucket_start, stats))   # no longer changed once closed
+            bucket = open_rollups.get(device_id, {}).get(resolution)
+            if bucket is not None:
+                live.append((bucket[0], {k: list(v) for k, v in bucket[1].items()}))
+            pending = pending_rollups.get(device_id)
+            if pending is not None:
+                live.append((pending[0] // seconds * seconds, _pending_stats(pending[1])))
+    for bucket_start, stats in live:
+        if (start is None or bucket_start >= start) and (end is None or bucket_start <= end):
+            merge(bucket_start, stats)
+
+    buckets = []
+    for bucket_start in sorted(merged):
+        entry = {
+            "time": time.strftime("%Y-%m-%d %H:%M:%S", time.gmtime(bucket_start)),
+            "epoch": bucket_start
+        }
+        for field in fields:
+            lo_v, hi_v, total, n = merged[bucket_start][field]
+            entry[field] = (
+                {"min": lo_v, "max": hi_v, "mean": total / n, "count": n} if n else None
+            )
+        buckets.append(entry)
+    return buckets
+
+
+def replay_device_rollups(device_id: str) -> dict:
+    """
+    Brings a device's rollups up to date with its CSV and returns its open
+    buckets (taken out of open_rollups). Only the rows after the last
+    persisted bucket of each resolution are replayed, so a normal restart
+    reads at most one day of data and a missing rollup file is rebuilt from
+    the whole history.
+    """
+    resume = {}
+    for resolution, seconds in ROLLUP_RESOLUTIONS.items():
+        resume[resolution] = None
+        path = rollup_path(device_id, resolution)
+        count = os.path.getsize(path) // ROLLUP_RECORD.size if os.path.isfile(path) else 0
+        if count:
+            os.truncate(path, count * ROLLUP_RECORD.size)   # drop a torn last record
+            with open(path, "rb") as f:
+                last = max(_read_rollup_record(f, i)[0]
+                           for i in range(max(count - ROLLUP_SCAN_SLACK, 0), count))
+            resume[resolution] = last + seconds
+
+    earliest = None if None in resume.values() else min(resume.values())
+    with rollup_lock:
+        try:
+            for row in iter_history(device_id, earliest):
+                _add_to_rollups(device_id, parse_time(row.get("time")),
+                                _reading_values(row), resume)
+        finally:
+            buckets = open_rollups.pop(device_id, {})
+    write_closed_rollups()
+    return buckets
+
+
+station_positions = {}   # {device_id_str: (lon, lat)} from each device's latest row
+station_grid = {}        # {(cell_x, cell_y): set of device_id_str}
+station_lock = threading.Lock()
+
+
+def _row_position(row: dict):
+    """(lon, lat) of a /latest row, or None without a usable GPS fix."""
+    try:
+        lon, lat = float(row.get("longitude")), float(row.get("latitude"))
+    except (TypeError, ValueError):
+        return None
+    if not (-180 <= lon <= 180 and -90 <= lat <= 90) or (lon == 0 and lat == 0):
+        return None
+    return lon, lat
+
+
+def _grid_cell(lon: float, lat: float):
+    return int(math.floor(lon / GRID_CELL_DEGREES)), int(math.floor(lat / GRID_CELL_DEGREES))
+
+
+def update_station(device_id, row: dict):
+    """Moves a device to the position of its newest row (kept as is while it has no fix)."""
+    key = str(device_id)
+    position = _row_position(row)
+    if position is None:
+        return
+    with station_lock:
+        old = station_positions.get(key)
+        if old == position:
+            return
+        if old is not None:
+            cell = station_grid[_grid_cell(*old)]
+            cell.discard(key)
+            if not cell:
+                del station_grid[_grid_cell(*old)]
+        station_positions[key] = position
+        station_grid.setdefault(_grid_cell(*position), set()).add(key)
+
+
+def rebuild_station_index():
+    """Fills the spatial grid from `latest_rows`."""
+    with latest_lock:
+        rows = dict(latest_rows)
+    with station_lock:
+        station_positions.clear()
+        station_grid.clear()
+    for device_id, row in rows.items():
+        update_station(device_id, row)
+
+
+def stations_in_bbox(min_lon: float, min_lat: float, max_lon: float, max_lat: float):
+    """
+    Returns the IDs of the stations inside the box, visiting only the grid
+    cells it covers (or only the occupied ones, when there are fewer).
+    A box with min_lon > max_lon crosses the antimeridian.
+    """
+    if min_lon > max_lon:
+        return (stations_in_bbox(min_lon, min_lat, 180, max_lat)
+                + stations_in_bbox(-180, min_lat, max_lon, max_lat))
+
+    (x0, y0), (x1, y1) = _grid_cell(min_lon, min_lat), _grid_cell(max_lon, max_lat)
+    found = []
+    with station_lock:
+        if (x1 - x0 + 1) * (y1 - y0 + 1) <= len(station_grid):
+            cells = [(x, y) for x in range(x0, x1 + 1) for y in range(y0, y1 + 1)]
+        else:
+            cells = [cell for cell in station_grid if x0 <= cell[0] <= x1 and y0 <= cell[1] <= y1]
+        for cell in cells:
+            for device_id in station_grid.get(cell, ()):
+                lon, lat = station_positions[device_id]
+                if min_lon <= lon <= max_lon and min_lat <= lat <= max_lat:
+                    found.append(device_id)
+    return found
+
+
+def _ring_of(cell, cx: int, cy: int, columns: int) -> int:
+    """How many rings out from (cx, cy) a cell is; longitude wraps around at ±180°."""
+    dx = abs(cell[0] - cx) % columns
+    return max(min(dx, columns - dx), abs(cell[1] - cy))
+
+
+def nearest_stations(lat: float, lon: float, k: int):
+    """
+    Returns [(distance_km, device_id)] of the k stations closest to the
+    point, nearest first. Grid rings around the point's cell are searched
+    outwards (across the antimeridian too) until nothing outside them can
+    beat the k-th best so far.
+    """
+    cx, cy = _grid_cell(lon, lat)
+    columns = round(360 / GRID_CELL_DEGREES)
+    with station_lock:
+        if not station_grid:
+            return []
+        reach = max(_ring_of(cell, cx, cy, columns) for cell in station_grid)
+        best = []
+        for r in range(reach + 1):
+            if 8 * r >= len(station_grid):
+                # The ring has more cells than there are occupied ones: finish on those
+                ring = [cell for cell in station_grid if _ring_of(cell, cx, cy, columns) >= r]
+            else:
+                # Cells across ±180° have x values a whole turn away
+                ring = {(x + turn, y) for x in range(cx - r, cx + r + 1) for y in range(cy - r, cy + r + 1)
+                        for turn in (-columns, 0, columns)}
+                ring = [cell for cell in ring if _ring_of(cell, cx, cy, columns) == r]
+            for cell in ring:
+                for device_id in station_grid.get(cell, ()):
+                    s_lon, s_lat = station_positions[device_id]
+                    best.append((distance_km(lat, lon, s_lat, s_lon), device_id))
+            best.sort()
+            del best[k:]
+            if 8 * r >= len(station_grid):
+                break
+
+            # Anything beyond ring r is at least r cells away in latitude or longitude
+            span = math.radians(r * GRID_CELL_DEGREES)
+            widest = min(90.0, abs(lat) + r * GRID_CELL_DEGREES)
+            bound = EARTH_RADIUS_KM * span * min(1.0, math.cos(math.radians(widest)))
+            if len(best) >= k and best[-1][0] <= bound:
+                break
+    return best
+
+
+class StreamClient:
+    """One /stream subscriber: a bounded event queue plus its device filter."""
+
+    def __init__(self, devices=None):
+        self.devices = devices            # set of device ID strings, or None for all
+        self.events = queue.Queue(maxsize=STREAM_CLIENT_QUEUE)
+        self.dropped = False
+
+    def wants(self, device_id: str) -> bool:
+        return self.devices is None or device_id in self.devices
+
+
+stream_clients = set()
+stream_lock = threading.Lock()
+stream_event_id = 0
+
+
+def publish_reading(device_id, row: dict):
+    """Pushes a device's new /latest row to every subscribed /stream client."""
+    global stream_event_id
+    if not stream_clients:
+        return   # nobody is listening (checked again under the lock)
+    key = str(device_id)
+    with stream_lock:
+        if not stream_clients:
+            return
+        stream_event_id += 1
+        event = (stream_event_id, json.dumps({key: row}))
+        clients = [client for client in stream_clients if client.wants(key)]
+
+    for client in clients:
+        try:
+            client.events.put_nowait(event)
+        except queue.Full:
+            client.dropped = True
+
+
+def stream_events(client: StreamClient):
+    """
+    SSE generator for one client: a snapshot, then readings as they arrive,
+    with heartbeats. The client is only subscribed once the response body is
+    read, so a request that never reads it (e.g. HEAD) leaves nothing behind.
+    """
+    with stream_lock:
+        stream_clients.add(client)
+    try:
+        with latest_lock:
+            snapshot = {device_id: row for device_id, row in latest_rows.items()
+                        if client.wants(device_id)}
+        if snapshot:
+            yield f"event: snapshot\ndata: {json.dumps(snapshot)}\n\n"
+        while not client.dropped:
+            try:
+                event_id, data = client.events.get(timeout=STREAM_HEARTBEAT_SECONDS)
+            except queue.Empty:
+                yield ": heartbeat\n\n"
+                continue
+            yield f"id: {event_id}\nevent: reading\ndata: {data}\n\n"
+    finally:
+        with stream_lock:
+            stream_clients.discard(client)
+
+
+class Histogram:
+    """Cumulative-bucket latency histogram rendered in Prometheus text format."""
+
+    def __init__(self, buckets=LATENCY_BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)   # last slot is +Inf
+        self.total = 0.0
+        self.lock = threading.Lock()
+
+    def observe(self, value: float):
+        i = bisect.bisect_left(self.buckets, value)
+        with self.lock:
+            self.counts[i] += 1
+            self.total += value
+
+    def render(self, name: str, labels: str = "") -> list:
+        with self.lock:
+            counts, total = list(self.counts), self.total
+        sep = "," if labels else ""
+        lines, cumulative = [], 0
+        for bound, count in zip(self.buckets + ("+Inf",), counts):
+            cumulative += count
+            lines.append(f'{name}_bucket{{{labels}{sep}le="{bound}"}} {cumulative}')
+        suffix = f"{{{labels}}}" if labels else ""
+        lines.append(f"{name}_sum{suffix} {total}")
+        lines.append(f"{name}_count{suffix} {cumulative}")
+        return lines
+
+
+route_latency = {route: Histogram() for route in METRIC_ROUTES}
+save_latency = Histogram()
+metrics_lock = threading.Lock()
+rows_written = 0
+duplicates_dropped = 0
+validation_failures = {}   # {reason: count}
+device_last_seen = {}      # {device_id_str: epoch seconds of its last write}
+
+
+def count_validation_failure(reason: str):
+    with metrics_lock:
+        validation_failures[reason] = validation_failures.get(reason, 0) + 1
+
+
+class RunningStats:
+    """
+    Statistics of one device field over the last STATS_WINDOW readings:
+    mean/variance by Welford's update (with the matching removal as values
+    leave the window), an EWMA, min/max from monotonic deques, and the
+    length of the current run of identical values. Every update is O(1)
+    (amortised for min/max).
+    """
+
+    def __init__(self, field: str):
+        self.field = field
+        self.stuck_run = STUCK_RUNS.get(field)
+        self.window = deque()
+        self.mean = 0.0
+        self.m2 = 0.0
+        self.ewma = None
+        self.mins = deque()   # window values, non-decreasing
+        self.maxs = deque()   # window values, non-increasing
+        self.last = None
+        self.run = 0
+        self.total = 0
+
+    def std(self) -> float:
+        n = len(self.window)
+        return math.sqrt(max(self.m2, 0.0) / (n - 1)) if n > 1 else 0.0
+
+    def add(self, value: float) -> list:
+        """Adds a reading; returns the flags it raises as (reason, detail) pairs."""
+        # Runs for every field of every reading, so attributes are read into locals once
+        flags = []
+        window, mean = self.window, self.mean
+        n = len(window)
+        if n >= ANOMALY_MIN_COUNT or n >= STATS_WINDOW:
+            sigma = math.sqrt(max(self.m2, 0.0) / (n - 1)) if n > 1 else 0.0
+            deviation = (value - mean) / (sigma if sigma > ANOMALY_MIN_STD else ANOMALY_MIN_STD)
+            if abs(deviation) > ANOMALY_SIGMA:
+                flags.append(("spike", round(deviation, 2)))
+
+        self.run = run = self.run + 1 if value == self.last else 1
+        self.last = value
+        if run == self.stuck_run:
+            flags.append(("stuck", run))
+
+        # Equal values stay in both deques, so the one leaving the window is at the front
+        mins, maxs = self.mins, self.maxs
+        while mins and mins[-1] > value:
+            mins.pop()
+        mins.append(value)
+        while maxs and maxs[-1] < value:
+            maxs.pop()
+        maxs.append(value)
+
+        # Welford: add the new value, drop the one leaving the window
+        window.append(value)
+        n += 1
+        delta = value - mean
+        mean += delta / n
+        m2 = self.m2 + delta * (value - mean)
+        if n > STATS_WINDOW:
+            old = window.popleft()
+            n -= 1
+            delta = old - mean
+            mean -= delta / n
+            m2 -= delta * (old - mean)
+            if mins[0] == old:
+                mins.popleft()
+            if maxs[0] == old:
+                maxs.popleft()
+        self.mean, self.m2 = mean, m2
+
+        self.ewma = value if self.ewma is None else self.ewma + EWMA_ALPHA * (value - self.ewma)
+
+        self.total += 1
+        return flags
+
+    def to_dict(self) -> dict:
+        return {
+            "count": self.total,
+            "window": len(self.window),
+            "mean": self.mean,
+            "std": self.std(),
+            "ewma": self.ewma,
+            "min": self.mins[0],
+            "max": self.maxs[0],
+            "last": self.last,
+            "run": self.run,
+            "stuck": self.stuck_run is not None and self.run >= self.stuck_run,
+        }
+
+
+device_stats = {}       # {device_id_str: {field: RunningStats}}
+device_anomalies = {}   # {device_id_str: deque of recent flags}
+anomaly_counts = {}     # {(field, reason): count}, for /metrics
+stats_lock = threading.Lock()
+
+
+def update_stats(stored: list):
+    """Folds saved readings into their devices' running statistics and records any flags; `stored` is as in save_batch."""
+    flagged = []
+    with stats_lock:
+        for device_id, readings, _, _, values in stored:
+            key = str(device_id)
+            fields = device_stats.setdefault(key, {})
+            for reading, reading_values in zip(readings, values):
+                for field in STATS_FIELDS:
+                    value = reading_values.get(field)
+                    if value is None:
+                        continue
+                    stats = fields.get(field)
+                    if stats is None:
+                        stats = fields[field] = RunningStats(field)
+                    for reason, detail in stats.add(value):
+                        flagged.append((field, reason))
+                        device_anomalies.setdefault(key, deque(maxlen=ANOMALY_LOG_SIZE)).append({
+                            "time": reading.get("time"), "field": field, "value": value,
+                            "reason": reason, "detail": detail
+                        })
+    if flagged:
+        with metrics_lock:
+            for flag in flagged:
+                anomaly_counts[flag] = anomaly_counts.get(flag, 0) + 1
+
+
+def device_stats_dict(device_id: str) -> dict:
+    with stats_lock:
+        return {
+            "fields": {field: stats.to_dict()
+                       for field, stats in device_stats.get(device_id, {}).items()},
+            "anomalies": list(device_anomalies.get(device_id, ())),
+        }
+
+
+def save_device(device_id: int, data: dict):
+    """
+    Writes one row into <device_id>_data.csv (creating file + header if needed).
+    The row goes through the write-behind buffer, so it reaches the file
+    within WRITE_BUFFER_SECONDS; readers call csv_log.flush() first.
+    Expects `data` to be a dict containing:
+      "time", "long", "lat", "alt", "temp", "hum", "uv", "rain"
+    """
+    save_readings(device_id, [data])
+
+
+def save_readings(device_id: int, readings: list, times: list = None):
+    """Saves several readings of one device (see save_batch); `times` are their parsed times, if known."""
+    if times is None:
+        times = [parse_time(data.get("time")) for data in readings]
+    save_batch({device_id: readings}, {device_id: times})
+
+
+def newest_index(times: list) -> int:
+    """Index of the latest time (the last of them on a tie), or of the last row if none parses."""
+    newest = None
+    for i, ts in enumerate(times):
+        if ts is not None and (newest is None or ts >= times[newest]):
+            newest = i
+    return len(times) - 1 if newest is None else newest
+
+
+def is_newer_time(ts, current_ts) -> bool:
+    """False if `ts` is older than the current /latest row's time; times that do not parse count as new."""
+    return ts is None or current_ts is None or ts >= current_ts
+
+
+def validate_reading(device_str, subdict):
     """
-    Writes one row into <device_id>_data.csv (creating file + header if needed).
-    Expects `data` to be a dict containing:
-      "time", "long", "lat", "alt", "temp", "hum", "uv", "rain"
+    Returns (reason, message) describing why one device's reading is invalid,
+    or None if it is valid. `reason` is a short label for /metrics.
     """
-    filename = f"{device_id}_data.csv"
-    filepath = os.path.join(DATA_DIR, filename)
+    try:
+        int(device_str)
+    except (TypeError, ValueError):
+        return "invalid_device_id", f"Device key '{device_str}' is not a valid integer"
 
-    # Map internal keys to proper header names
-    headers = ["time", "longitude", "latitude", "altitude",
-               "temp", "hum", "uv", "rain"]
+    if not isinstance(subdict, dict):
+        return "not_an_object", f"Payload for device '{device_str}' is not a JSON object"
 
-    row = [
-        data.get("time"),
-        data.get("long"),
-        data.get("lat"),
-        data.get("alt"),
-        data.get("temp"),
-        data.get("hum"),
-        data.get("uv"),
-        data.get("rain")
-    ]
+    missing = REQUIRED_FIELDS - subdict.keys()
+    extra = subdict.keys() - REQUIRED_FIELDS
+
+    if missing:
+        return "missing_fields", f"Device '{device_str}' is missing fields: {sorted(missing)}"
+    if extra:
+        return "unexpected_fields", f"Device '{device_str}' has unexpected fields: {sorted(extra)}"
+    return None
+
+
+submit_queue = queue.Queue(maxsize=SUBMIT_QUEUE_SIZE)
+submit_writer = None
+submit_writer_lock = threading.Lock()
+
+
+def save_batch(batch: dict, times: dict, saved: set = None) -> int:
+    """
+    Saves an already validated batch of {device_id: [readings]}, with their
+    parsed {device_id: [times]}. Each device's rows go to its CSV in one
+    buffered append (the sparse index follows when the buffer is flushed)
+    and the device is added to `saved`. The rollups, statistics and /latest
+    entries of every stored device are then updated together, so each of
+    their locks is taken once per batch. Readings older than their device's
+    newest are merged into its history instead (see WriteBehindLog.merge_late)
+    and left out of the statistics; their number is returned.
+    """
+    global rows_written
+    started = time.perf_counter()
+    stored = []   # (device_id, readings, times, CSV rows, _reading_values) per device
+    merged = []   # the same for readings merged into the history
+    error = None
+    for device_id, readings in batch.items():
+        # Cells in the string form csv.writer gives them, so /latest matches the file
+        rows = [
+            ["" if value is None else str(value) for value in (
+                data.get("time"),
+                data.get("long"),
+                data.get("lat"),
+                data.get("alt"),
+                data.get("temp"),
+                data.get("hum"),
+                data.get("uv"),
+                data.get("rain")
+            )]
+            for data in readings
+        ]
+        if not rows:
+            continue
+        device_times = times[device_id]
+        try:
+            late = csv_log.append_rows(device_id, rows, device_times)
+            if late:
+                late_set = set(late)
+                merged.append((device_id, [readings[i] for i in late], [device_times[i] for i in late],
+                               [rows[i] for i in late], [_reading_values(readings[i]) for i in late]))
+                readings = [r for i, r in enumerate(readings) if i not in late_set]
+                device_times = [ts for i, ts in enumerate(device_times) if i not in late_set]
+                rows = [row for i, row in enumerate(rows) if i not in late_set]
+            if columnar is not None:
+                if late:
+                    columnar.mark_incomplete(device_id)   # its columns are append-only
+                columnar.append(device_id, rows)
+        except Exception as e:
+            error = e   # the devices stored so far still get their updates
+            break
+        if saved is not None:
+            saved.add(device_id)
+        if rows:
+            stored.append((device_id, readings, device_times, rows,
+                           [_reading_values(data) for data in readings]))
+
+    update_rollups(stored + merged)
+    update_stats(stored)
+
+    advanced = []
+    with latest_lock:
+        for device_id, _, device_times, rows, _ in stored:
+            key = str(device_id)
+            newest = newest_index(device_times)
+            # A backfill of older readings leaves /latest alone
+            if is_newer_time(device_times[newest], latest_times.get(key)):
+                previous = latest_rows.get(key) or {}
+                latest = latest_rows[key] = dict(zip(CSV_HEADERS, rows[newest]))
+                latest_times[key] = device_times[newest]
+                latest_seqs[key] = next_latest_seq()
+                moved = (latest["longitude"] != previous.get("longitude")
+                         or latest["latitude"] != previous.get("latitude"))
+                advanced.append((device_id, latest, moved))
+    for device_id, latest, moved in advanced:
+        if moved:
+            update_station(device_id, latest)
+        publish_reading(device_id, latest)
+
+    save_latency.observe(time.perf_counter() - started)
+    now = time.time()
+    with metrics_lock:
+        for device_id, _, _, rows, _ in stored + merged:
+            rows_written += len(rows)
+            device_last_seen[str(device_id)] = now
+    if error is not None:
+        raise error
+    return sum(len(rows) for _, _, _, rows, _ in merged)
+
+
+def submit_writer_loop():
+    """Drains the submit queue in bulk until it receives the None sentinel."""
+    while True:
+        batches = [submit_queue.get()]
+        try:
+            while len(batches) < WRITER_DRAIN_MAX:
+                batches.append(submit_queue.get_nowait())
+        except queue.Empty:
+            pass
+
+        for item in batches:
+            if item is None:
+                return
+            batch, times, claimed = item
+            saved = set()
+            try:
+                save_batch(batch, times, saved)
+            except Exception as e:
+                release_unsaved(claimed, saved)   # so the client's retry is stored, not acknowledged
+                print(f"Queued batch could not be saved: {e}")
+
+
+def start_submit_writer():
+    global submit_writer
+    with submit_writer_lock:
+        if submit_writer is None or not submit_writer.is_alive():
+            submit_writer = threading.Thread(target=submit_writer_loop, daemon=True)
+            submit_writer.start()
+
+
+def stop_submit_writer(timeout: float = 10.0):
+    """Lets the writer finish what is queued (runs at exit, before the CSV flush)."""
+    if submit_writer is not None and submit_writer.is_alive():
+        try:
+            submit_queue.put(None, timeout=timeout)
+            submit_writer.join(timeout)
+        except queue.Full:
+            print("Submit queue still full at shutdown; queued batches were dropped")
+
+
+atexit.register(stop_submit_writer)
+
+
+recent_keys = OrderedDict()   # recently stored submission keys, least recently seen first
+dedup_lock = threading.Lock()
+
+
+def claim_keys(keys) -> list:
+    """Marks keys as seen; returns the ones that were not (those callers may store)."""
+    claimed = []
+    with dedup_lock:
+        for key in keys:
+            if key in recent_keys:
+                recent_keys.move_to_end(key)
+                continue
+            recent_keys[key] = None
+            claimed.append(key)
+            while len(recent_keys) > DEDUP_CACHE_SIZE:
+                recent_keys.popitem(last=False)
+    return claimed
+
+
+def release_keys(keys):
+    """Forgets claimed keys again, so a batch that could not be stored can be retried."""
+    with dedup_lock:
+        for key in keys:
+            recent_keys.pop(key, None)
+
+
+def release_unsaved(claimed, saved: set):
+    """Releases the claimed keys of devices that were not stored; every key starts with its device ID."""
+    release_keys([key for key in claimed if key[0] not in saved])
+
+
+def drop_seen_readings(batch: dict, times: dict):
+    """
+    Removes readings whose (device, time) was stored recently, or appears
+    twice in the batch. Readings without a parsable time are always kept.
+    Returns (batch, times, claimed keys, duplicates dropped).
+    """
+    keys = [(device_id, ts) for device_id, device_times in times.items()
+            for ts in device_times if ts is not None]
+    claimed = claim_keys(keys)   # a key twice in `keys` is claimed once while the check is on
+    if len(claimed) == len(keys):
+        return batch, times, claimed, 0
+
+    fresh = set(claimed)
+    kept, kept_times, duplicates = {}, {}, 0
+    for device_id, readings in batch.items():
+        for ts, reading in zip(times[device_id], readings):
+            if ts is not None:
+                if (device_id, ts) not in fresh:
+                    duplicates += 1
+                    continue
+                fresh.discard((device_id, ts))   # later copies in the batch are duplicates
+            kept.setdefault(device_id, []).append(reading)
+            kept_times.setdefault(device_id, []).append(ts)
+    return kept, kept_times, claimed, duplicates
+
+
+def parse_batch_times(batch: dict) -> dict:
+    """
+    Returns {device_id: [epoch time or None]} for a batch. Stations sending
+    together tend to share a time string, so each distinct one is parsed once.
+    """
+    parsed = {}
+    times = {}
+    for device_id, readings in batch.items():
+        device_times = times[device_id] = []
+        for reading in readings:
+            text = reading.get("time")
+            if not isinstance(text, str):
+                device_times.append(parse_time(text))
+                continue
+            if text not in parsed:
+                parsed[text] = parse_time(text)
+            device_times.append(parsed[text])
+    return times
+
+
+def store_batch(batch: dict, message: str):
+    """
+    Saves a validated batch, or queues it when ASYNC_SUBMIT is on. Batches
+    and readings already stored recently are acknowledged, not written again.
+    """
+    global duplicates_dropped
+    times = parse_batch_times(batch)   # everything downstream works with these
+    idempotency_key = request.headers.get(IDEMPOTENCY_HEADER)
+    if idempotency_key:
+        # Claimed per device, so a retry after a partial failure stores only the rest
+        claimed = claim_keys([(device_id, "key", idempotency_key) for device_id in batch])
+        fresh = {key[0] for key in claimed}
+        duplicates = sum(len(readings) for device_id, readings in batch.items() if device_id not in fresh)
+        batch = {device_id: readings for device_id, readings in batch.items() if device_id in fresh}
+    else:
+        batch, times, claimed, duplicates = drop_seen_readings(batch, times)
+    note = f", {duplicates} duplicate readings skipped" if duplicates else ""
+    if duplicates:
+        with metrics_lock:
+            duplicates_dropped += duplicates
+    if not batch:
+        return jsonify({"status": "success", "message": f"{message} already processed"}), 200
+
+    if ASYNC_SUBMIT:
+        start_submit_writer()
+        try:
+            submit_queue.put_nowait((batch, times, claimed))
+        except queue.Full:
+            release_keys(claimed)
+            response = jsonify({"status": "error", "message": "Server busy, retry later"})
+            response.headers["Retry-After"] = str(RETRY_AFTER_SECONDS)
+            return response, 429
+        return jsonify({"status": "accepted", "message": f"{message} queued{note}"}), 202
+
+    saved = set()
+    try:
+        late = save_batch(batch, times, saved)
+        if late:
+            note += f", {late} older readings merged into the history"
+        return jsonify({"status": "success", "message": f"{message} processed{note}"}), 200
+
+    except Exception as e:
+        # The batch was valid; a 5xx makes uploaders retry it rather than reject its readings
+        release_unsaved(claimed, saved)
+        return jsonify({"status": "error", "message": f"Could not save readings: {e}"}), 500
+
+
+def iter_bulk_readings(stream, mimetype: str):
+    """
+    Yields (device_key, reading, position) from a /submit_bulk body, parsing
+    NDJSON line by line and the binary format record by record. Raises
+    ValueError on malformed input.
+    """
+    if mimetype == Wire_format.CONTENT_TYPE:
+        for i, (device, reading) in enumerate(Wire_format.iter_decode(stream)):
+            yield str(device), reading, f"record {i}"
+    elif mimetype == "application/x-ndjson":
+        for line_no, raw in enumerate(stream, 1):
+            if not raw.strip():
+                continue
+            reading = json.loads(raw)
+            if not isinstance(reading, dict):
+                raise ValueError(f"line {line_no}: expected a JSON object")
+            device = reading.pop("device", None)
+            yield str(device), reading, f"line {line_no}"
+    else:
+        payload = json.load(stream)
+        if not isinstance(payload, dict):
+            raise ValueError("Expected a JSON object (dict)")
+        for device, readings in payload.items():
+            if not isinstance(readings, list):
+                readings = [readings]
+            for i, reading in enumerate(readings):
+                yield device, reading, f"device '{device}' reading {i}"
+
+
+@app.before_request
+def start_request_timer():
+    g.request_started = time.perf_counter()
 
-    file_exists = os.path.isfile(filepath)
-    with open(filepath, "a", newline="") as f:
-        writer = csv.writer(f)
-        if not file_exists:
-            writer.writerow(headers)  # Write header only once
-        writer.writerow(row)
+
+@app.before_request
+def require_warm_start():
+    """Answers 503 until the indexes are loaded, except on WARMUP_OPEN_ROUTES."""
+    if not warm_ready.is_set() and request.path not in WARMUP_OPEN_ROUTES:
+        response = jsonify({"status": "error", "message": "Server is starting, retry later"})
+        response.headers["Retry-After"] = str(RETRY_AFTER_SECONDS)
+        return response, 503
+
+
+@app.after_request
+def record_request_latency(response):
+    """Times METRIC_ROUTES; streamed responses are timed until they are closed."""
+    histogram = route_latency.get(request.url_rule.rule if request.url_rule else None)
+    if histogram is not None:
+        started = g.request_started
+        if response.is_streamed:
+            response.call_on_close(lambda: histogram.observe(time.perf_counter() - started))
+        else:
+            histogram.observe(time.perf_counter() - started)
+    return response
 
 
 @app.route('/')
 def home():
     return "Server is running."
 
+
+@app.route("/ready", methods=["GET"])
+def ready():
+    """Readiness probe: 503 until the startup warm-up has loaded every device."""
+    if warm_ready.is_set():
+        return jsonify({"status": "ready", "devices": warmup["total"],
+                        "scanned": warmup["scanned"], "seconds": warmup["seconds"]}), 200
+    response = jsonify({"status": "warming up", "devices": warmup["total"], "done": warmup["done"]})
+    response.headers["Retry-After"] = str(RETRY_AFTER_SECONDS)
+    return response, 503
+
 @app.route('/submit', methods=['POST'])
 def submit():
     """
@@ -74,121 +2376,708 @@ def submit():
         "rain": 1
       }
     }
+
+    The same readings can be sent in the compact binary layout of
+    Wire_format.py, with Content-Type: application/vnd.climanet.readings.
+
+    A retry is acknowledged without writing anything twice: send the same
+    Idempotency-Key header, or none and readings are matched by (device, time).
+    """
+    if request.mimetype == Wire_format.CONTENT_TYPE:
+        try:
+            readings = [(str(device), reading) for device, reading
+                        in Wire_format.iter_decode(request.stream)]
+        except ValueError as e:
+            count_validation_failure("malformed_body")
+            return jsonify({"status": "error", "message": f"Malformed binary body: {e}"}), 400
+    else:
+        payload = request.get_json()
+        if not isinstance(payload, dict):
+            count_validation_failure("not_a_dict")
+            return (
+                jsonify({"status": "error", "message": "Expected a JSON object (dict)"}),
+                400
+            )
+        readings = payload.items()
+
+    # Iterate over each (device_id_str, subdict) pair
+    batch = {}
+    for device_str, subdict in readings:
+        error = validate_reading(device_str, subdict)
+        if error:
+            count_validation_failure(error[0])
+            return jsonify({"status": "error", "message": error[1]}), 400
+        batch.setdefault(int(device_str), []).append(subdict)
+
+    return store_batch(batch, "Batch")
+
+
+@app.route('/submit_bulk', methods=['POST'])
+def submit_bulk():
+    """
+    Accepts many timestamped readings per device in one request, e.g. a
+    station replaying an hour it spent offline. Three body formats:
+      - application/x-ndjson: one reading per line, with its device ID inline
+          {"device": 0, "time": "2025-06-02 12:00:08", "long": 22.947412, ...}
+      - application/json: a dict of device ID -> list of readings
+          {"0": [{"time": ..., ...}, {"time": ..., ...}], "1": [...]}
+      - application/vnd.climanet.readings: binary records (see Wire_format.py)
+    The body may be sent with `Content-Encoding: gzip`. It is parsed as a
+    stream and validated completely before anything is written; each device's
+    readings are then appended in one go.
     """
-    payload = request.get_json()
-    if not isinstance(payload, dict):
+    stream = request.stream
+    if request.content_encoding == "gzip":
+        stream = gzip.GzipFile(fileobj=stream)
+    elif request.content_encoding not in (None, "", "identity"):
+        count_validation_failure("unsupported_encoding")
         return (
-            jsonify({"status": "error", "message": "Expected a JSON object (dict)"}),
-            400
+            jsonify({
+                "status": "error",
+                "message": f"Unsupported Content-Encoding '{request.content_encoding}'"
+            }),
+            415
         )
 
-    # Iterate over each (device_id_str, subdict) pair
-    for device_str, subdict in payload.items():
+    batch = {}
+    count = 0
+    try:
+        for device_str, reading, position in iter_bulk_readings(stream, request.mimetype):
+            error = validate_reading(device_str, reading)
+            if error:
+                count_validation_failure(error[0])
+                return jsonify({"status": "error", "message": f"{position}: {error[1]}"}), 400
+
+            count += 1
+            if count > MAX_BULK_READINGS:
+                count_validation_failure("too_many_readings")
+                return (
+                    jsonify({
+                        "status": "error",
+                        "message": f"More than {MAX_BULK_READINGS} readings in one request"
+                    }),
+                    413
+                )
+            batch.setdefault(int(device_str), []).append(reading)
+
+    except (ValueError, OSError, EOFError) as e:
+        count_validation_failure("malformed_body")
+        return jsonify({"status": "error", "message": f"Malformed bulk body: {e}"}), 400
+
+    return store_batch(batch, f"{count} readings")
+
+
+@app.route("/latest", methods=["GET"])
+def get_latest_data_all_devices():
+    """
+    Returns the last row of every device. The ETag and X-Latest-Seq headers
+    carry the current write sequence number:
+      - If-None-Match with the last ETag gets a 304 when nothing changed
+      - ?since=<X-Latest-Seq> returns only the devices written after it
+    """
+    since = request.args.get("since")
+    try:
+        since = int(since) if since else None
+    except ValueError:
+        return jsonify({"status": "error", "message": "'since' must be an integer"}), 400
+
+    try:
+        if MULTI_PROCESS:
+            refresh_latest_from_disk()
+        with latest_lock:
+            seq = latest_seq
+            if since is None:
+                result = dict(latest_rows)
+            else:
+                result = {device_id: row for device_id, row in latest_rows.items()
+                          if latest_seqs.get(device_id, 0) > since}
+
+        if request.if_none_match.contains(str(seq)):
+            response = Response(status=304)
+        else:
+            response = jsonify(result)
+        response.set_etag(str(seq))
+        response.headers["X-Latest-Seq"] = str(seq)
+        return response
+
+    except Exception as e:
+        return jsonify({"status": "error", "message": str(e)}), 500
+
+
+@app.route("/metrics", methods=["GET"])
+def get_metrics():
+    """Prometheus text exposition of request latencies, ingest counters and device ages."""
+    lines = [
+        "# HELP climanet_request_duration_seconds Time from request start until the response is closed.",
+        "# TYPE climanet_request_duration_seconds histogram",
+    ]
+    for route, histogram in route_latency.items():
+        lines += histogram.render("climanet_request_duration_seconds", f'route="{route}"')
+
+    lines += [
+        "# HELP climanet_save_seconds Time spent in save_batch per batch.",
+        "# TYPE climanet_save_seconds histogram",
+    ]
+    lines += save_latency.render("climanet_save_seconds")
+
+    now = time.time()
+    with metrics_lock:
+        written = rows_written
+        duplicates = duplicates_dropped
+        failures = dict(validation_failures)
+        anomalies = dict(anomaly_counts)
+        last_seen = dict(device_last_seen)
+
+    lines += [
+        "# HELP climanet_rows_written_total Rows accepted into the device logs.",
+        "# TYPE climanet_rows_written_total counter",
+        f"climanet_rows_written_total {written}",
+        "# HELP climanet_duplicate_readings_total Resubmitted readings acknowledged without being written.",
+        "# TYPE climanet_duplicate_readings_total counter",
+        f"climanet_duplicate_readings_total {duplicates}",
+        "# HELP climanet_validation_failures_total Rejected submissions by reason.",
+        "# TYPE climanet_validation_failures_total counter",
+    ]
+    for reason, count in sorted(failures.items()):
+        lines.append(f'climanet_validation_failures_total{{reason="{reason}"}} {count}')
+
+    lines += [
+        "# HELP climanet_anomalies_total Readings flagged on ingest, by field and reason.",
+        "# TYPE climanet_anomalies_total counter",
+    ]
+    for (field, reason), count in sorted(anomalies.items()):
+        lines.append(f'climanet_anomalies_total{{field="{field}",reason="{reason}"}} {count}')
+
+    lines += [
+        "# HELP climanet_device_last_seen_age_seconds Seconds since each device last wrote a row.",
+        "# TYPE climanet_device_last_seen_age_seconds gauge",
+    ]
+    for device_id, seen in sorted(last_seen.items(), key=lambda item: int(item[0])):
+        lines.append(f'climanet_device_last_seen_age_seconds{{device="{device_id}"}} {now - seen:.3f}')
+
+    with stream_lock:
+        clients = len(stream_clients)
+    lines += [
+        "# HELP climanet_submit_queue_depth Batches waiting for the async writer.",
+        "# TYPE climanet_submit_queue_depth gauge",
+        f"climanet_submit_queue_depth {submit_queue.qsize()}",
+        "# HELP climanet_stream_clients Connected /stream subscribers.",
+        "# TYPE climanet_stream_clients gauge",
+        f"climanet_stream_clients {clients}",
+        "# HELP climanet_ready 1 once the startup warm-up has loaded every device.",
+        "# TYPE climanet_ready gauge",
+        f"climanet_ready {int(warm_ready.is_set())}",
+    ]
+    return Response("\n".join(lines) + "\n", mimetype="text/plain; version=0.0.4")
+
+
+@app.route("/stream", methods=["GET"])
+def stream_latest():
+    """
+    Server-Sent Events feed of new readings, so clients need not poll /latest.
+      /stream                 every device
+      /stream?devices=0,3     only these devices
+    The first event ("snapshot") carries the current /latest rows; each
+    "reading" event then carries {device_id: row} in the same format.
+    A ": heartbeat" comment is sent after STREAM_HEARTBEAT_SECONDS of silence.
+    """
+    devices = None
+    if request.args.get("devices"):
         try:
-            device_id = int(device_str)
+            devices = {str(int(d)) for d in request.args["devices"].split(",") if d.strip()}
         except ValueError:
             return (
                 jsonify({
                     "status": "error",
-                    "message": f"Device key '{device_str}' is not a valid integer"
+                    "message": f"'devices' must be a comma separated list of integers: {request.args['devices']}"
                 }),
                 400
             )
 
-        if not isinstance(subdict, dict):
-            return (
-                jsonify({
-                    "status": "error",
-                    "message": f"Payload for device '{device_str}' is not a JSON object"
-                }),
-                400
-            )
+    return Response(
+        stream_events(StreamClient(devices)),
+        mimetype="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+    )
 
-        required_fields = {
-            "time", "long", "lat", "alt", "temp", "hum", "uv", "rain"
-        }
-        missing = required_fields - subdict.keys()
-        extra = subdict.keys() - required_fields
 
-        if missing:
-            return (
-                jsonify({
-                    "status": "error",
-                    "message": (
-                        f"Device '{device_str}' is missing fields: {sorted(missing)}"
-                    )
-                }),
-                400
-            )
-        if extra:
+@app.route("/history", methods=["GET"])
+def get_history():
+    """
+    Returns the rows of one device whose time lies within [from, to]:
+      /history?device=0&from=2025-06-02 12:00:00&to=2025-06-02 13:00:00
+    `from` and `to` accept the station time formats or epoch seconds and may
+    each be omitted. At most `limit` rows (default HISTORY_ROW_LIMIT) are returned.
+    """
+    device_id, error = parse_device_arg()
+    if error:
+        return error
+
+    start, end, error = parse_time_range()
+    if error:
+        return error
+
+    try:
+        limit = int(request.args.get("limit", HISTORY_ROW_LIMIT))
+    except ValueError:
+        return jsonify({"status": "error", "message": "'limit' must be an integer"}), 400
+    limit = max(0, min(limit, HISTORY_ROW_LIMIT))
+
+    try:
+        rows, truncated = read_history(device_id, start, end, limit)
+        return jsonify({"device": device_id, "rows": rows, "truncated": truncated})
+
+    except FileNotFoundError:
+        return (
+            jsonify({"status": "error", "message": f"No data for device '{device_id}'"}),
+            404
+        )
+    except Exception as e:
+        return jsonify({"status": "error", "message": str(e)}), 500
+
+
+@app.route("/rollup", methods=["GET"])
+def get_rollup():
+    """
+    Returns min/max/mean/count buckets for one device:
+      /rollup?device=0&resolution=hour&from=2025-06-01 00:00:00&to=2025-06-08 00:00:00
+    `resolution` is minute, hour (default) or day; `fields=temp,hum` limits
+    the fields returned (default: all of ROLLUP_FIELDS).
+    """
+    device_id, error = parse_device_arg()
+    if error:
+        return error
+
+    start, end, error = parse_time_range()
+    if error:
+        return error
+
+    resolution = request.args.get("resolution", "hour")
+    if resolution not in ROLLUP_RESOLUTIONS:
+        return (
+            jsonify({
+                "status": "error",
+                "message": f"'resolution' must be one of {list(ROLLUP_RESOLUTIONS)}"
+            }),
+            400
+        )
+
+    fields = ROLLUP_FIELDS
+    if request.args.get("fields"):
+        fields = tuple(f.strip() for f in request.args["fields"].split(",") if f.strip())
+        unknown = set(fields) - set(ROLLUP_FIELDS)
+        if unknown:
             return (
                 jsonify({
                     "status": "error",
-                    "message": (
-                        f"Device '{device_str}' has unexpected fields: {sorted(extra)}"
-                    )
+                    "message": f"Unknown fields {sorted(unknown)}, expected some of {list(ROLLUP_FIELDS)}"
                 }),
                 400
             )
 
     try:
-        for device_str, subdict in payload.items():
-            device_id = int(device_str)
-            save_device(device_id, subdict)
-
-        return jsonify({"status": "success", "message": "Batch processed"}), 200
+        buckets = read_rollups(device_id, resolution, start, end, fields)
+        truncated = len(buckets) > ROLLUP_BUCKET_LIMIT
+        return jsonify({
+            "device": device_id,
+            "resolution": resolution,
+            "buckets": buckets[:ROLLUP_BUCKET_LIMIT],
+            "truncated": truncated
+        })
 
     except Exception as e:
-        return jsonify({"status": "error", "message": str(e)}), 400
+        return jsonify({"status": "error", "message": str(e)}), 500
 
 
-@app.route("/latest", methods=["GET"])
-def get_latest_data_all_devices():
-    result = {}
+@app.route("/stations", methods=["GET"])
+def get_stations():
+    """
+    Returns {device_id: latest row} of the stations with a known position,
+    optionally only those inside bbox=min_lon,min_lat,max_lon,max_lat.
+    """
+    bbox = request.args.get("bbox")
     try:
-        for filename in os.listdir(DATA_DIR):
-            if not filename.endswith("_data.csv"):
-                continue
+        if bbox:
+            min_lon, min_lat, max_lon, max_lat = (float(v) for v in bbox.split(","))
+            if not (all(map(math.isfinite, (min_lon, min_lat, max_lon, max_lat)))
+                    and min_lat <= max_lat):
+                raise ValueError
+            device_ids = stations_in_bbox(min_lon, min_lat, max_lon, max_lat)
+        else:
+            with station_lock:
+                device_ids = list(station_positions)
+    except ValueError:
+        return (
+            jsonify({
+                "status": "error",
+                "message": f"'bbox' must be min_lon,min_lat,max_lon,max_lat: {bbox}"
+            }),
+            400
+        )
 
-            device_id = filename.replace("_data.csv", "")
-            filepath = os.path.join(DATA_DIR, filename)
+    with latest_lock:
+        return jsonify({device_id: latest_rows[device_id]
+                        for device_id in device_ids if device_id in latest_rows})
 
-            try:
-                with open(filepath, newline="") as f:
-                    reader = csv.DictReader(f)
-                    last_row_dict = None
-                    for row_dict in reader:
-                        last_row_dict = row_dict
 
-                    if last_row_dict:
-                        result[device_id] = last_row_dict
+@app.route("/nearest", methods=["GET"])
+def get_nearest():
+    """
+    Returns the k (default 1) stations closest to lat=, lon=, nearest first:
+    [{"device", "distance_km", "latest"}, ...].
+    """
+    try:
+        lat = float(request.args.get("lat", ""))
+        lon = float(request.args.get("lon", ""))
+        if not (-90 <= lat <= 90 and -180 <= lon <= 180):
+            raise ValueError
+    except ValueError:
+        return (
+            jsonify({"status": "error", "message": "'lat' and 'lon' must be valid coordinates"}),
+            400
+        )
+    try:
+        k = int(request.args.get("k", 1))
+        if not 1 <= k <= NEAREST_MAX_K:
+            raise ValueError
+    except ValueError:
+        return (
+            jsonify({"status": "error", "message": f"'k' must be an integer from 1 to {NEAREST_MAX_K}"}),
+            400
+        )
+
+    nearest = nearest_stations(lat, lon, k)
+    with latest_lock:
+        return jsonify([
+            {"device": device_id, "distance_km": round(distance, 3),
+             "latest": latest_rows.get(device_id)}
+            for distance, device_id in nearest
+        ])
 
-            except Exception as e:
-                result[device_id] = {"error": f"Could not read file: {e}"}
 
-        return jsonify(result)
+@app.route("/stats", methods=["GET"])
+def get_stats():
+    """
+    Running statistics and recent anomaly flags, for every device or only
+    ?device=<id>: {device: {"fields": {field: {...}}, "anomalies": [...]}}.
+    """
+    if request.args.get("device") is not None:
+        device_id, error = parse_device_arg()
+        if error:
+            return error
+        with stats_lock:
+            known = device_id in device_stats
+        if not known:
+            return jsonify({"status": "error", "message": f"No statistics for device {device_id}"}), 404
+        return jsonify({"device": device_id, **device_stats_dict(device_id)})
 
-    except Exception as e:
-        return jsonify({"status": "error", "message": str(e)}), 500
+    with stats_lock:
+        device_ids = list(device_stats)
+    return jsonify({device_id: device_stats_dict(device_id) for device_id in device_ids})
 
 
 @app.route("/get_logs", methods=["GET"])
 def get_all_logs():
+    """
+    Streams a zip of the device CSVs. Optional filters:
+      devices=0,3,7   only these devices (default: all)
+      from=, to=      only rows in this time range (as in /history)
+      level=0..9      deflate level, 0 = store uncompressed (default EXPORT_LEVEL)
+    """
+    start, end, error = parse_time_range()
+    if error:
+        return error
+
+    try:
+        level = int(request.args.get("level", EXPORT_LEVEL))
+        if not 0 <= level <= 9:
+            raise ValueError
+    except ValueError:
+        return (
+            jsonify({"status": "error", "message": "'level' must be an integer from 0 to 9"}),
+            400
+        )
+
     try:
-        zip_buffer = BytesIO()
-        with zipfile.ZipFile(zip_buffer, "w", zipfile.ZIP_DEFLATED) as zipf:
-            for filename in os.listdir(DATA_DIR):
-                if filename.endswith("_data.csv"):
-                    file_path = os.path.join(DATA_DIR, filename)
-                    zipf.write(file_path, arcname=filename)
-
-        zip_buffer.seek(0)
-        return send_file(
-            zip_buffer,
-            mimetype='application/zip',
-            as_attachment=True,
-            download_name="logs.zip"
+        on_disk = device_ids_on_disk()
+        devices = request.args.get("devices")
+        if devices:
+            try:
+                wanted = {str(int(d)) for d in devices.split(",") if d.strip()}
+            except ValueError:
+                return (
+                    jsonify({
+                        "status": "error",
+                        "message": f"'devices' must be a comma separated list of integers: {devices}"
+                    }),
+                    400
+                )
+            on_disk = [device_id for device_id in on_disk if device_id in wanted]
+
+        chunks = (chunk for chunk in stream_logs_zip(on_disk, start, end, level) if chunk)
+        return Response(
+            chunks,
+            mimetype="application/zip",
+            headers={"Content-Disposition": "attachment; filename=logs.zip"}
         )
 
     except Exception as e:
         return jsonify({"status": "error", "message": str(e)}), 500
+
+
+WARMUP_WORKER_ENV = "CLIMANET_WARMUP_WORKER"   # set in pool processes, which must not warm up themselves
+WARMUP_SETTINGS = ("DATA_DIR", "INDEX_STRIDE", "MULTI_PROCESS", "ROLLUP_SCAN_SLACK")
+ROLLUP_CHECKSUM_BYTES = 64 * 1024   # rollup files change near their end: the tail is what can tear
+
+warm_ready = threading.Event()
+warmup = {"total": 0, "done": 0, "scanned": 0, "seconds": None}
+
+
+def warm_start_path() -> str:
+    return os.path.join(DATA_DIR, "warm_start.json")
+
+
+def _file_checksum(path: str, tail: int = None):
+    """[size, crc32] of a file, or of only its last `tail` bytes; None if it does not exist."""
+    try:
+        with open(path, "rb") as f:
+            size = os.fstat(f.fileno()).st_size
+            if tail is not None:
+                f.seek(max(size - tail, 0))
+            return [size, zlib.crc32(f.read())]
+    except FileNotFoundError:
+        return None
+
+
+def _csv_signature(device_id) -> list:
+    st = os.stat(os.path.join(DATA_DIR, f"{device_id}_data.csv"))
+    return [st.st_size, st.st_mtime_ns, st.st_ino]
+
+
+def _rollup_checksums(device_id) -> dict:
+    return {resolution: _file_checksum(rollup_path(device_id, resolution), ROLLUP_CHECKSUM_BYTES)
+            for resolution in ROLLUP_RESOLUTIONS}
+
+
+def save_warm_start():
+    """
+    Records every device's CSV signature, last row and index file checksums
+    in warm_start.json (at exit, after the final flushes), so the next start
+    can trust those files without scanning the CSVs.
+    """
+    if not warm_ready.is_set() or not os.path.isdir(DATA_DIR):
+        return
+    devices = {}
+    for device_id in device_ids_on_disk():
+        with index_lock:
+            state = offset_index.get(device_id)
+            rows_since = state["rows_since"] if state else None
+        try:
+            devices[device_id] = {
+                "csv": _csv_signature(device_id),
+                "latest": read_last_row(os.path.join(DATA_DIR, f"{device_id}_data.csv")),
+                "idx": _file_checksum(index_path(device_id)),
+                "rows_since": rows_since,
+                "rollups": _rollup_checksums(device_id),
+            }
+        except OSError as e:
+            print(f"Could not record warm start for device {device_id}: {e}")
+
+    body = json.dumps(devices, sort_keys=True)
+    tmp = f"{warm_start_path()}.{os.getpid()}.tmp"
+    with open(tmp, "w") as f:
+        json.dump({"devices": devices, "checksum": zlib.crc32(body.encode())}, f)
+    os.replace(tmp, warm_start_path())
+
+
+def read_warm_start() -> dict:
+    """Returns the devices recorded in warm_start.json, or {} if it is missing or damaged."""
+    try:
+        with open(warm_start_path()) as f:
+            snapshot = json.load(f)
+        devices = snapshot["devices"]
+        if zlib.crc32(json.dumps(devices, sort_keys=True).encode()) == snapshot["checksum"]:
+            return devices
+    except (OSError, ValueError, KeyError, TypeError):
+        pass
+    return {}
+
+
+def warm_from_snapshot(device_id: str, entry: dict):
+    """
+    Returns warm_device's result rebuilt from a warm_start.json entry, or
+    None if the CSV changed since. Index files that fail their checksum
+    although the CSV is unchanged are damaged: they are deleted, so the
+    scan that follows rebuilds them from scratch.
+    """
+    if not entry or entry["csv"] != _csv_signature(device_id):
+        return None
+
+    damaged = []
+    if _file_checksum(index_path(device_id)) != entry["idx"] or entry["rows_since"] is None:
+        damaged.append(index_path(device_id))
+    checksums = _rollup_checksums(device_id)
+    for resolution, checksum in entry["rollups"].items():
+        if checksums.get(resolution) != checksum:
+            damaged.append(rollup_path(device_id, resolution))
+    if damaged:
+        for path in damaged:
+            if os.path.isfile(path):
+                print(f"Checksum mismatch, rebuilding {path}")
+                os.remove(path)
+        return None
+
+    state = _new_index_state()
+    with open(index_path(device_id), "rb") as f:
+        data = f.read()
+        state["idx_ino"] = os.fstat(f.fileno()).st_ino
+    for line in data.splitlines():
+        ts, offset = line.split(b",")
+        state["times"].append(float(ts))
+        state["offsets"].append(int(offset))
+    state["idx_size"], state["rows_since"] = len(data), entry["rows_since"]
+    return {"csv": entry["csv"], "latest": entry["latest"], "index": state, "rollups": {}}
+
+
+def warm_device(device_id: str) -> dict:
+    """Scans one device's files: its last row, sparse index and rollups."""
+    filepath = os.path.join(DATA_DIR, f"{device_id}_data.csv")
+    signature = _csv_signature(device_id)
+    result = {
+        "csv": signature,
+        "latest": read_last_row(filepath),
+        "index": load_offset_index(device_id),
+        "rollups": replay_device_rollups(device_id),
+    }
+    if MULTI_PROCESS:
+        # Other processes may write this device next: persist instead of keeping them open
+        for resolution, (start, stats) in result["rollups"].items():
+            _write_rollup_records(rollup_path(device_id, resolution), [(start, stats)])
+        result["rollups"] = {}
+    return result
+
+
+def warm_device_worker(settings: dict, device_id: str) -> dict:
+    """Process-pool entry point: warm_device with the parent's settings."""
+    globals().update(settings)
+    return warm_device(device_id)
+
+
+def warm_devices(device_ids):
+    """
+    Yields (device_id, warm_device result or exception) for every device,
+    biggest first on a process pool when there is enough to scan.
+    """
+    sizes = {device_id: _csv_signature(device_id)[0] for device_id in device_ids}
+    device_ids = sorted(device_ids, key=sizes.get, reverse=True)
+    processes = min(WARMUP_PROCESSES or os.cpu_count() or 1, len(device_ids))
+    if processes <= 1 or sum(sizes.values()) < WARMUP_POOL_MIN_BYTES:
+        for device_id in device_ids:
+            try:
+                yield device_id, warm_device(device_id)
+            except Exception as e:
+                yield device_id, e
+        return
+
+    settings = {name: globals()[name] for name in WARMUP_SETTINGS}
+    os.environ[WARMUP_WORKER_ENV] = "1"
+    try:
+        with ProcessPoolExecutor(processes, mp_context=multiprocessing.get_context("spawn")) as pool:
+            futures = {pool.submit(warm_device_worker, settings, device_id): device_id
+                       for device_id in device_ids}
+            for future in as_completed(futures):
+                try:
+                    yield futures[future], future.result()
+                except Exception as e:
+                    yield futures[future], e
+    finally:
+        os.environ.pop(WARMUP_WORKER_ENV, None)
+
+
+@contextmanager
+def rollup_replay_lock():
+    """With MULTI_PROCESS, lets one server process at a time replay rollups."""
+    if not MULTI_PROCESS:
+        yield
+        return
+    with open(os.path.join(DATA_DIR, ".rollup.lock"), "a") as lock_file, file_lock(lock_file):
+        yield
+
+
+def load_indexes():
+    """
+    (Re)builds every in-memory index from the files in DATA_DIR: from
+    warm_start.json for devices unchanged since the last clean shutdown,
+    by scanning their files for the rest. Sets `warm_ready` when done.
+    """
+    warm_ready.clear()
+    started = time.monotonic()
+    device_ids = device_ids_on_disk() if os.path.isdir(DATA_DIR) else []
+    warmup.update(total=len(device_ids), done=0, scanned=0, seconds=None)
+    snapshot = read_warm_start() if device_ids else {}
+
+    results, cold = {}, []
+    for device_id in device_ids:
+        try:
+            result = warm_from_snapshot(device_id, snapshot.get(device_id))
+        except (OSError, ValueError, KeyError, TypeError):
+            result = None
+        if result is None:
+            cold.append(device_id)
+        else:
+            results[device_id] = result
+            warmup["done"] += 1
+
+    if cold:
+        with rollup_replay_lock():
+            for device_id, result in warm_devices(cold):
+                if isinstance(result, Exception):
+                    print(f"Could not load device {device_id}: {result}")
+                    result = {"csv": None, "latest": {"error": f"Could not read file: {result}"},
+                              "index": None, "rollups": {}}
+                results[device_id] = result
+                warmup["done"] += 1
+                warmup["scanned"] += 1
+
+    with latest_lock:
+        latest_rows.clear()
+        latest_rows.update({device_id: r["latest"] for device_id, r in results.items() if r["latest"]})
+        latest_times.clear()
+        latest_times.update({device_id: parse_time(row.get("time")) for device_id, row in latest_rows.items()})
+        latest_seqs.clear()
+        latest_seqs.update(dict.fromkeys(latest_rows, latest_seq))
+        latest_file_sizes.clear()
+        latest_file_sizes.update({device_id: r["csv"][0] for device_id, r in results.items() if r["csv"]})
+    with index_lock:
+        offset_index.clear()
+        offset_index.update({device_id: r["index"] for device_id, r in results.items() if r["index"]})
+    with rollup_lock:
+        pending_rollups.clear()
+        open_rollups.clear()
+        open_rollups.update({device_id: r["rollups"] for device_id, r in results.items() if r["rollups"]})
+    with metrics_lock:
+        for device_id in results:
+            try:
+                device_last_seen.setdefault(device_id, os.path.getmtime(
+                    os.path.join(DATA_DIR, f"{device_id}_data.csv")))
+            except OSError:
+                pass
+    rebuild_station_index()
+
+    if os.path.isdir(os.path.join(DATA_DIR, "segments")):
+        start_segment_maintainer()   # seal leftovers, apply retention
+        segment_work.set()
+    warmup["seconds"] = round(time.monotonic() - started, 3)
+    warm_ready.set()
+
+
+def start_warm_up():
+    """Loads the indexes, in a background thread when there is a DATA_DIR to read."""
+    if WARMUP_IN_BACKGROUND and os.path.isdir(DATA_DIR):
+        threading.Thread(target=load_indexes, daemon=True).start()
+    else:
+        load_indexes()
+
+
+if os.environ.get(WARMUP_WORKER_ENV) != "1":
+    start_warm_up()
@@ -0,0 +1,70 @@
+"""
+Timestamps as Climanet stations send them, shared by the server, the
+uploader and the storage tools. Importing this module has no side effects.
+"""
+import calendar
+import math
+import time
+from datetime import date
+
+# Time formats sent by stations, most common first (Receiver.ino prints DD-MM-YYYY)
+RECEIVER_TIME_FORMAT = "%d-%m-%Y %H:%M:%S"
+TIME_FORMATS = (RECEIVER_TIME_FORMAT, "%Y-%m-%d %H:%M:%S")
+
+EPOCH_ORDINAL = date(1970, 1, 1).toordinal()
+
+
+def _parse_fixed(text):
+    """
+    The two TIME_FORMATS with zero-padded fields, read by position: several
+    times faster than strptime. Returns None for anything else (including
+    leap seconds), which is then left to strptime.
+    """
+    if len(text) != 19 or text[10] != " " or text[13] != ":" or text[16] != ":":
+        return None
+    if text[2] == "-" and text[5] == "-":
+        digits = text[6:10] + text[3:5] + text[0:2]
+    elif text[4] == "-" and text[7] == "-":
+        digits = text[0:4] + text[5:7] + text[8:10]
+    else:
+        return None
+    digits += text[11:13] + text[14:16] + text[17:19]
+    if not (digits.isascii() and digits.isdigit()):
+        return None
+    hour, minute, second = int(digits[8:10]), int(digits[10:12]), int(digits[12:14])
+    if hour > 23 or minute > 59 or second > 59:
+        return None
+    try:
+        day = date(int(digits[0:4]), int(digits[4:6]), int(digits[6:8])).toordinal() - EPOCH_ORDINAL
+    except ValueError:
+        return None
+    return float(day * 86400 + hour * 3600 + minute * 60 + second)
+
+
+def parse_time(value):
+    """
+    Returns `value` as UTC epoch seconds (float), or None if it is not a
+    recognised timestamp. Accepts epoch numbers and the TIME_FORMATS strings.
+    """
+    if value is None:
+        return None
+    text = str(value).strip()
+    ts = _parse_fixed(text)
+    if ts is not None:
+        return ts
+    try:
+        ts = float(text)
+        return ts if math.isfinite(ts) else None
+    except ValueError:
+        pass
+    for fmt in TIME_FORMATS:
+        try:
+            return float(calendar.timegm(time.strptime(text, fmt)))
+        except ValueError:
+            continue
+    return None
+
+
+def utc_day(ts):
+    """Days since the epoch of an epoch-seconds time (None stays None)."""
+    return None if ts is None else int(ts // 86400)